@@ -0,0 +1,94 @@
+# Presupuesto de arranque en frío: mide `import main` en procesos nuevos y el tiempo hasta la primera respuesta
+# de uvicorn, y falla (código 1) si el coste propio de main (sin FastAPI/pydantic, que no se pueden diferir)
+# supera el presupuesto o si alguna dependencia pesada vuelve a importarse al cargar el módulo.
+# tests/test_arranque.py comprueba lo mismo en cada ejecución de los tests (sin uvicorn).
+# Uso: python benchmarks/bench_arranque.py --presupuesto-ms 250 --repeticiones 5
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENTORNO = {"TOKENIZER_FALLBACK": "1", **os.environ, "LOG_LEVEL": "ERROR", "PYTHONDONTWRITEBYTECODE": "1"}
+
+SCRIPT_IMPORT = """
+import json, sys, time
+inicio = time.perf_counter()
+import main
+fin = time.perf_counter()
+print(json.dumps({"ms": (fin - inicio) * 1000, **main.estado_arranque}))
+"""
+
+
+def medir_import() -> dict:
+    salida = subprocess.run([sys.executable, "-X", "importtime", "-c", SCRIPT_IMPORT], cwd=RAIZ, env=ENTORNO,
+                            capture_output=True, text=True, check=True)
+    resultado = json.loads(salida.stdout.strip().splitlines()[-1])
+    # Líneas "import time: self | acumulado | módulo"; solo imports de primer nivel dentro de main
+    resultado["top"] = []
+    for linea in salida.stderr.splitlines():
+        partes = linea.split("|")
+        if len(partes) == 3 and partes[1].strip().isdigit() and partes[2].startswith("   ") and not partes[2].startswith("     "):
+            resultado["top"].append((int(partes[1]) / 1000, partes[2].strip()))
+    return resultado
+
+
+def puerto_libre() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def medir_primera_respuesta(timeout: float = 30.0) -> float:
+    puerto = puerto_libre()
+    inicio = time.perf_counter()
+    proceso = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(puerto), "--log-level", "error"],
+                               cwd=RAIZ, env=ENTORNO, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - inicio < timeout:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{puerto}/stats", timeout=1) as r:
+                    if r.status == 200:
+                        return (time.perf_counter() - inicio) * 1000
+            except OSError:
+                time.sleep(0.01)
+        raise TimeoutError(f"uvicorn no respondió en {timeout}s")
+    finally:
+        proceso.terminate()
+        proceso.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Presupuesto de tiempo de arranque de main.py")
+    parser.add_argument("--repeticiones", type=int, default=5)
+    parser.add_argument("--presupuesto-ms", type=float, default=float(os.getenv("IMPORT_BUDGET_MS", 250)),
+                        help="Mediana máxima del coste propio de `import main` (ms, sin FastAPI/pydantic); depende de la máquina")
+    parser.add_argument("--sin-uvicorn", action="store_true", help="No mide el tiempo hasta la primera respuesta")
+    args = parser.parse_args()
+
+    medidas = [medir_import() for _ in range(args.repeticiones)]
+    mediana_total = statistics.median(m["ms"] for m in medidas)
+    mediana = statistics.median(m["import_ms"] for m in medidas)
+    print(f"import main: mediana {mediana_total:.0f} ms en total, {mediana:.0f} ms propios (mín {min(m['import_ms'] for m in medidas):.0f}, "
+          f"máx {max(m['import_ms'] for m in medidas):.0f}) en {args.repeticiones} procesos; presupuesto {args.presupuesto_ms:.0f} ms propios")
+    print("Imports de primer nivel más lentos (ms acumulados, última ejecución):")
+    for ms, modulo in sorted(medidas[-1]["top"], reverse=True)[:10]:
+        print(f"  {ms:8.1f}  {modulo}")
+    if not args.sin_uvicorn:
+        primeras = [medir_primera_respuesta() for _ in range(max(1, args.repeticiones // 2))]
+        print(f"Hasta la primera respuesta de uvicorn (GET /stats): mediana {statistics.median(primeras):.0f} ms")
+
+    errores = []
+    cargados = medidas[-1]["eager_deferred_modules"]
+    if cargados:
+        errores.append(f"dependencias que deberían importarse en el primer uso cargadas al importar main: {', '.join(cargados)}")
+    if mediana > args.presupuesto_ms:
+        errores.append(f"import main tarda {mediana:.0f} ms propios (> {args.presupuesto_ms:.0f} ms)")
+    for error in errores:
+        print(f"FALLO: {error}")
+    sys.exit(1 if errores else 0)
@@ -0,0 +1,244 @@
+# Benchmark de carga offline: /consulta, /process-document, /analizar-documento y /direccion/detalles contra
+# sustitutos locales (benchmarks/falsos.py), sin OpenAI, Google, PHP Bridge ni PostgreSQL reales.
+# La app se ejecuta en proceso (httpx.ASGITransport + lifespan), así que las cifras sirven para comparar
+# versiones de main.py en la misma máquina, no como capacidad absoluta.
+# Uso:
+#   python benchmarks/bench_carga.py --guardar benchmarks/baseline.json
+#   python benchmarks/bench_carga.py --baseline benchmarks/baseline.json --tolerancia 10
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from falsos import GENERADORES, Latencias, ServidorFalso, instalar_bd_falsa  # noqa: E402
+
+ESCENARIOS = ("consulta", "ingesta", "analisis", "places")
+MIME = {"pdf": "application/pdf", "docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+        "csv": "text/csv", "txt": "text/plain"}
+
+
+def percentil(valores: list, p: float) -> float:
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    k = (len(ordenados) - 1) * p
+    i = int(k)
+    return ordenados[i] + (ordenados[min(i + 1, len(ordenados) - 1)] - ordenados[i]) * (k - i)
+
+
+# Pico de RSS (VmHWM) por escenario: se reinicia escribiendo 5 en clear_refs (Linux); si no se puede, es el del proceso
+def _reiniciar_pico_rss(pid="self"):
+    try:
+        with open(f"/proc/{pid}/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _pico_rss_mb(pid="self") -> float:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for linea in f:
+                if linea.startswith("VmHWM:"):
+                    return int(linea.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if pid == "self" else 0.0
+
+
+def reiniciar_picos():
+    _reiniciar_pico_rss()
+    for hijo in multiprocessing.active_children():
+        _reiniciar_pico_rss(hijo.pid)
+
+
+def picos_rss() -> tuple[float, float]:
+    # (proceso principal, suma de los procesos de extracción)
+    return _pico_rss_mb(), sum(_pico_rss_mb(h.pid) for h in multiprocessing.active_children())
+
+
+async def ejecutar_carga(nombre: str, variante: str, peticiones: int, concurrencia: int, una) -> dict:
+    limite = asyncio.Semaphore(concurrencia)
+    latencias = []
+    fallos = 0
+
+    async def envolver(i: int):
+        nonlocal fallos
+        async with limite:
+            inicio = time.perf_counter()
+            try:
+                ok = await una(i)
+            except Exception as e:
+                print(f"  ! {nombre}/{variante} #{i}: {type(e).__name__}: {e}", file=sys.stderr)
+                ok = False
+            latencias.append(time.perf_counter() - inicio)
+            fallos += 0 if ok else 1
+
+    reiniciar_picos()
+    inicio = time.perf_counter()
+    await asyncio.gather(*(envolver(i) for i in range(peticiones)))
+    total = time.perf_counter() - inicio
+    rss, rss_hijos = picos_rss()
+    return {
+        "escenario": nombre, "variante": variante, "peticiones": peticiones, "concurrencia": concurrencia, "fallos": fallos,
+        "p50_s": percentil(latencias, 0.50), "p95_s": percentil(latencias, 0.95), "p99_s": percentil(latencias, 0.99),
+        "rps": peticiones / total if total else 0.0, "rss_mb": round(rss, 1), "rss_hijos_mb": round(rss_hijos, 1)
+    }
+
+
+async def carga_consulta(http, args) -> list[dict]:
+    async def una(i: int) -> bool:
+        # Uno de cada cuatro con búsqueda web forzada; mensajes distintos para no acertar en la caché
+        r = await http.post("/consulta", json={"user_id": 1, "tenant_id": 1, "mensaje": f"¿Qué plazos fija el pliego {i}?",
+                                               "especializacion": "legal", "buscar_web": i % 4 == 0})
+        return r.status_code == 200 and "Error" not in r.json()["respuesta"]
+    return [await ejecutar_carga("consulta", "-", args.peticiones, args.concurrencia, una)]
+
+
+async def carga_places(http, args) -> list[dict]:
+    async def una(i: int) -> bool:
+        r = await http.get(f"/direccion/detalles/bench-{time.time_ns()}-{i}")
+        return r.status_code == 200 and r.json()["success"]
+    return [await ejecutar_carga("places", "-", args.peticiones, args.concurrencia, una)]
+
+
+async def carga_ingesta(http, args, servidor: ServidorFalso) -> list[dict]:
+    resultados = []
+    siguiente_id = 1
+    for tipo in args.tipos:
+        for kb in args.tamanos_kb:
+            base = siguiente_id
+            for i in range(args.peticiones):
+                servidor.documentos[base + i] = (f"bench_{base + i}.{tipo}", GENERADORES[tipo](kb, base + i))
+            siguiente_id += args.peticiones
+
+            async def una(i: int, base=base) -> bool:
+                r = await http.post("/process-document", params={"async": "1"}, json={"doc_id": base + i, "user_id": 1, "tenant_id": 1})
+                trabajo = r.json()
+                if not trabajo.get("job_id"):
+                    return False
+                while True:  # Extremo a extremo: hasta que el worker de la cola termina
+                    await asyncio.sleep(0.02)
+                    estado = (await http.get(f"/process-document/jobs/{trabajo['job_id']}")).json()
+                    if estado["status"] in ("done", "failed"):
+                        return estado["status"] == "done"
+            resultados.append(await ejecutar_carga("ingesta", f"{tipo}-{kb}KB", args.peticiones, args.concurrencia, una))
+            for i in range(args.peticiones):
+                servidor.documentos.pop(base + i, None)
+    return resultados
+
+
+async def carga_analisis(http, args) -> list[dict]:
+    resultados = []
+    for tipo in args.tipos:
+        for kb in args.tamanos_kb:
+            corpus = [GENERADORES[tipo](kb, 10_000 + i) for i in range(args.peticiones)]
+
+            async def una(i: int, corpus=corpus, tipo=tipo) -> bool:
+                r = await http.post("/analizar-documento", data={"user_id": "1", "tenant_id": "1", "especializacion": "general"},
+                                    files={"file": (f"analisis_{i}.{tipo}", corpus[i], MIME[tipo])})
+                return r.status_code == 200 and "Error" not in r.json()["informe"][:200]
+            resultados.append(await ejecutar_carga("analisis", f"{tipo}-{kb}KB", args.peticiones, args.concurrencia, una))
+    return resultados
+
+
+def clave(r: dict) -> str:
+    return f"{r['escenario']}/{r['variante']}"
+
+
+def imprimir(resultados: list[dict], baseline: dict | None, tolerancia: float) -> int:
+    regresiones = 0
+    print(f"{'escenario':<26} {'n':>4} {'fallos':>6} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8} {'req/s':>7} {'RSS MB':>7} {'+hijos':>7}")
+    for r in resultados:
+        print(f"{clave(r):<26} {r['peticiones']:>4} {r['fallos']:>6} {r['p50_s']:>8.3f} {r['p95_s']:>8.3f} {r['p99_s']:>8.3f} "
+              f"{r['rps']:>7.1f} {r['rss_mb']:>7.0f} {r['rss_hijos_mb']:>7.0f}")
+        previo = (baseline or {}).get(clave(r))
+        if not previo:
+            continue
+        deltas = []
+        for campo, mayor_es_mejor in (("p50_s", False), ("p95_s", False), ("p99_s", False), ("rps", True), ("rss_mb", False)):
+            if not previo.get(campo):
+                continue
+            cambio = (r[campo] - previo[campo]) / previo[campo] * 100
+            peor = -cambio if mayor_es_mejor else cambio
+            marca = " !" if peor > tolerancia else ""
+            regresiones += 1 if marca else 0
+            deltas.append(f"{campo} {cambio:+.1f}%{marca}")
+        print(f"{'':<26} vs baseline: " + ", ".join(deltas))
+    return regresiones
+
+
+async def ejecutar(args, servidor: ServidorFalso):
+    import main
+    instalar_bd_falsa(main, args.latencia_bd, servidor.documentos)
+    from httpx import ASGITransport, AsyncClient
+    resultados = []
+    async with main.lifespan(main.app):
+        # Calienta el pool de extracción (imports de PyPDF2/python-docx en cada proceso) fuera de la medida
+        await asyncio.gather(*(main.extraction_pool.ejecutar(main.extraer_texto_documento, GENERADORES[tipo](1), tipo)
+                               for tipo in args.tipos for _ in range(max(1, main.EXTRACT_WORKERS))))
+        async with AsyncClient(transport=ASGITransport(app=main.app), base_url="http://bench", timeout=None) as http:
+            for escenario in args.escenarios:
+                if escenario == "consulta":
+                    resultados += await carga_consulta(http, args)
+                elif escenario == "ingesta":
+                    resultados += await carga_ingesta(http, args, servidor)
+                elif escenario == "analisis":
+                    resultados += await carga_analisis(http, args)
+                elif escenario == "places":
+                    resultados += await carga_places(http, args)
+    return resultados
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark de carga offline de main.py")
+    parser.add_argument("--escenarios", nargs="+", choices=ESCENARIOS, default=list(ESCENARIOS))
+    parser.add_argument("--peticiones", type=int, default=40, help="Peticiones por escenario y variante")
+    parser.add_argument("--concurrencia", type=int, default=8)
+    parser.add_argument("--tipos", nargs="+", choices=sorted(GENERADORES), default=["pdf", "docx", "csv"])
+    parser.add_argument("--tamanos-kb", type=int, nargs="+", default=[16, 256, 1024], help="Tamaños del corpus sintético")
+    parser.add_argument("--latencia-openai", type=float, default=0.8)
+    parser.add_argument("--chunks-openai", type=int, default=20, help="Fragmentos por respuesta en streaming")
+    parser.add_argument("--tokens-respuesta", type=int, default=400)
+    parser.add_argument("--latencia-search", type=float, default=0.15)
+    parser.add_argument("--latencia-places", type=float, default=0.08)
+    parser.add_argument("--latencia-php", type=float, default=0.2)
+    parser.add_argument("--latencia-bd", type=float, default=0.005, help="Segundos por consulta a la BD falsa")
+    parser.add_argument("--con-cache", action="store_true", help="No desactiva las cachés de análisis en disco")
+    parser.add_argument("--baseline", help="JSON de una ejecución anterior con el que comparar")
+    parser.add_argument("--tolerancia", type=float, default=10.0, help="%% de empeoramiento que se marca como regresión")
+    parser.add_argument("--guardar", help="Guarda los resultados en este JSON (para usarlo como baseline)")
+    parser.add_argument("--verbose", action="store_true", help="Muestra el log INFO de main")
+    args = parser.parse_args()
+
+    latencias = Latencias(openai=args.latencia_openai, openai_chunks=args.chunks_openai, tokens_respuesta=args.tokens_respuesta,
+                          search=args.latencia_search, places=args.latencia_places, php=args.latencia_php)
+    servidor = ServidorFalso(latencias).arrancar()
+    os.environ.update(servidor.variables_entorno())
+    os.environ.setdefault("EMBEDDER", "local")
+    if not args.con_cache:
+        os.environ["ANALISIS_CACHE_TEXTO_MAX_BYTES"] = "0"
+        os.environ["ANALISIS_CACHE_INFORME_MAX_BYTES"] = "0"
+    if not args.verbose:
+        os.environ["LOG_LEVEL"] = "ERROR"  # También en los procesos de extracción (heredan el entorno)
+    try:
+        resultados = asyncio.run(ejecutar(args, servidor))
+    finally:
+        servidor.parar()
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = {clave(r): r for r in json.load(f)["resultados"]}
+    regresiones = imprimir(resultados, baseline, args.tolerancia)
+    print(f"Peticiones a los sustitutos: {servidor.peticiones}")
+    if args.guardar:
+        with open(args.guardar, "w", encoding="utf-8") as f:
+            json.dump({"fecha": time.strftime("%Y-%m-%d %H:%M:%S"), "argumentos": vars(args), "resultados": resultados}, f, indent=2, ensure_ascii=False)
+    sys.exit(1 if regresiones else 0)
@@ -0,0 +1,97 @@
+"""Benchmark de ingesta (/process-document): N documentos en paralelo contra el PHP Bridge falso de falsos.py.
+
+La BD se sustituye por funciones que duermen (como un driver bloqueante) para medir solo el pipeline.
+Uso: python benchmarks/bench_ingesta.py --docs 40 --concurrencia 1 4 16 --latencia-php 0.2
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from falsos import Latencias, ServidorFalso, generar_txt, instalar_bd_falsa  # noqa: E402
+
+
+def preparar_main(servidor: ServidorFalso, latencia_bd: float):
+    import main
+    main.PHP_FILE_SERVE_URL = f"{servidor.url}/serve.php"
+    main.PHP_API_SECRET_KEY = "bench"
+    instalar_bd_falsa(main, latencia_bd, servidor.documentos)
+    return main
+
+
+async def medir_lag(parar: asyncio.Event, muestras: list):
+    intervalo = 0.01
+    while not parar.is_set():
+        inicio = time.perf_counter()
+        await asyncio.sleep(intervalo)
+        muestras.append(time.perf_counter() - inicio - intervalo)
+
+
+async def ronda(main, docs: int, concurrencia: int) -> dict:
+    limite = asyncio.Semaphore(concurrencia)
+    latencias = []
+    fallos = 0
+
+    async def uno(doc_id: int):
+        nonlocal fallos
+        async with limite:
+            inicio = time.perf_counter()
+            resultado = await main.procesar_documento(doc_id, 1, 1)
+            latencias.append(time.perf_counter() - inicio)
+            fallos += 0 if resultado.success else 1
+
+    parar = asyncio.Event()
+    lag = []
+    monitor = asyncio.create_task(medir_lag(parar, lag))
+    inicio = time.perf_counter()
+    await asyncio.gather(*(uno(i) for i in range(docs)))
+    total = time.perf_counter() - inicio
+    parar.set()
+    await monitor
+    latencias.sort()
+    return {
+        "concurrencia": concurrencia, "total_s": total, "docs_s": docs / total, "fallos": fallos,
+        "p50_s": statistics.median(latencias), "p95_s": latencias[int(0.95 * (len(latencias) - 1))],
+        "lag_max_ms": max(lag, default=0.0) * 1000
+    }
+
+
+async def ejecutar(args):
+    servidor = ServidorFalso(Latencias(php=args.latencia_php, php_bloques=args.bloques)).arrancar()
+    cuerpo = generar_txt(args.kb)
+    for doc_id in range(-1, args.docs):
+        servidor.documentos[doc_id] = (f"doc_{doc_id}.txt", cuerpo)
+    main = preparar_main(servidor, args.latencia_bd)
+    main.extraction_pool.abrir()
+    try:
+        await main.procesar_documento(-1, 1, 1)  # Calienta el pool de extracción
+        print(f"{args.docs} docs de {args.kb} KB, PHP {args.latencia_php * 1000:.0f} ms, BD {args.latencia_bd * 1000:.0f} ms/consulta, {main.EXTRACT_WORKERS} procesos de extracción")
+        print(f"{'conc':>5} {'total s':>8} {'docs/s':>8} {'p50 s':>7} {'p95 s':>7} {'lag máx ms':>11} {'fallos':>7}")
+        for concurrencia in args.concurrencia:
+            r = await ronda(main, args.docs, concurrencia)
+            print(f"{r['concurrencia']:>5} {r['total_s']:>8.2f} {r['docs_s']:>8.1f} {r['p50_s']:>7.3f} {r['p95_s']:>7.3f} {r['lag_max_ms']:>11.1f} {r['fallos']:>7}")
+    finally:
+        await main.cliente_php.cerrar()
+        main.extraction_pool.cerrar()
+        servidor.parar()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--docs", type=int, default=40)
+    parser.add_argument("--concurrencia", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--kb", type=int, default=256, help="Tamaño de cada documento TXT")
+    parser.add_argument("--latencia-php", type=float, default=0.2, help="Segundos por descarga (mitad hasta el primer byte, mitad de transferencia)")
+    parser.add_argument("--bloques", type=int, default=8, help="Bloques en que el PHP falso envía el cuerpo")
+    parser.add_argument("--latencia-bd", type=float, default=0.01)
+    parser.add_argument("--verbose", action="store_true", help="Muestra el log INFO de main")
+    args = parser.parse_args()
+    os.environ.setdefault("EMBEDDER", "local")
+    if not args.verbose:
+        os.environ["LOG_LEVEL"] = "ERROR"  # También en los procesos de extracción (heredan el entorno)
+    asyncio.run(ejecutar(args))
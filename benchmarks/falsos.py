@@ -0,0 +1,274 @@
+# Sustitutos locales para los benchmarks: un servidor HTTP que imita OpenAI (chat con y sin streaming, embeddings),
+# Google Custom Search, Google Places Details y el PHP Bridge, una BD falsa (funciones de main sustituidas por
+# esperas, como un driver bloqueante) y generadores de corpus sintéticos PDF/DOCX/CSV/TXT.
+import io
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+FRASE = "El adjudicatario entregará la documentación técnica en un plazo de 30 días naturales desde la firma. "
+
+
+class Latencias:
+    def __init__(self, openai: float = 0.8, openai_chunks: int = 20, tokens_respuesta: int = 400,
+                 search: float = 0.15, places: float = 0.08, php: float = 0.2, php_bloques: int = 8):
+        self.openai = openai  # Hasta el primer token (o la respuesta completa sin streaming)
+        self.openai_chunks = openai_chunks  # Fragmentos en streaming; se reparte otra `openai` entre ellos
+        self.tokens_respuesta = tokens_respuesta
+        self.search = search
+        self.places = places
+        self.php = php  # Mitad hasta el primer byte, mitad de transferencia
+        self.php_bloques = php_bloques
+
+
+def texto_sintetico(kb: int, semilla: int = 0) -> str:
+    cabecera = f"Documento sintético {semilla}. "
+    return (cabecera + FRASE * (kb * 1024 // len(FRASE) + 1))[:kb * 1024]
+
+
+def generar_txt(kb: int, semilla: int = 0) -> bytes:
+    return texto_sintetico(kb, semilla).encode("utf-8")
+
+
+def generar_csv(kb: int, semilla: int = 0) -> bytes:
+    rnd = random.Random(semilla)
+    salida = io.StringIO()
+    salida.write("id;fecha;cliente;importe;estado;observaciones\n")
+    i = 0
+    while salida.tell() < kb * 1024:
+        salida.write(f"{i};2024-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d};Cliente {rnd.randint(1, 500)};"
+                     f"{rnd.uniform(10, 5000):.2f};{rnd.choice(['pagado', 'pendiente', 'anulado'])};Lote {semilla}\n")
+        i += 1
+    return salida.getvalue().encode("utf-8")
+
+
+def generar_docx(kb: int, semilla: int = 0) -> bytes:
+    from docx import Document
+    documento = Document()
+    documento.add_heading(f"Pliego sintético {semilla}", 1)
+    parrafo = FRASE * 8
+    for _ in range(max(1, kb * 1024 // len(parrafo))):
+        documento.add_paragraph(parrafo)
+    salida = io.BytesIO()
+    documento.save(salida)
+    return salida.getvalue()
+
+
+def generar_pdf(kb: int, semilla: int = 0) -> bytes:
+    # PDF mínimo escrito a mano (Helvetica, ~3 KB de texto por página) que PyPDF2 puede extraer
+    lineas = [f"Documento sintetico {semilla}."] + [FRASE.encode("ascii", "replace").decode()] * 40
+    n = max(1, kb * 1024 // sum(len(l) for l in lineas))  # Páginas
+    objetos = [b"<< /Type /Catalog /Pages 2 0 R >>",
+               f"<< /Type /Pages /Kids [{' '.join(f'{3 + 2 * i} 0 R' for i in range(n))}] /Count {n} >>".encode()]
+    fuente = 3 + 2 * n
+    cuerpo = ("BT /F1 9 Tf 30 760 Td 11 TL " + " ".join(f"({l}) '" for l in lineas) + " ET").encode("latin-1")
+    for i in range(n):
+        objetos.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {4 + 2 * i} 0 R "
+                       f"/Resources << /Font << /F1 {fuente} 0 R >> >> >>".encode())
+        objetos.append(b"<< /Length %d >>\nstream\n" % len(cuerpo) + cuerpo + b"\nendstream")
+    objetos.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    salida = b"%PDF-1.4\n"
+    offsets = []
+    for i, objeto in enumerate(objetos):
+        offsets.append(len(salida))
+        salida += f"{i + 1} 0 obj\n".encode() + objeto + b"\nendobj\n"
+    xref = len(salida)
+    salida += f"xref\n0 {len(objetos) + 1}\n0000000000 65535 f \n".encode()
+    salida += b"".join(f"{o:010d} 00000 n \n".encode() for o in offsets)
+    salida += f"trailer\n<< /Size {len(objetos) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return salida
+
+
+GENERADORES = {"pdf": generar_pdf, "docx": generar_docx, "csv": generar_csv, "txt": generar_txt}
+
+
+def respuesta_html(tokens: int, semilla: str = "") -> str:
+    palabras = max(1, int(tokens * 0.75))
+    return f"<h2>Respuesta {semilla}</h2><p>" + " ".join(["informe"] * palabras) + "</p>"
+
+
+class ServidorFalso:
+    """Un único servidor local para todos los servicios externos; `documentos` es doc_id -> (nombre, bytes) del PHP Bridge."""
+
+    def __init__(self, latencias: Latencias):
+        self.latencias = latencias
+        self.documentos = {}
+        self.peticiones = {"openai": 0, "embeddings": 0, "search": 0, "places": 0, "php": 0}
+        self._servidor = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._servidor.daemon_threads = True
+        self._servidor.request_queue_size = 1024
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._servidor.server_address[1]}"
+
+    def variables_entorno(self) -> dict:
+        # Para exportar antes de importar main
+        return {
+            "OPENAI_API_KEY": "bench", "OPENAI_BASE_URL": f"{self.url}/v1",
+            "GOOGLE_API_KEY": "bench", "GOOGLE_CX": "bench", "GOOGLE_SEARCH_URL": f"{self.url}/customsearch/v1",
+            "MAPS_API_ALL": "bench", "GOOGLE_PLACES_DETAILS_URL": f"{self.url}/maps/api/place/details/json",
+            "PHP_FILE_SERVE_URL": f"{self.url}/serve.php", "PHP_API_SECRET_KEY": "bench",
+            "TOKENIZER_FALLBACK": os.environ.get("TOKENIZER_FALLBACK", "1"),  # Sin red: estimación si no hay BPE en caché
+        }
+
+    def arrancar(self):
+        threading.Thread(target=self._servidor.serve_forever, daemon=True).start()
+        return self
+
+    def parar(self):
+        self._servidor.shutdown()
+        self._servidor.server_close()
+
+    def _handler(self):
+        falso = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _json(self, datos: dict, estado: int = 200):
+                cuerpo = json.dumps(datos).encode("utf-8")
+                self.send_response(estado)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(cuerpo)))
+                self.end_headers()
+                self.wfile.write(cuerpo)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                lat = falso.latencias
+                if url.path == "/customsearch/v1":
+                    falso.peticiones["search"] += 1
+                    time.sleep(lat.search)
+                    items = [{"title": f"Resultado {i} para {params.get('q', '')}", "link": f"https://ejemplo.es/{i}",
+                              "snippet": FRASE} for i in range(int(params.get("num", 5)))]
+                    return self._json({"items": items})
+                if url.path == "/maps/api/place/details/json":
+                    falso.peticiones["places"] += 1
+                    time.sleep(lat.places)
+                    componentes = [
+                        {"long_name": "3", "types": ["street_number"]}, {"long_name": "Calle Larios", "types": ["route"]},
+                        {"long_name": "29005", "types": ["postal_code"]}, {"long_name": "Málaga", "types": ["locality"]},
+                        {"long_name": "Málaga", "types": ["administrative_area_level_2"]}, {"long_name": "España", "types": ["country"]},
+                    ]
+                    return self._json({"status": "OK", "result": {"formatted_address": "Calle Larios, 3, 29005 Málaga, España",
+                                                                  "address_components": componentes}})
+                if url.path == "/serve.php":
+                    falso.peticiones["php"] += 1
+                    documento = falso.documentos.get(int(params.get("doc_id", -1)))
+                    cuerpo = documento[1] if documento else None
+                    time.sleep(lat.php / 2)
+                    if cuerpo is None:
+                        return self._json({"error": "not found"}, 404)
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/octet-stream")
+                    self.send_header("Content-Length", str(len(cuerpo)))
+                    self.end_headers()
+                    tam = max(1, len(cuerpo) // max(1, lat.php_bloques))
+                    for i in range(0, len(cuerpo), tam):
+                        self.wfile.write(cuerpo[i:i + tam])
+                        time.sleep(lat.php / 2 / max(1, lat.php_bloques))
+                    return
+                self._json({"error": "ruta desconocida"}, 404)
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                peticion = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                lat = falso.latencias
+                if url.path == "/v1/embeddings":
+                    falso.peticiones["embeddings"] += 1
+                    entradas = peticion.get("input") or []
+                    entradas = [entradas] if isinstance(entradas, str) else entradas
+                    time.sleep(lat.openai / 4)
+                    datos = [{"object": "embedding", "index": i, "embedding": [random.random() for _ in range(64)]} for i in range(len(entradas))]
+                    return self._json({"object": "list", "data": datos, "model": peticion.get("model"),
+                                       "usage": {"prompt_tokens": 8 * len(entradas), "total_tokens": 8 * len(entradas)}})
+                if url.path != "/v1/chat/completions":
+                    return self._json({"error": {"message": "ruta desconocida"}}, 404)
+                falso.peticiones["openai"] += 1
+                tokens_entrada = sum(len(str(m.get("content", ""))) for m in peticion.get("messages", [])) // 4
+                max_tokens = peticion.get("max_tokens") or lat.tokens_respuesta
+                tokens_salida = min(lat.tokens_respuesta, max_tokens)
+                texto = respuesta_html(tokens_salida)
+                fin = "length" if tokens_salida >= max_tokens else "stop"
+                uso = {"prompt_tokens": tokens_entrada, "completion_tokens": tokens_salida, "total_tokens": tokens_entrada + tokens_salida}
+                base = {"id": "chatcmpl-bench", "created": int(time.time()), "model": peticion.get("model", "bench")}
+                time.sleep(lat.openai)
+                if not peticion.get("stream"):
+                    return self._json({**base, "object": "chat.completion", "usage": uso, "choices": [
+                        {"index": 0, "message": {"role": "assistant", "content": texto}, "finish_reason": fin}]})
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+
+                def evento(datos):
+                    linea = f"data: {json.dumps(datos) if isinstance(datos, dict) else datos}\n\n".encode("utf-8")
+                    self.wfile.write(f"{len(linea):x}\r\n".encode() + linea + b"\r\n")
+                    self.wfile.flush()
+
+                n = max(1, lat.openai_chunks)
+                tam = max(1, len(texto) // n)
+                for i in range(0, len(texto), tam):
+                    evento({**base, "object": "chat.completion.chunk", "choices": [
+                        {"index": 0, "delta": {"content": texto[i:i + tam]}, "finish_reason": None}]})
+                    time.sleep(lat.openai / n)
+                evento({**base, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {}, "finish_reason": fin}]})
+                if (peticion.get("stream_options") or {}).get("include_usage"):
+                    evento({**base, "object": "chat.completion.chunk", "choices": [], "usage": uso})
+                evento("[DONE]")
+                self.wfile.write(b"0\r\n\r\n")
+
+        return Handler
+
+
+def instalar_bd_falsa(main, latencia: float, documentos: dict):
+    """Sustituye en main las funciones que tocan PostgreSQL por esperas de `latencia` segundos por consulta."""
+    def esperar(*_args, **_kwargs):
+        time.sleep(latencia)
+
+    def leer_info_documento(doc_id, user_id, tenant_id):
+        esperar()
+        if doc_id not in documentos:
+            return None
+        return {"original_filename": documentos[doc_id][0], "file_type": "", "stored_path": "", "procesado": False}
+
+    def reutilizar_documento_duplicado(*args):
+        esperar()
+        return None
+
+    def guardar_documento_procesado(doc_id, user_id, tenant_id, texto, sha256, extractor, chunks, embeddings):
+        esperar()
+        return 1, len(chunks)
+
+    def obtener_memoria_usuario(user_id, tenant_id):
+        esperar()
+        return "Prefiero respuestas breves con tablas."
+
+    def obtener_version_documentos(user_id, tenant_id):
+        esperar()
+        return "bench"
+
+    def construir_contexto_rag(mensaje_usuario, user_id, tenant_id, empaquetador, vector_consulta=None, version_docs=None):
+        esperar()  # FTS
+        return empaquetador.reservar("### Contexto de documentos ###\n" + FRASE * 60)
+
+    main.DB_CONFIGURED = True
+    main.db_pool.abrir = lambda: None
+    main.db_pool.cerrar = lambda: None
+    main.comprobar_esquema_rag = lambda: []
+    main.leer_info_documento = leer_info_documento
+    main.reutilizar_documento_duplicado = reutilizar_documento_duplicado
+    main.guardar_documento_procesado = guardar_documento_procesado
+    main.obtener_memoria_usuario = obtener_memoria_usuario
+    main.obtener_version_documentos = obtener_version_documentos
+    main.construir_contexto_rag = construir_contexto_rag
+    main.insertar_historial = esperar
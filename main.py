@@ -1,44 +1,104 @@
 # --- INICIO main.py v2.4.3-mt (Revisado para integración con nuevo flujo de registro en PHP) ---
 from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Query, Path
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel, Field
-from openai import OpenAI, APIError
+from contextlib import asynccontextmanager, contextmanager
+import time
+import sys
+_inicio_import = time.perf_counter()  # Coste propio del módulo (sin FastAPI/pydantic): ver estado_arranque
+_modulos_previos = set(sys.modules)
 import os
 import shutil
-import requests
 import base64
 import logging
+import json
 import psycopg2  # Driver PostgreSQL
 import psycopg2.extras  # Para DictCursor
+import psycopg2.pool  # Pool de conexiones
+import threading
+import uuid
+import unicodedata
+import zlib
+from collections import OrderedDict, deque
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import tempfile
+import io
+import csv
+import codecs
+import itertools
 import re
-import chardet  # Para extraer_texto_simple
 import hashlib
-import httpx  # Para llamadas async a Google Places API
-from PyPDF2 import PdfReader, errors as pdf_errors
-from docx import Document
-from docx.opc.exceptions import PackageNotFoundError
+import random
+import email.utils
+import math
+import importlib.util
+import bisect
+# Dependencias pesadas (openai, PyPDF2, python-docx, chardet, bs4, Pillow, numpy, httpx) se importan en el primer uso:
+# arranque en frío más rápido, también en cada proceso del pool de extracción (spawn reimporta main)
+BS4_AVAILABLE = importlib.util.find_spec("bs4") is not None
+PIL_AVAILABLE = importlib.util.find_spec("PIL") is not None
 try:
-    from bs4 import BeautifulSoup
-    BS4_AVAILABLE = True
+    import tiktoken  # Tokenizador BPE; sin el fichero de la codificación en caché se usa la estimación local
+    TIKTOKEN_AVAILABLE = True
 except ImportError:
-    BS4_AVAILABLE = False
+    TIKTOKEN_AVAILABLE = False
 from html import escape as htmlspecialchars
-import time  # Para reintentos con espera
+
+# Módulo que se importa al acceder al primer atributo (las anotaciones que lo usan van entre comillas)
+class ModuloDiferido:
+    def __init__(self, nombre: str):
+        self._nombre = nombre
+        self._modulo = None
+
+    def __getattr__(self, atributo):
+        if self._modulo is None:
+            self._modulo = importlib.import_module(self._nombre)
+        return getattr(self._modulo, atributo)
+
+np = ModuloDiferido("numpy")  # Índice vectorial y embedder
+httpx = ModuloDiferido("httpx")  # Google Search/Places y PHP Bridge
 
 # Configuración del Logging
 logging.basicConfig(
-    level=logging.INFO,  # Cambiar a DEBUG para más detalle
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),  # DEBUG para más detalle
     format='%(asctime)s - %(name)s - %(levelname)s - [%(funcName)s:%(lineno)d] - %(message)s',
     handlers=[logging.StreamHandler()]
 )
 logger = logging.getLogger(__name__)
 
+# Ciclo de vida: recursos compartidos que se abren al arrancar y se cierran al parar
+@asynccontextmanager
+async def lifespan(app_: FastAPI):
+    await asyncio.to_thread(contador_tokens.verificar, TOKENIZER_FALLBACK)
+    if DB_CONFIGURED:
+        db_pool.abrir()
+        await asyncio.to_thread(comprobar_esquema_rag)
+    extraction_pool.abrir()
+    await cola_ingesta.iniciar()
+    await buffer_historial.iniciar()
+    calentamiento = asyncio.create_task(calentar()) if WARMUP_ON_STARTUP else None
+    yield
+    if calentamiento and not calentamiento.done():
+        calentamiento.cancel()
+    await cola_ingesta.detener()
+    await buffer_historial.detener(HISTORIAL_DRAIN_TIMEOUT)
+    await motor_busqueda.cerrar()
+    await cliente_places.cerrar()
+    await cliente_php.cerrar()
+    extraction_pool.cerrar()
+    db_pool.cerrar()
+
 # Configuración de la aplicación FastAPI
 app = FastAPI(
     title="Asistente IA UBIKUA API v2.4.3-mt (Revisado para nuevo flujo de registro)",
     version="2.4.3-mt",
-    description="API para el Asistente IA UBIKUA con funcionalidades multi-tenant, RAG y obtención de detalles de dirección."
+    description="API para el Asistente IA UBIKUA con funcionalidades multi-tenant, RAG y obtención de detalles de dirección.",
+    lifespan=lifespan
 )
 
 app.add_middleware(
@@ -56,17 +116,55 @@ MAPS_CONFIGURED = False
 DB_CONFIGURED = False
 PHP_BRIDGE_CONFIGURED = False
 
+def _env_int(nombre: str, por_defecto: int) -> int:
+    valor = os.getenv(nombre, str(por_defecto)).strip()
+    if valor.isdigit():
+        return int(valor)
+    logger.warning(f"{nombre} ('{valor}') no es un número válido. Usando {por_defecto}.")
+    return por_defecto
+
+def _env_float(nombre: str, por_defecto: float) -> float:
+    valor = os.getenv(nombre, str(por_defecto)).strip()
+    try:
+        return float(valor)
+    except ValueError:
+        logger.warning(f"{nombre} ('{valor}') no es un número válido. Usando {por_defecto}.")
+        return por_defecto
+
+# El SDK de OpenAI tarda ~0,3 s en importarse: se importa y se crea el cliente en el primer uso
+class ClienteOpenAIDiferido:
+    def __init__(self, api_key: str):
+        self._api_key = api_key
+        self._cliente = None
+        self._lock = threading.Lock()
+
+    def obtener(self):
+        if self._cliente is None:
+            with self._lock:
+                if self._cliente is None:
+                    from openai import AsyncOpenAI
+                    # Reintentos y timeout los gestiona llamar_openai()
+                    self._cliente = AsyncOpenAI(api_key=self._api_key, max_retries=0)
+                    logger.info("Cliente OpenAI (async) OK.")
+        return self._cliente
+
+    def __getattr__(self, nombre):
+        return getattr(self.obtener(), nombre)
+
+class _SinErrorOpenAI(Exception):
+    pass
+
+# Para los except: si openai no se ha importado todavía, ninguna excepción puede venir de él
+def error_api_openai() -> type:
+    modulo = sys.modules.get("openai")
+    return modulo.APIError if modulo is not None else _SinErrorOpenAI
+
 try:
     openai_api_key = os.getenv("OPENAI_API_KEY")
     if not openai_api_key:
          logger.warning("Var OPENAI_API_KEY no encontrada. Funcionalidad IA limitada.")
     else:
-        try:
-            client = OpenAI(api_key=openai_api_key)
-            logger.info("Cliente OpenAI OK.")
-        except Exception as openai_err:
-            logger.error(f"Error inicializando cliente OpenAI: {openai_err}")
-            client = None
+        client = ClienteOpenAIDiferido(openai_api_key)
 
     GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
     GOOGLE_CX = os.getenv("GOOGLE_CX")
@@ -139,6 +237,32 @@ class ProcessResponse(BaseModel):
     success: bool
     message: str | None = None
     error: str | None = None
+    job_id: str | None = Field(None, description="ID del trabajo en la cola de ingesta")
+    status: str | None = Field(None, description="queued | running | done | failed")
+    reused_from: int | None = Field(None, description="ID del documento idéntico del que se reutilizó el contenido")
+
+class ProcessBatchRequest(BaseModel):
+    doc_ids: list[int] = Field(..., min_length=1, description="IDs de documentos en la BD")
+    user_id: int = Field(..., description="ID del usuario propietario")
+    tenant_id: int | None = Field(None, description="ID del tenant/empresa propietario")
+
+class ProcessBatchResponse(BaseModel):
+    success: bool
+    jobs: list[ProcessResponse] = []
+    error: str | None = None
+
+class IngestJobStatus(BaseModel):
+    job_id: str
+    doc_id: int
+    user_id: int
+    tenant_id: int
+    status: str = Field(..., description="queued | running | done | failed")
+    message: str | None = None
+    error: str | None = None
+    reused_from: int | None = None
+    created_at: float
+    started_at: float | None = None
+    finished_at: float | None = None
 
 class PlaceDetailsResponse(BaseModel):
     success: bool
@@ -171,6 +295,12 @@ BASE_PROMPT_ANALISIS_DOC = (
     "Asegúrate de que la salida final sea un documento que se pueda copiar y pegar en Word o Google Docs sin perder el formato."
     "Por favor, responde solo con HTML sin ningún comentario de código o markdown adicional."
 )
+# Fase map del análisis por secciones: resúmenes intermedios que luego se combinan en el informe HTML
+PROMPT_RESUMEN_SECCION = (
+    "Eres un analista experto. Recibes una sección de un documento más largo. Resume su contenido de forma fiel y densa, "
+    "en texto plano con viñetas, conservando cifras, importes, fechas, plazos, nombres, obligaciones y conclusiones. "
+    "No inventes nada ni añadas introducción ni despedida; no uses HTML ni markdown de código."
+)
 PROMPT_ESPECIALIZACIONES = {
     "general": "Ofrece una respuesta amplia, comprensiva y detallada, abarcando todos los puntos relevantes de la consulta.",
     "legal": "Adopta un enfoque riguroso y formal, utilizando terminología jurídica adecuada y estructurando la respuesta de forma clara y precisa.",
@@ -190,51 +320,609 @@ try:
     logger.info(f"Directorio temporal verificado/creado: {TEMP_DIR}")
 except OSError as e:
     logger.error(f"No se pudo crear el directorio temporal {TEMP_DIR}: {e}.")
+UPLOAD_SPOOL_MAX_BYTES = _env_int("UPLOAD_SPOOL_MAX_BYTES", 16 * 1024 * 1024)  # Por encima, el archivo se vuelca a TEMP_DIR
+
+# --- Métricas (formato de texto Prometheus en /metrics) ---
+# Registro mínimo propio (contadores e histogramas con etiquetas). Se actualiza desde el event loop
+# y desde hilos (to_thread), de ahí el lock.
+METRICAS_PREFIJO = "ubikua"
+METRICAS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+def _escapar_etiqueta(valor) -> str:
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class RegistroMetricas:
+    def __init__(self, prefijo: str, buckets: tuple):
+        self.prefijo = prefijo
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._definiciones = {}  # nombre -> (tipo, ayuda)
+        self._series = {}  # nombre -> {etiquetas: valor (counter/gauge) | [cuentas por bucket, suma, total] (histogram)}
+
+    def definir(self, nombre: str, tipo: str, ayuda: str):
+        self._definiciones[nombre] = (tipo, ayuda)
+        self._series.setdefault(nombre, {})
+
+    def incrementar(self, nombre: str, valor: float = 1, **etiquetas):
+        clave = tuple(sorted(etiquetas.items()))
+        with self._lock:
+            serie = self._series[nombre]
+            serie[clave] = serie.get(clave, 0) + valor
+
+    def fijar(self, nombre: str, valor: float, **etiquetas):
+        clave = tuple(sorted(etiquetas.items()))
+        with self._lock:
+            self._series[nombre][clave] = valor
+
+    def observar(self, nombre: str, valor: float, **etiquetas):
+        clave = tuple(sorted(etiquetas.items()))
+        i = bisect.bisect_left(self.buckets, valor)
+        with self._lock:
+            serie = self._series[nombre]
+            histograma = serie.get(clave)
+            if histograma is None:
+                histograma = serie[clave] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histograma[0][i] += 1
+            histograma[1] += valor
+            histograma[2] += 1
+
+    # with metricas.medir("etapa"): ...  (también alrededor de awaits)
+    @contextmanager
+    def medir(self, etapa: str):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar("stage_duration_seconds", time.perf_counter() - inicio, stage=etapa)
+
+    def exportar(self) -> str:
+        lineas = []
+        with self._lock:
+            for nombre, (tipo, ayuda) in self._definiciones.items():
+                completo = f"{self.prefijo}_{nombre}"
+                lineas.append(f"# HELP {completo} {ayuda}")
+                lineas.append(f"# TYPE {completo} {tipo}")
+                for clave, valor in self._series[nombre].items():
+                    etiquetas = ",".join(f'{k}="{_escapar_etiqueta(v)}"' for k, v in clave)
+                    if tipo in ("counter", "gauge"):
+                        lineas.append(f"{completo}{{{etiquetas}}} {valor}" if etiquetas else f"{completo} {valor}")
+                        continue
+                    cuentas, suma, total = valor
+                    acumulado = 0
+                    for limite, cuenta in zip(self.buckets + (float("inf"),), cuentas):
+                        acumulado += cuenta
+                        le = "+Inf" if limite == float("inf") else repr(limite)
+                        lineas.append(f'{completo}_bucket{{{etiquetas + "," if etiquetas else ""}le="{le}"}} {acumulado}')
+                    sufijo = f"{{{etiquetas}}}" if etiquetas else ""
+                    lineas.append(f"{completo}_sum{sufijo} {suma}")
+                    lineas.append(f"{completo}_count{sufijo} {total}")
+        return "\n".join(lineas) + "\n"
+
+metricas = RegistroMetricas(METRICAS_PREFIJO, METRICAS_BUCKETS)
+metricas.definir("http_request_duration_seconds", "histogram", "Duración de las peticiones HTTP por endpoint (hasta el último byte, incluido SSE).")
+metricas.definir("stage_duration_seconds", "histogram", "Duración de cada etapa del pipeline (memoria, RAG, OpenAI, web, historial, ingesta...).")
+metricas.definir("openai_truncated_total", "counter", "Respuestas de OpenAI con finish_reason == 'length'.")
+metricas.definir("openai_tokens_total", "counter", "Tokens según el campo usage de OpenAI (direction=input|output).")
+metricas.definir("extraction_failures_total", "counter", "Extracciones de texto fallidas por tipo de archivo y motivo.")
+metricas.definir("php_bridge_bytes_total", "counter", "Bytes descargados del PHP Bridge.")
+
+def registrar_uso_openai(usage, operacion: str):
+    if usage is None:
+        return
+    metricas.incrementar("openai_tokens_total", getattr(usage, "prompt_tokens", 0) or 0, operation=operacion, direction="input")
+    metricas.incrementar("openai_tokens_total", getattr(usage, "completion_tokens", 0) or 0, operation=operacion, direction="output")
+
+# Middleware ASGI (no BaseHTTPMiddleware) para medir hasta el final del cuerpo en respuestas en streaming
+class MiddlewareMetricas:
+    def __init__(self, app_):
+        self.app = app_
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        inicio = time.perf_counter()
+        estado = {"status": 500}
+
+        async def enviar(mensaje):
+            if mensaje["type"] == "http.response.start":
+                estado["status"] = mensaje["status"]
+            await send(mensaje)
+
+        try:
+            await self.app(scope, receive, enviar)
+        finally:
+            # Plantilla de la ruta (/process-document/jobs/{job_id}) para no disparar la cardinalidad
+            ruta = getattr(scope.get("route"), "path", "sin_ruta")
+            metricas.observar("http_request_duration_seconds", time.perf_counter() - inicio, method=scope["method"], path=ruta, status=estado["status"])
+
+app.add_middleware(MiddlewareMetricas)
+
+# --- Resiliencia de upstreams (OpenAI, Google Search, Google Places, PHP Bridge) ---
+# Error transitorio (timeout, conexión, 408/429/5xx): se reintenta con backoff exponencial y jitter completo,
+# respetando Retry-After, y cuenta como fallo del interruptor del upstream. Con BREAKER_FAILURES fallos seguidos
+# el interruptor se abre y las llamadas fallan al instante (503 + Retry-After) durante BREAKER_OPEN_SECONDS;
+# después deja pasar una única llamada de prueba (half_open) y se cierra si sale bien.
+# Errores definitivos (4xx, respuesta inválida del cliente) no se reintentan ni abren el interruptor.
+RETRY_BASE_DELAY = _env_float("RETRY_BASE_DELAY", 0.5)
+RETRY_MAX_DELAY = _env_float("RETRY_MAX_DELAY", 8.0)
+RETRY_AFTER_MAX = _env_float("RETRY_AFTER_MAX", 30.0)  # Con un Retry-After mayor no se reintenta: se devuelve el error
+BREAKER_FAILURES = max(1, _env_int("BREAKER_FAILURES", 5))
+BREAKER_OPEN_SECONDS = _env_float("BREAKER_OPEN_SECONDS", 30.0)
+ESTADOS_INTERRUPTOR = {"closed": 0, "half_open": 1, "open": 2}
+
+class CircuitoAbierto(HTTPException):
+    def __init__(self, upstream: str, retry_after: float):
+        segundos = max(1, math.ceil(retry_after))
+        super().__init__(503, f"Servicio {upstream} no disponible temporalmente. Inténtalo en {segundos}s.", headers={"Retry-After": str(segundos)})
+        self.upstream = upstream
+        self.retry_after = segundos
+
+# Error reintentable detectado en el cuerpo de una respuesta correcta (p.ej. UNKNOWN_ERROR de Places)
+class ErrorTransitorio(Exception):
+    pass
+
+def _estado_http_transitorio(status: int) -> bool:
+    return status in (408, 429) or status >= 500
+
+# httpx y openai se importan en diferido: si no están cargados, el error no puede venir de ellos
+def es_error_transitorio(error: Exception) -> bool:
+    if isinstance(error, (ErrorTransitorio, asyncio.TimeoutError)):
+        return True
+    modulo_httpx = sys.modules.get("httpx")
+    if modulo_httpx is not None:
+        if isinstance(error, modulo_httpx.TransportError):
+            return True
+        if isinstance(error, modulo_httpx.HTTPStatusError):
+            return _estado_http_transitorio(error.response.status_code)
+    modulo = sys.modules.get("openai")
+    if modulo is not None:
+        if isinstance(error, modulo.APIConnectionError):  # Incluye APITimeoutError
+            return True
+        if isinstance(error, modulo.APIStatusError):
+            return _estado_http_transitorio(error.status_code)
+    return False
+
+# Retry-After (segundos o fecha HTTP) o retry-after-ms (OpenAI) de la respuesta asociada al error, si la hay
+def segundos_retry_after(error: Exception) -> float | None:
+    cabeceras = getattr(getattr(error, "response", None), "headers", None)
+    if cabeceras is None:
+        return None
+    try:
+        if cabeceras.get("retry-after-ms"):
+            return max(0.0, float(cabeceras["retry-after-ms"]) / 1000)
+        valor = cabeceras.get("retry-after")
+        if not valor:
+            return None
+        if valor.strip().replace(".", "", 1).isdigit():
+            return float(valor)
+        return max(0.0, email.utils.parsedate_to_datetime(valor).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+# Sin la URL: en Places y Search lleva la API key en la query
+def describir_error(error: Exception) -> str:
+    modulo_httpx = sys.modules.get("httpx")
+    if modulo_httpx is not None and isinstance(error, modulo_httpx.HTTPStatusError):
+        return f"HTTPStatusError: HTTP {error.response.status_code}"
+    return f"{type(error).__name__}: {error}"
+
+# Backoff exponencial con jitter completo: uniforme en [0, min(máx, base * 2^intento)]
+def calcular_espera(intento: int, retry_after: float | None = None) -> float:
+    espera = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** intento))
+    return max(espera, retry_after) if retry_after is not None else espera
+
+class Interruptor:
+    def __init__(self, nombre: str, fallos_max: int, segundos_abierto: float):
+        self.nombre = nombre
+        self.fallos_max = fallos_max
+        self.segundos_abierto = segundos_abierto
+        self.estado = "closed"
+        self._fallos = 0  # Consecutivos
+        self._abierto_desde = 0.0
+        self._sonda = False  # Llamada de prueba en curso (half_open)
+        self._ultimo_error = None
+        self._cambio = time.time()
+        self._stats = {"calls": 0, "failures": 0, "rejected": 0, "retries": 0, "opened": 0, "hedged": 0, "hedge_wins": 0}
+        metricas.fijar("circuit_breaker_state", 0, upstream=nombre)
+
+    def _cambiar(self, estado: str):
+        logger.warning(f"Interruptor {self.nombre}: {self.estado} -> {estado}.")
+        self.estado = estado
+        self._cambio = time.time()
+        metricas.fijar("circuit_breaker_state", ESTADOS_INTERRUPTOR[estado], upstream=self.nombre)
+
+    def _restante(self) -> float:
+        return max(0.0, self._abierto_desde + self.segundos_abierto - time.monotonic())
+
+    def _rechazar(self, retry_after: float):
+        self._stats["rejected"] += 1
+        metricas.incrementar("circuit_breaker_rejected_total", upstream=self.nombre)
+        raise CircuitoAbierto(self.nombre, retry_after)
+
+    def permitir(self):
+        if self.estado == "open":
+            if self._restante() > 0:
+                self._rechazar(self._restante())
+            self._cambiar("half_open")
+        if self.estado == "half_open":
+            if self._sonda:
+                self._rechazar(1.0)
+            self._sonda = True
+        self._stats["calls"] += 1
+
+    def exito(self):
+        self._fallos = 0
+        self._sonda = False
+        if self.estado != "closed":
+            self._cambiar("closed")
+
+    def fallo(self, error: Exception):
+        self._stats["failures"] += 1
+        self._fallos += 1
+        self._sonda = False
+        self._ultimo_error = describir_error(error)[:300]
+        if self.estado == "half_open" or (self.estado == "closed" and self._fallos >= self.fallos_max):
+            self._stats["opened"] += 1
+            self._abierto_desde = time.monotonic()
+            self._cambiar("open")
+
+    # Llamada cancelada (cliente desconectado, cobertura descartada): no cuenta, pero libera la prueba
+    def descartar(self):
+        self._sonda = False
+
+    def contar(self, clave: str):
+        self._stats[clave] += 1
+
+    def estadisticas(self) -> dict:
+        return {
+            "state": self.estado, "consecutive_failures": self._fallos, "failure_threshold": self.fallos_max, "open_seconds": self.segundos_abierto,
+            "retry_in_s": round(self._restante(), 1) if self.estado == "open" else 0, "last_change": self._cambio, "last_error": self._ultimo_error, **self._stats
+        }
+
+# Petición cubierta (hedging), solo para lecturas idempotentes: si la primera no ha terminado en `retraso` s
+# se lanza una segunda igual y gana la primera que responda bien; la otra se cancela
+async def _con_cobertura(interruptor: Interruptor, llamada, retraso: float):
+    tareas = [asyncio.create_task(llamada())]
+    try:
+        hechas, _ = await asyncio.wait(tareas, timeout=retraso)
+        if not hechas:
+            interruptor.contar("hedged")
+            tareas.append(asyncio.create_task(llamada()))
+        pendientes = set(tareas)
+        error = None
+        while pendientes:
+            hechas, pendientes = await asyncio.wait(pendientes, return_when=asyncio.FIRST_COMPLETED)
+            for tarea in hechas:
+                if tarea.exception() is None:
+                    if tarea is not tareas[0]:
+                        interruptor.contar("hedge_wins")
+                    return tarea.result()
+                error = error or tarea.exception()
+        raise error
+    finally:
+        for tarea in tareas:
+            if not tarea.done():
+                tarea.cancel()
+            elif not tarea.cancelled():
+                tarea.exception()  # Recuperada aunque haya ganado la otra
+
+# `llamada` es una función sin argumentos que devuelve un awaitable nuevo en cada intento
+async def con_reintentos(interruptor: Interruptor, llamada, etiqueta: str, operacion: str, intentos: int, cobertura: float = 0.0):
+    for intento in range(intentos):
+        interruptor.permitir()
+        try:
+            resultado = await (_con_cobertura(interruptor, llamada, cobertura) if cobertura > 0 else llamada())
+        except asyncio.CancelledError:
+            interruptor.descartar()
+            raise
+        except Exception as e:
+            transitorio = es_error_transitorio(e)
+            if transitorio:
+                interruptor.fallo(e)
+            else:
+                interruptor.descartar()  # Error definitivo (4xx): ni fallo ni éxito; en half_open no cierra el interruptor
+            espera = calcular_espera(intento, segundos_retry_after(e))
+            if not transitorio or intento == intentos - 1 or interruptor.estado == "open" or espera > RETRY_AFTER_MAX:
+                logger.error(f"Error {etiqueta} (Intento {intento + 1}/{intentos}): {describir_error(e)}")
+                raise
+            logger.warning(f"Error {etiqueta} (Intento {intento + 1}/{intentos}): {describir_error(e)}. Reintento en {espera:.2f}s.")
+            interruptor.contar("retries")
+            metricas.incrementar("upstream_retries_total", upstream=interruptor.nombre, operation=operacion)
+            await asyncio.sleep(espera)
+        else:
+            interruptor.exito()
+            return resultado
+
+metricas.definir("upstream_retries_total", "counter", "Reintentos de llamadas a upstreams (openai, google_search, google_places, php_bridge) por operación.")
+metricas.definir("circuit_breaker_state", "gauge", "Estado del interruptor por upstream (0 closed, 1 half_open, 2 open).")
+metricas.definir("circuit_breaker_rejected_total", "counter", "Llamadas rechazadas al instante con el interruptor abierto.")
+interruptor_openai = Interruptor("openai", BREAKER_FAILURES, BREAKER_OPEN_SECONDS)
+interruptor_busqueda = Interruptor("google_search", BREAKER_FAILURES, BREAKER_OPEN_SECONDS)
+interruptor_places = Interruptor("google_places", BREAKER_FAILURES, BREAKER_OPEN_SECONDS)
+interruptor_php = Interruptor("php_bridge", BREAKER_FAILURES, BREAKER_OPEN_SECONDS)
+interruptores = (interruptor_openai, interruptor_busqueda, interruptor_places, interruptor_php)
+
+# Archivo recibido (subida o PHP Bridge): en memoria hasta el umbral y volcado a un temporal con nombre por encima,
+# para que el pool de procesos pueda abrirlo. Calcula el SHA-256 al escribir. El temporal se borra al cerrar.
+class BufferArchivo:
+    def __init__(self, sufijo: str = "", umbral: int = UPLOAD_SPOOL_MAX_BYTES):
+        self.sufijo = sufijo
+        self.umbral = umbral
+        self.tamaño = 0
+        self._memoria = io.BytesIO()
+        self._disco = None
+        self._hasher = hashlib.sha256()
+
+    def write(self, datos: bytes):
+        self._hasher.update(datos)
+        self.tamaño += len(datos)
+        if self._disco is None and self.tamaño > self.umbral:
+            self._disco = tempfile.NamedTemporaryFile(mode='wb', suffix=self.sufijo, dir=TEMP_DIR, delete=True)
+            self._disco.write(self._memoria.getbuffer())
+            self._memoria = None
+            logger.info(f"Archivo de más de {self.umbral} bytes: volcado a {self._disco.name}")
+        (self._disco or self._memoria).write(datos)
+
+    @property
+    def en_disco(self) -> bool:
+        return self._disco is not None
+
+    @property
+    def sha256(self) -> str:
+        return self._hasher.hexdigest()
+
+    # bytes si está en memoria, ruta si se volcó a disco (lo que aceptan las funciones de extracción)
+    def origen(self) -> bytes | str:
+        if self._disco is None:
+            return self._memoria.getvalue()
+        self._disco.flush()
+        return self._disco.name
+
+    def close(self):
+        if self._disco is not None:
+            self._disco.close()
+            self._disco = None
+        self._memoria = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# --- Pool de conexiones PostgreSQL ---
+DB_POOL_MIN = _env_int("DB_POOL_MIN", 1)
+DB_POOL_MAX = max(_env_int("DB_POOL_MAX", 10), DB_POOL_MIN, 1)
+DB_POOL_TIMEOUT = _env_float("DB_POOL_TIMEOUT", 10.0)  # Espera máx. (s) por una conexión libre
+DB_POOL_CHECK_IDLE = _env_float("DB_POOL_CHECK_IDLE", 30.0)  # Ping a conexiones inactivas más de N s
+
+class PoolConexionesBD:
+    def __init__(self, minconn: int, maxconn: int, wait_timeout: float, check_idle: float):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.wait_timeout = wait_timeout
+        self.check_idle = check_idle
+        self._pool = None
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._ultimo_uso = {}  # id(conn) -> monotonic de la última devolución
+        self._en_uso = 0
+        # Recuento propio (sin tocar los internos de psycopg2): conexiones ya vistas y las minconn iniciales aún no entregadas
+        self._conocidas = set()
+        self._iniciales = 0
+        self._stats = {"checkouts": 0, "timeouts": 0, "health_check_failures": 0, "connect_errors": 0, "max_in_use": 0, "opened": 0, "closed": 0}
+
+    def abrir(self) -> bool:
+        with self._lock:
+            if self._pool is not None:
+                return True
+            try:
+                self._pool = psycopg2.pool.ThreadedConnectionPool(
+                    self.minconn, self.maxconn,
+                    host=DB_HOST, database=DB_NAME, user=DB_USER,
+                    password=DB_PASS, port=DB_PORT, connect_timeout=5
+                )
+                self._iniciales = self.minconn
+                self._stats["opened"] += self.minconn
+                logger.info(f"Pool BD abierto (min={self.minconn}, max={self.maxconn}).")
+                return True
+            except psycopg2.OperationalError as op_err:
+                self._stats["connect_errors"] += 1
+                logger.error(f"Error operacional al abrir pool PostgreSQL: {op_err}", exc_info=False)
+            except Exception as error:
+                self._stats["connect_errors"] += 1
+                logger.error(f"Error inesperado al abrir pool PostgreSQL: {error}", exc_info=True)
+            return False
+
+    def cerrar(self):
+        with self._lock:
+            if self._pool is None:
+                return
+            try:
+                self._pool.closeall()
+                logger.info("Pool BD cerrado.")
+            except Exception as e:
+                logger.error(f"Error cerrando pool BD: {e}")
+            self._pool = None
+            self._ultimo_uso.clear()
+            self._stats["closed"] += len(self._conocidas) + self._iniciales
+            self._conocidas.clear()
+            self._iniciales = 0
+
+    def _conexion_sana(self, conn) -> bool:
+        if conn.closed:
+            return False
+        ultimo = self._ultimo_uso.get(id(conn))
+        if ultimo is not None and time.monotonic() - ultimo < self.check_idle:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def obtener(self):
+        if self._pool is None and not self.abrir():
+            return None
+        if not self._slots.acquire(timeout=self.wait_timeout):
+            self._stats["timeouts"] += 1
+            logger.error(f"Pool BD agotado: sin conexión libre tras {self.wait_timeout}s.")
+            return None
+        try:
+            for _ in range(self.maxconn + 1):
+                conn = self._pool.getconn()
+                self._registrar(conn)
+                if self._conexion_sana(conn):
+                    with self._lock:
+                        self._en_uso += 1
+                        self._stats["checkouts"] += 1
+                        self._stats["max_in_use"] = max(self._stats["max_in_use"], self._en_uso)
+                    return conn
+                self._stats["health_check_failures"] += 1
+                logger.warning("Conexión BD del pool no responde. Descartando.")
+                self._ultimo_uso.pop(id(conn), None)
+                self._pool.putconn(conn, close=True)
+                self._olvidar(conn)
+        except psycopg2.OperationalError as op_err:
+            self._stats["connect_errors"] += 1
+            logger.error(f"Error operacional al conectar con PostgreSQL: {op_err}", exc_info=False)
+        except Exception as error:
+            self._stats["connect_errors"] += 1
+            logger.error(f"Error inesperado al obtener conexión del pool: {error}", exc_info=True)
+        self._slots.release()
+        return None
+
+    def liberar(self, conn):
+        if conn is None:
+            return
+        try:
+            if self._pool is None:
+                conn.close()
+                return
+            descartar = bool(conn.closed)
+            if not descartar and conn.status != psycopg2.extensions.STATUS_READY:
+                try:
+                    conn.rollback()
+                except Exception:
+                    descartar = True
+            if descartar:
+                self._ultimo_uso.pop(id(conn), None)
+            else:
+                self._ultimo_uso[id(conn)] = time.monotonic()
+            self._pool.putconn(conn, close=descartar)
+            if conn.closed:  # Descartada, o cerrada por psycopg2 al sobrar por encima de minconn libres
+                self._ultimo_uso.pop(id(conn), None)
+                self._olvidar(conn)
+        except Exception as e:
+            logger.error(f"Error devolviendo conexión al pool: {e}")
+        finally:
+            with self._lock:
+                self._en_uso = max(0, self._en_uso - 1)
+            self._slots.release()
+
+    def _registrar(self, conn):
+        with self._lock:
+            if id(conn) in self._conocidas:
+                return
+            self._conocidas.add(id(conn))
+            if self._iniciales > 0:
+                self._iniciales -= 1  # Una de las abiertas al crear el pool
+            else:
+                self._stats["opened"] += 1
+
+    def _olvidar(self, conn):
+        with self._lock:
+            if id(conn) in self._conocidas:
+                self._conocidas.discard(id(conn))
+                self._stats["closed"] += 1
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            abiertas = len(self._conocidas) + self._iniciales if self._pool is not None else 0
+            libres = max(0, abiertas - self._en_uso)
+            return {
+                "open": self._pool is not None, "min": self.minconn, "max": self.maxconn,
+                "connections": abiertas, "idle": libres, "in_use": self._en_uso, **self._stats
+            }
+
+db_pool = PoolConexionesBD(DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_CHECK_IDLE)
 
 def get_db_connection():
     if not DB_CONFIGURED:
         return None
+    return db_pool.obtener()
+
+def release_db_connection(conn):
+    db_pool.liberar(conn)
+
+MAX_TEXT_LENGTH = 15 * 1024 * 1024  # Máx. caracteres guardados en user_documents.extracted_text
+MAX_ANALYSIS_TOKENS = 100000
+
+# Las funciones de extracción reciben el contenido en memoria (bytes) o la ruta de un archivo en disco
+def _abrir_origen(origen: bytes | str):
+    return io.BytesIO(origen) if isinstance(origen, (bytes, bytearray)) else open(origen, 'rb')
+
+def _nombre_origen(origen: bytes | str) -> str:
+    return f"<memoria {len(origen)} bytes>" if isinstance(origen, (bytes, bytearray)) else os.path.basename(origen)
+
+# Generadores de texto por página/párrafo: permiten parar la extracción al llegar al tope sin construir el texto entero
+def iterar_paginas_pdf(origen: bytes | str):
+    filename_for_log = _nombre_origen(origen)
+    with _abrir_origen(origen) as archivo:
+        from PyPDF2 import PdfReader
+        lector = PdfReader(archivo, strict=False)
+        if lector.is_encrypted:
+            logger.warning(f"PDF '{filename_for_log}' encriptado.")
+        num_paginas = len(lector.pages)
+        logger.info(f"Procesando {num_paginas} páginas PDF.")
+        for i in range(num_paginas):
+            try:
+                texto_pagina = lector.pages[i].extract_text()
+                if texto_pagina:
+                    yield texto_pagina + "\n"
+            except Exception as page_error:
+                logger.warning(f"Error extraer pág {i+1} en {filename_for_log}: {page_error}")
+
+def iterar_parrafos_docx(origen: bytes | str):
+    with _abrir_origen(origen) as archivo:
+        from docx import Document
+        doc = Document(archivo)
+    for p in doc.paragraphs:
+        if p.text and p.text.strip():
+            yield p.text + "\n"
+
+def _consumir_hasta(segmentos, max_chars: int | None) -> str:
+    partes = []
+    total = 0
     try:
-        conn = psycopg2.connect(
-            host=DB_HOST, database=DB_NAME, user=DB_USER,
-            password=DB_PASS, port=DB_PORT, connect_timeout=5
-        )
-        return conn
-    except psycopg2.OperationalError as op_err:
-         logger.error(f"Error operacional al conectar con PostgreSQL: {op_err}", exc_info=False)
-         return None
-    except Exception as error:
-        logger.error(f"Error inesperado al conectar con PostgreSQL: {error}", exc_info=True)
-        return None
+        for segmento in segmentos:
+            partes.append(segmento)
+            total += len(segmento)
+            if max_chars and total >= max_chars:
+                logger.info(f"Tope de extracción alcanzado ({max_chars} chars). Parando.")
+                break
+    finally:
+        segmentos.close()
+    texto = "".join(partes)
+    return texto[:max_chars] if max_chars else texto
 
-def extraer_texto_pdf_docx(ruta_archivo: str, extension: str) -> str:
-    texto = ""
-    filename_for_log = os.path.basename(ruta_archivo)
+def extraer_texto_pdf_docx(origen: bytes | str, extension: str, max_chars: int | None = None) -> str:
+    filename_for_log = _nombre_origen(origen)
     logger.info(f"Extrayendo texto ({extension.upper()}) de: {filename_for_log}")
     try:
         if extension == "pdf":
-            with open(ruta_archivo, 'rb') as archivo:
-                try:
-                    lector = PdfReader(archivo, strict=False)
-                    if lector.is_encrypted:
-                        logger.warning(f"PDF '{filename_for_log}' encriptado.")
-                    num_paginas = len(lector.pages)
-                    logger.info(f"Procesando {num_paginas} páginas PDF.")
-                    for i, pagina in enumerate(lector.pages):
-                        try:
-                            texto_pagina = pagina.extract_text()
-                            if texto_pagina:
-                                texto += texto_pagina + "\n"
-                        except Exception as page_error:
-                            logger.warning(f"Error extraer pág {i+1} en {filename_for_log}: {page_error}")
-                except pdf_errors.PdfReadError as pdf_err:
-                    logger.error(f"Error PyPDF2 leer {filename_for_log}: {pdf_err}")
-                    return "[Error PDF: Dañado/No Soportado]"
+            from PyPDF2 import errors as pdf_errors
+            try:
+                texto = _consumir_hasta(iterar_paginas_pdf(origen), max_chars)
+            except pdf_errors.PdfReadError as pdf_err:
+                logger.error(f"Error PyPDF2 leer {filename_for_log}: {pdf_err}")
+                return "[Error PDF: Dañado/No Soportado]"
         elif extension in ["doc", "docx"]:
+             from docx.opc.exceptions import PackageNotFoundError
              try:
-                doc = Document(ruta_archivo)
-                parrafos = [p.text for p in doc.paragraphs if p.text and p.text.strip()]
-                texto = "\n".join(parrafos)
+                texto = _consumir_hasta(iterar_parrafos_docx(origen), max_chars)
              except PackageNotFoundError:
                  logger.error(f"Error DOCX '{filename_for_log}': No válido.")
                  return "[Error DOCX: Inválido]"
@@ -251,33 +939,86 @@ def extraer_texto_pdf_docx(ruta_archivo: str, extension: str) -> str:
         logger.info(f"Texto {extension.upper()} OK ({len(texto_limpio)} chars) de '{filename_for_log}'.")
         return texto_limpio
     except FileNotFoundError:
-        logger.error(f"FNF Sistema: '{filename_for_log}' en {ruta_archivo}.")
+        logger.error(f"FNF Sistema: '{filename_for_log}'.")
         return "[Error: Archivo no encontrado]"
     except Exception as e:
         logger.error(f"Error Gral extraer {extension.upper()} '{filename_for_log}': {e}", exc_info=True)
         return f"[Error interno {extension.upper()}]"
 
-def extraer_texto_simple(ruta_archivo: str) -> str:
-    filename_for_log = os.path.basename(ruta_archivo)
+ENCODING_SAMPLE_BYTES = _env_int("ENCODING_SAMPLE_BYTES", 64 * 1024)  # Muestra para detectar la codificación
+TEXT_READ_BLOCK = 1024 * 1024
+CSV_MODO = os.getenv("CSV_MODO", "registros").lower()  # registros ("columna: valor" por fila) | esquema (resumen + filas de muestra)
+CSV_MUESTRA_FILAS = _env_int("CSV_MUESTRA_FILAS", 20)
+CSV_FILAS_TIPADO = 1000  # El tipo de cada columna se infiere sobre las primeras filas
+CSV_DELIMITADORES = ",;\t|"
+
+def detectar_encoding(muestra: bytes, descartar: tuple = ()) -> str:
+    if muestra.startswith(codecs.BOM_UTF8) and "utf-8-sig" not in descartar:
+        return "utf-8-sig"
+    if "utf-8" not in descartar:
+        try:
+            codecs.getincrementaldecoder("utf-8")().decode(muestra)  # Sin final: tolera un carácter cortado al final
+            return "utf-8"
+        except UnicodeDecodeError:
+            pass
+    import chardet
+    deteccion = chardet.detect(muestra)
+    if deteccion.get("encoding") and deteccion.get("confidence", 0) > 0.6:
+        try:
+            encoding = codecs.lookup(deteccion["encoding"]).name
+            if encoding not in descartar:
+                return encoding
+        except LookupError:
+            pass
+    return "cp1252" if "cp1252" not in descartar else "latin-1"
+
+# Decodifica por bloques con la codificación detectada en una muestra inicial. Si un bloque posterior no encaja
+# se vuelve a detectar sobre ese bloque y se sigue con la nueva codificación (latin-1 nunca falla).
+def iterar_texto(origen: bytes | str):
+    filename_for_log = _nombre_origen(origen)
+    with _abrir_origen(origen) as archivo:
+        bloque = archivo.read(TEXT_READ_BLOCK)
+        encoding = detectar_encoding(bloque[:ENCODING_SAMPLE_BYTES])
+        logger.info(f"Encoding: {encoding} (muestra de {min(len(bloque), ENCODING_SAMPLE_BYTES)} bytes) para '{filename_for_log}'")
+        descartados = []
+        decoder = codecs.getincrementaldecoder(encoding)()
+        while bloque:
+            try:
+                texto = decoder.decode(bloque)
+            except UnicodeDecodeError as ude:
+                descartados.append(encoding)
+                encoding = detectar_encoding(bloque[:ENCODING_SAMPLE_BYTES], tuple(descartados))
+                logger.warning(f"Error decodif '{filename_for_log}' ({ude.reason}). Continuando con '{encoding}'.")
+                decoder = codecs.getincrementaldecoder(encoding)()
+                continue
+            if texto:
+                yield texto
+            bloque = archivo.read(TEXT_READ_BLOCK)
+        try:
+            texto = decoder.decode(b"", final=True)
+        except UnicodeDecodeError:
+            texto = ""  # Carácter incompleto al final del archivo
+        if texto:
+            yield texto
+
+def iterar_lineas(piezas):
+    pendiente = ""
+    for pieza in piezas:
+        pendiente += pieza
+        *lineas, pendiente = pendiente.split("\n")
+        for linea in lineas:
+            yield linea + "\n"
+    if pendiente:
+        yield pendiente
+
+def extraer_texto_simple(origen: bytes | str, max_chars: int | None = None) -> str:
+    filename_for_log = _nombre_origen(origen)
     logger.info(f"Extrayendo texto simple de: {filename_for_log}")
-    texto = ""
-    detected_encoding = 'utf-8'
     try:
-        with open(ruta_archivo, 'rb') as fb:
-            raw_data = fb.read()
-            if not raw_data:
-                logger.warning(f"Archivo vacío: {filename_for_log}")
-                return ""
-            detection = chardet.detect(raw_data)
-            confidence = detection.get('confidence', 0)
-            encoding = detection.get('encoding')
-            if encoding and confidence > 0.6:
-                detected_encoding = encoding
-                logger.info(f"Encoding: {detected_encoding} (Conf: {confidence:.2f}) para '{filename_for_log}'")
-            else:
-                logger.info(f"Encoding incierto ({detection}), usando '{detected_encoding}' para '{filename_for_log}'.")
-        with open(ruta_archivo, 'r', encoding=detected_encoding, errors='ignore') as f:
-            texto = f.read()
+        texto = _consumir_hasta(iterar_texto(origen), max_chars)
+        if not texto:
+            logger.warning(f"Archivo vacío: {filename_for_log}")
+            return ""
         texto_limpio = texto.strip()
         if not texto_limpio:
             logger.warning(f"Texto útil vacío tras strip: '{filename_for_log}' (simple)")
@@ -287,374 +1028,2372 @@ def extraer_texto_simple(ruta_archivo: str) -> str:
     except FileNotFoundError:
         logger.error(f"FNF: '{filename_for_log}' extracción simple.")
         return "[Error: Archivo no encontrado]"
-    except UnicodeDecodeError as ude:
-         logger.error(f"Error decodif '{filename_for_log}' con '{detected_encoding}': {ude}")
-         try:
-             logger.info(f"Reintento '{filename_for_log}' con ISO-8859-1...")
-             with open(ruta_archivo, 'r', encoding='iso-8859-1', errors='ignore') as f_fallback:
-                 texto = f_fallback.read()
-             texto_limpio = texto.strip()
-             if not texto_limpio:
-                 return "[Archivo sin texto extraíble]"
-             logger.info(f"Texto OK fallback ISO-8859-1 ({len(texto_limpio)} chars).")
-             return texto_limpio
-         except Exception as e_fallback:
-             logger.error(f"Fallo fallback '{filename_for_log}': {e_fallback}")
-             return "[Error Codificación]"
     except Exception as e:
         logger.error(f"Error inesperado texto simple '{filename_for_log}': {e}", exc_info=True)
         return "[Error interno texto plano]"
 
-def buscar_google(query: str) -> str:
-    if not SEARCH_CONFIGURED:
-        logger.warning("buscar_google sin config.")
-        return "<p><i>[Búsqueda web no config.]</i></p>"
-    url = "https://www.googleapis.com/customsearch/v1"
-    params = {"key": GOOGLE_API_KEY, "cx": GOOGLE_CX, "q": query, "num": 3, "lr": "lang_es"}
-    logger.info(f"Buscando Google Search: '{query}'")
+def detectar_dialecto_csv(muestra: str):
+    sniffer = csv.Sniffer()
     try:
-        response = requests.get(url, params=params, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        if "error" in data:
-            error_details = data["error"].get("message", "?")
-            logger.error(f"Error Google Search API: {error_details}")
-            return f"<p><i>[Error búsqueda: {htmlspecialchars(error_details)}]</i></p>"
-        resultados = data.get("items", [])
-        if not resultados:
-            logger.info("Búsqueda web sin resultados.")
-            return "<p><i>[No resultados web.]</i></p>"
-        texto_resultados = "<div class='google-results' style='margin-top:15px; padding-top:10px; border-top: 1px solid #eee;'><h4 style='font-size:0.9em;color:#555; margin-bottom: 5px;'>Resultados web relacionados:</h4><ul>"
-        for item in resultados:
-            title = item.get('title','?')
-            link = item.get('link','#')
-            snippet = item.get('snippet','')
-            if snippet:
-                snippet = re.sub('<.*?>', '', snippet).replace('\n',' ').strip()
-            else:
-                snippet = "No descripción."
-            texto_resultados += (f"<li style='margin-bottom: 10px; padding-left: 5px; border-left: 3px solid #ddd;'><a href='{link}' target='_blank' style='font-weight: bold; color: #1a0dab; text-decoration: none; display: block; margin-bottom: 2px;'>{htmlspecialchars(title)}</a><p style='font-size: 0.85em; margin: 0; color: #333;'>{htmlspecialchars(snippet)}</p><cite style='font-size: 0.8em; color: #006621; display: block; margin-top: 2px;'>{htmlspecialchars(link)}</cite></li>")
-        texto_resultados += "</ul></div>"
-        logger.info(f"Búsqueda web OK: {len(resultados)} resultados.")
-        return texto_resultados
-    except requests.exceptions.Timeout:
-        logger.error("Timeout búsqueda web.")
-        return "<p><i>[Error: Timeout búsqueda web.]</i></p>"
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error conexión búsqueda web: {e}")
-        return "<p><i>[Error conexión búsqueda web.]</i></p>"
-    except Exception as e:
-        logger.error(f"Error inesperado búsqueda web: {e}", exc_info=True)
-        return "<p><i>[Error inesperado búsqueda web.]</i></p>"
+        dialecto = sniffer.sniff(muestra, delimiters=CSV_DELIMITADORES)
+    except csv.Error:
+        # Sin patrón claro: el delimitador más frecuente en la primera línea
+        primera = muestra.split("\n", 1)[0]
+        dialecto = type("DialectoCSV", (csv.excel,), {"delimiter": max(CSV_DELIMITADORES, key=primera.count)})
+    try:
+        con_cabecera = sniffer.has_header(muestra)
+    except csv.Error:
+        con_cabecera = True
+    return dialecto, con_cabecera
 
-@app.post("/process-document", response_model=ProcessResponse)
-async def process_document_text(request: ProcessRequest):
-    doc_id = request.doc_id
-    current_user_id = request.user_id
-    current_tenant_id = request.tenant_id
-    if not isinstance(current_user_id, int) or not isinstance(current_tenant_id, int):
-        logger.error(f"IDs inválidos recibidos en /process-document: User='{current_user_id}', Tenant='{current_tenant_id}' para Doc ID {doc_id}")
-        return ProcessResponse(success=False, error="User ID y Tenant ID deben ser números enteros válidos.")
-    logger.info(f"Procesar doc ID: {doc_id} user: {current_user_id} tenant: {current_tenant_id}")
-    if not DB_CONFIGURED or not PHP_BRIDGE_CONFIGURED:
-        error_msg = "Configuración incompleta en el backend para procesar documentos."
-        if not DB_CONFIGURED:
-            error_msg += " (Falta config BD)"
-        if not PHP_BRIDGE_CONFIGURED:
-            error_msg += " (Falta config PHP Bridge)"
-        logger.error(error_msg + f" - Solicitud para doc {doc_id}")
-        return ProcessResponse(success=False, error=error_msg)
-    conn = None; original_fname = None; temp_path = None
+def _valor_csv(valor: str) -> str:
+    return " ".join(valor.split())
+
+# "columna: valor; columna: valor" por fila, omitiendo celdas vacías
+def iterar_registros_csv(filas, cabecera: list[str]):
+    for n, fila in enumerate(filas, 1):
+        campos = [f"{cabecera[i] if i < len(cabecera) else f'col{i + 1}'}: {_valor_csv(v)}" for i, v in enumerate(fila) if v.strip()]
+        if campos:
+            yield f"[{n}] " + "; ".join(campos) + "\n"
+
+def _tipo_valor_csv(valor: str) -> str:
+    v = valor.strip().replace(" ", "")
+    if re.fullmatch(r"[-+]?\d+", v):
+        return "entero"
+    if re.fullmatch(r"[-+]?(\d{1,3}([.,]\d{3})*|\d+)([.,]\d+)?%?", v):
+        return "decimal"
+    if re.fullmatch(r"\d{1,4}[-/.]\d{1,2}[-/.]\d{1,4}([ T]\d{1,2}:\d{2}(:\d{2})?)?", v):
+        return "fecha"
+    return "texto"
+
+# Recorre todas las filas (memoria acotada) y devuelve un resumen de columnas más las primeras filas como registros
+def resumir_csv(filas, cabecera: list[str], max_chars: int | None) -> str:
+    columnas = {}  # índice -> {"llenas", "tipos", "ejemplos"}
+    muestra = []
+    total = 0
+    for fila in filas:
+        total += 1
+        if len(muestra) < CSV_MUESTRA_FILAS:
+            muestra.append(fila)
+        for i, valor in enumerate(fila):
+            if not valor.strip():
+                continue
+            col = columnas.setdefault(i, {"llenas": 0, "tipos": {}, "ejemplos": []})
+            col["llenas"] += 1
+            if total > CSV_FILAS_TIPADO:
+                continue
+            tipo = _tipo_valor_csv(valor)
+            col["tipos"][tipo] = col["tipos"].get(tipo, 0) + 1
+            valor = _valor_csv(valor)[:60]
+            if len(col["ejemplos"]) < 3 and valor not in col["ejemplos"]:
+                col["ejemplos"].append(valor)
+    lineas = [f"Tabla CSV: {total} filas, {max(len(cabecera), max(columnas, default=-1) + 1)} columnas.", "Columnas:"]
+    for i in sorted(set(range(len(cabecera))) | set(columnas)):
+        col = columnas.get(i, {"llenas": 0, "tipos": {}, "ejemplos": []})
+        nombre = cabecera[i] if i < len(cabecera) else f"col{i + 1}"
+        tipo = max(col["tipos"], key=col["tipos"].get) if col["tipos"] else "vacía"
+        lineas.append(f"- {nombre} ({tipo}, {col['llenas']}/{total} con valor): {', '.join(col['ejemplos'])}")
+    lineas.append(f"Primeras {len(muestra)} filas:")
+    texto = "\n".join(lineas) + "\n" + "".join(iterar_registros_csv(muestra, cabecera))
+    return texto[:max_chars] if max_chars else texto
+
+def extraer_texto_csv(origen: bytes | str, max_chars: int | None = None) -> str:
+    filename_for_log = _nombre_origen(origen)
+    logger.info(f"Extrayendo CSV ({CSV_MODO}) de: {filename_for_log}")
     try:
-        conn = get_db_connection()
-        if not conn:
-            raise ConnectionError("No se pudo conectar a BD para obtener info del documento.")
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
-            sql_select = """
-                SELECT original_filename, file_type, stored_path, procesado
-                FROM user_documents
-                WHERE id = %s AND user_id = %s AND tenant_id = %s
-            """
-            cursor.execute(sql_select, (doc_id, current_user_id, current_tenant_id))
-            doc_info = cursor.fetchone()
-            if not doc_info:
-                 logger.warning(f"Documento ID {doc_id} no encontrado para User {current_user_id}/Tenant {current_tenant_id}.")
-                 raise FileNotFoundError(f"Documento ID {doc_id} no encontrado para este usuario/tenant.")
-            original_fname = doc_info['original_filename']
-            file_type = doc_info['file_type']
-            stored_path = doc_info['stored_path']
-            is_already_processed = doc_info['procesado']
-            if is_already_processed:
-                 logger.info(f"Documento {doc_id} ('{original_fname}') ya estaba marcado como procesado. Omitiendo.")
-                 return ProcessResponse(success=True, message="El documento ya estaba procesado.")
-        conn.close()
-        conn = None
-        serve_url = f"{PHP_FILE_SERVE_URL}?doc_id={doc_id}&user_id={current_user_id}&tenant_id={current_tenant_id}&api_key={PHP_API_SECRET_KEY}"
-        logger.info(f"Solicitando doc ID {doc_id} a PHP. URL: {serve_url}")
-        response = requests.get(serve_url, timeout=120, stream=True)
-        response.raise_for_status()
-        logger.info(f"Respuesta recibida de PHP Bridge (Status: {response.status_code}).")
-        file_ext = os.path.splitext(original_fname)[1].lower().strip('.') if original_fname else ''
-        extracted_text = None
-        TEXT_EXTENSIONS_PROC = ["pdf", "doc", "docx", "txt", "csv"]
-        if file_ext in TEXT_EXTENSIONS_PROC:
-            with tempfile.NamedTemporaryFile(mode='wb', suffix=f'.{file_ext}', dir=TEMP_DIR, delete=False) as temp_file:
-                temp_path = temp_file.name
-                bytes_written = 0
-                try:
-                    logger.info(f"Guardando contenido en archivo temporal: {temp_path}")
-                    for chunk in response.iter_content(chunk_size=8192):
-                        temp_file.write(chunk)
-                        bytes_written += len(chunk)
-                    logger.info(f"Escritos {bytes_written} bytes en {temp_path}")
-                    if bytes_written == 0:
-                         logger.warning(f"Archivo recibido de PHP Bridge para doc {doc_id} vacío.")
-                         extracted_text = "[Archivo vacío recibido]"
-                except Exception as write_err:
-                     logger.error(f"Error escribiendo en archivo temporal {temp_path}: {write_err}", exc_info=True)
-                     if temp_path and os.path.exists(temp_path):
-                         os.remove(temp_path)
-                         temp_path = None
-                     raise IOError(f"No se pudo escribir el archivo temporal para {original_fname}")
-            if extracted_text is None:
-                 logger.info(f"Extrayendo texto de archivo temporal cerrado: {temp_path}")
-                 if file_ext in ['pdf', 'doc', 'docx']:
-                     extracted_text = extraer_texto_pdf_docx(temp_path, file_ext)
-                 elif file_ext in ['txt', 'csv']:
-                     extracted_text = extraer_texto_simple(temp_path)
-                 logger.info(f"Texto extraído (longitud: {len(extracted_text) if extracted_text else 0} caracteres)")
-            if temp_path and os.path.exists(temp_path):
-                try:
-                    os.remove(temp_path)
-                    logger.info(f"Archivo temporal {temp_path} eliminado tras extracción.")
-                    temp_path = None
-                except OSError as e_remove:
-                    logger.error(f"Error al borrar archivo temporal {temp_path}: {e_remove}")
+        lineas = iterar_lineas(iterar_texto(origen))
+        inicio = []
+        tam_inicio = 0
+        for linea in lineas:
+            inicio.append(linea)
+            tam_inicio += len(linea)
+            if tam_inicio >= ENCODING_SAMPLE_BYTES:
+                break
+        if not "".join(inicio).strip():
+            logger.warning(f"CSV vacío: {filename_for_log}")
+            return "[Archivo sin texto extraíble]"
+        dialecto, con_cabecera = detectar_dialecto_csv("".join(inicio))
+        filas = (fila for fila in csv.reader(itertools.chain(inicio, lineas), dialecto) if any(v.strip() for v in fila))
+        cabecera = []
+        if con_cabecera:
+            cabecera = [_valor_csv(c) or f"col{i + 1}" for i, c in enumerate(next(filas, []))]
+        logger.info(f"CSV '{filename_for_log}': delimitador {dialecto.delimiter!r}, cabecera: {cabecera[:10]}")
+        if CSV_MODO == "esquema":
+            texto = resumir_csv(filas, cabecera, max_chars)
         else:
-            logger.warning(f"Extracción no soportada para extensión '{file_ext}' (Doc: {doc_id}, File: '{original_fname}')")
-            extracted_text = f"[Extracción no soportada para tipo: {file_ext}]"
-        if extracted_text is None or not extracted_text.strip() or extracted_text.strip().startswith("[Error"):
-            if extracted_text is None:
-                extracted_text = "[Error: Extracción devolvió None]"
-            if not extracted_text.strip():
-                extracted_text = "[Archivo vacío o sin texto extraíble]"
-            logger.error(f"Extracción de texto fallida o vacía para doc {doc_id}. Texto guardado en BD: '{extracted_text[:100]}...'")
-        logger.info(f"Actualizando BD doc ID {doc_id} tenant {current_tenant_id}...")
-        conn = get_db_connection()
-        if not conn:
-            raise ConnectionError("No se pudo reconectar a BD para actualizar.")
-        with conn.cursor() as cursor:
-            sql_update = """
-                UPDATE user_documents
-                SET extracted_text = %s, procesado = TRUE
-                WHERE id = %s AND user_id = %s AND tenant_id = %s
-            """
-            MAX_TEXT_LENGTH = 15 * 1024 * 1024
-            if len(extracted_text) > MAX_TEXT_LENGTH:
-                 logger.warning(f"Texto extraído truncado a {MAX_TEXT_LENGTH} caracteres para BD (doc {doc_id}). Longitud original: {len(extracted_text)}")
-                 extracted_text_to_save = extracted_text[:MAX_TEXT_LENGTH]
-            else:
-                 extracted_text_to_save = extracted_text
-            cursor.execute(sql_update, (extracted_text_to_save, doc_id, current_user_id, current_tenant_id))
-            rows_affected = cursor.rowcount
-            conn.commit()
-            if rows_affected == 0:
-                logger.warning(f"UPDATE no afectó filas para doc {doc_id}/tenant {current_tenant_id}")
-            else:
-                logger.info(f"BD actualizada doc ID {doc_id} ({rows_affected} fila).")
-        return ProcessResponse(success=True, message="Documento procesado.")
-    except FileNotFoundError as e:
-        logger.error(f"Error FNF procesando doc {doc_id}: {e}")
-        return ProcessResponse(success=False, error=str(e))
-    except ConnectionError as e:
-        logger.error(f"Error de Conexión BD procesando doc {doc_id}: {e}")
-        return ProcessResponse(success=False, error="Error de conexión con la base de datos.")
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error PHP Bridge en doc {doc_id}: {e}", exc_info=True)
-        status_code = e.response.status_code if e.response is not None else 'N/A'
-        return ProcessResponse(success=False, error=f"Error al obtener el archivo ({status_code}).")
-    except IOError as e:
-         logger.error(f"Error de I/O con archivo temporal para doc {doc_id}: {e}", exc_info=True)
-         return ProcessResponse(success=False, error=f"Error al manejar archivo temporal: {e}")
-    except (psycopg2.Error) as db_err:
-        logger.error(f"Error de Base de Datos (Update) procesando doc {doc_id}: {db_err}", exc_info=True)
-        if conn and not conn.closed:
-            conn.rollback()
-        return ProcessResponse(success=False, error="Error de base de datos durante actualización.")
+            texto = _consumir_hasta(iterar_registros_csv(filas, cabecera), max_chars)
+        texto_limpio = texto.strip()
+        if not texto_limpio:
+            return "[Archivo sin texto extraíble]"
+        logger.info(f"CSV OK ({len(texto_limpio)} chars) de '{filename_for_log}'.")
+        return texto_limpio
+    except csv.Error as e:
+        logger.warning(f"CSV mal formado '{filename_for_log}' ({e}). Se extrae como texto plano.")
+        return extraer_texto_simple(origen, max_chars)
+    except FileNotFoundError:
+        logger.error(f"FNF: '{filename_for_log}' extracción CSV.")
+        return "[Error: Archivo no encontrado]"
     except Exception as e:
-        logger.error(f"Error general inesperado procesando doc {doc_id}: {e}", exc_info=True)
-        return ProcessResponse(success=False, error=f"Error interno del servidor ({type(e).__name__}).")
-    finally:
-        if temp_path and os.path.exists(temp_path):
-            try:
-                os.remove(temp_path)
-                logger.info(f"Archivo temporal {temp_path} eliminado en bloque finally (verificación).")
-            except OSError as e_remove:
-                logger.error(f"Error al borrar archivo temporal {temp_path} en finally: {e_remove}")
-        if conn and not conn.closed:
-            conn.close()
+        logger.error(f"Error inesperado CSV '{filename_for_log}': {e}", exc_info=True)
+        return "[Error interno CSV]"
 
-@app.post("/consulta", response_model=RespuestaConsulta)
-def consultar_agente(datos: PeticionConsulta):
-    if not client:
-        logger.error("Llamada /consulta sin cliente OpenAI.")
-        raise HTTPException(503, "Servicio IA no disponible.")
-    current_user_id = datos.user_id
-    current_tenant_id = datos.tenant_id
-    if not isinstance(current_user_id, int) or not isinstance(current_tenant_id, int):
-        logger.error(f"IDs inválidos /consulta: U={current_user_id}, T={current_tenant_id}")
-        raise HTTPException(400, "User/Tenant ID inválidos.")
-    especializacion = datos.especializacion.lower() if datos.especializacion else "general"
-    mensaje_usuario = datos.mensaje.strip()
-    forzar_busqueda_web = datos.buscar_web
-    logger.info(f"Consulta: U={current_user_id},T={current_tenant_id},E='{especializacion}',Web={forzar_busqueda_web},Msg='{mensaje_usuario[:100]}...'")
-    if not mensaje_usuario:
-        return RespuestaConsulta(respuesta="<p>Por favor, introduce tu consulta.</p>")
-    custom_prompt_text = ""
-    if DB_CONFIGURED:
-        conn_prompt = get_db_connection()
-        if conn_prompt:
+# --- Pool de procesos para extracción de texto (PyPDF2 / python-docx / chardet) ---
+EXTRACT_WORKERS = _env_int("EXTRACT_WORKERS", os.cpu_count() or 2)  # 0 = extracción en hilo (sin procesos)
+EXTRACT_TIMEOUT = _env_float("EXTRACT_TIMEOUT", 120.0)  # Timeout (s) por trabajo
+EXTRACT_MAX_TASKS_PER_CHILD = _env_int("EXTRACT_MAX_TASKS_PER_CHILD", 50)  # Reciclado de workers para acotar memoria
+
+class PoolExtraccion:
+    def __init__(self, workers: int, timeout: float, max_tasks_per_child: int):
+        self.workers = workers
+        self.timeout = timeout
+        self.max_tasks_per_child = max_tasks_per_child or None
+        self._executor = None
+        self._lock = threading.Lock()
+        self._slots = None  # asyncio.Semaphore: los trabajos esperan aquí y no en la cola interna del executor
+        self._en_vuelo = {}  # executor -> futures enviados y aún sin terminar
+        self._colgados = set()  # Futures que agotaron el timeout (su proceso es el que hay que matar)
+        self._stats = {"jobs": 0, "failed": 0, "timeouts": 0, "restarts": 0, "running": 0}
+
+    def abrir(self):
+        if self.workers <= 0:
+            logger.info("Pool de extracción deshabilitado (EXTRACT_WORKERS=0). Extracción en hilo.")
+            return
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    max_tasks_per_child=self.max_tasks_per_child
+                )
+                logger.info(f"Pool de extracción abierto ({self.workers} procesos, reciclado cada {self.max_tasks_per_child} trabajos).")
+
+    def cerrar(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+            logger.info("Pool de extracción cerrado.")
+
+    def _reiniciar(self, executor_roto):
+        # El trabajo colgado no se puede cancelar: se aparta el executor viejo, que termina sus otros trabajos en curso
+        with self._lock:
+            if self._executor is not executor_roto:
+                return
+            self._executor = None
+            self._stats["restarts"] += 1
+        procesos = list((getattr(executor_roto, "_processes", None) or {}).values())
+        executor_roto.shutdown(wait=False)
+        self._retirar(executor_roto, procesos)
+        self.abrir()
+
+    # Cuando solo quedan trabajos colgados en el executor apartado se matan sus procesos (los sanos ya han salido)
+    def _retirar(self, executor, procesos):
+        with self._lock:
+            pendientes = [f for f in self._en_vuelo.get(executor, ()) if f not in self._colgados]
+        if pendientes:
             try:
-                with conn_prompt.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
-                    cursor.execute("SELECT custom_prompt FROM user_settings WHERE user_id = %s AND tenant_id = %s", (current_user_id, current_tenant_id))
-                    result = cursor.fetchone()
-                    if result and result.get('custom_prompt') and result['custom_prompt'].strip():
-                        custom_prompt_text = result['custom_prompt'].strip()
-                        logger.info(f"Memoria OK U={current_user_id}/T={current_tenant_id}.")
-                    else:
-                        logger.info(f"No Memoria U={current_user_id}/T={current_tenant_id}.")
-            except (Exception, psycopg2.Error) as e:
-                logger.error(f"Error BD get Memoria U={current_user_id}: {e}", exc_info=True)
-            finally:
-                conn_prompt.close()
-        else:
-            logger.warning(f"No conexión BD Memoria U={current_user_id}")
-    document_context = ""
-    MAX_RAG_TOKENS = 3500
-    if DB_CONFIGURED:
-        conn_docs = get_db_connection()
-        if conn_docs:
+                asyncio.get_running_loop().call_later(1.0, self._retirar, executor, procesos)
+                return
+            except RuntimeError:
+                pass
+        for proceso in procesos:
+            if proceso.is_alive():
+                proceso.terminate()
+        with self._lock:
+            self._colgados.difference_update(self._en_vuelo.pop(executor, ()))
+
+    def _enviar(self, executor, fn, *args):
+        futuro = executor.submit(fn, *args)
+        with self._lock:
+            self._en_vuelo.setdefault(executor, set()).add(futuro)
+        def _terminado(f):
+            with self._lock:
+                self._en_vuelo.get(executor, set()).discard(f)
+                self._colgados.discard(f)
+        futuro.add_done_callback(_terminado)
+        return futuro
+
+    async def ejecutar(self, fn, *args):
+        if self.workers <= 0:
+            return await asyncio.to_thread(fn, *args)
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        async with self._slots:
+            if self._executor is None:
+                self.abrir()
+            executor = self._executor
+            self._stats["jobs"] += 1
+            self._stats["running"] += 1
+            futuro = None
             try:
-                with conn_docs.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
-                    search_query_cleaned = re.sub(r'[!\'()|&:*<>~@]', ' ', mensaje_usuario).strip()
-                    search_query_terms = search_query_cleaned.split()
-                    if not search_query_terms:
-                        logger.info("Msg RAG vacío tras limpiar.")
-                    else:
-                        fts_query_string = ' & '.join(search_query_terms)
-                        logger.info(f"Buscando RAG FTS: '{fts_query_string}' U={current_user_id}/T={current_tenant_id}")
-                        sql_fts = "SELECT original_filename, extracted_text, ts_rank_cd(fts_vector, plainto_tsquery('spanish', %(query)s)) as relevance FROM user_documents WHERE user_id = %(user_id)s AND tenant_id = %(tenant_id)s AND is_active_for_ai = TRUE AND procesado = TRUE AND fts_vector @@ plainto_tsquery('spanish', %(query)s) AND extracted_text IS NOT NULL AND extracted_text != '' AND NOT extracted_text LIKE '[Error%%' AND NOT extracted_text LIKE '[Archivo vacío%%' ORDER BY relevance DESC LIMIT 5"
-                        cursor.execute(sql_fts, {'query': fts_query_string, 'user_id': current_user_id, 'tenant_id': current_tenant_id})
-                        relevant_docs = cursor.fetchall()
-                        if relevant_docs:
-                            logger.info(f"Encontrados {len(relevant_docs)} docs RAG pots.")
-                            context_parts = ["\n\n### Contexto de tus Documentos ###\n"]
-                            current_token_count = 0
-                            docs_included_count = 0
-                            MIN_PARTIAL_TOKENS = 150
-                            for doc in relevant_docs:
-                                filename = doc['original_filename']
-                                text = doc['extracted_text']
-                                relevance_score = doc['relevance']
-                                logger.debug(f"Eval RAG: '{filename}' (Rel: {relevance_score:.4f})")
-                                doc_tokens_estimated = len(text.split()) * 1.3
-                                if current_token_count + doc_tokens_estimated <= MAX_RAG_TOKENS:
-                                    context_parts.append(f"\n--- Doc: {htmlspecialchars(filename)} (Rel: {relevance_score:.2f}) ---")
-                                    context_parts.append(text)
-                                    current_token_count += doc_tokens_estimated
-                                    docs_included_count += 1
-                                    logger.debug(f"Add RAG: '{filename}'. Toks: ~{current_token_count:.0f}/{MAX_RAG_TOKENS}")
-                                    if current_token_count >= MAX_RAG_TOKENS:
-                                        logger.warning(f"Límite RAG ({MAX_RAG_TOKENS}) {docs_included_count} docs.")
-                                        break
-                                else:
-                                    remaining_tokens = MAX_RAG_TOKENS - current_token_count
-                                    if remaining_tokens > MIN_PARTIAL_TOKENS:
-                                         available_chars = max(100, int(remaining_tokens / 1.3))
-                                         partial_text = text[:available_chars]
-                                         context_parts.append(f"\n--- Doc (Parcial): {htmlspecialchars(filename)} (Rel: {relevance_score:.2f}) ---")
-                                         context_parts.append(partial_text + "...")
-                                         current_token_count += remaining_tokens
-                                         docs_included_count += 1
-                                         logger.warning(f"Incluida porción RAG '{filename}'. Límite RAG.")
-                                    else:
-                                        logger.info(f"Doc RAG '{filename}' omitido (límite tokens).")
-                                    break
-                            if docs_included_count > 0:
-                                document_context = "\n".join(context_parts)
-                                logger.info(f"Contexto RAG: {docs_included_count} docs (~{current_token_count:.0f} tokens).")
-                            else:
-                                logger.info("Ningún doc RAG añadido a contexto.")
-                        else:
-                            logger.info("No docs RAG encontrados.")
-            except (Exception, psycopg2.Error) as e:
-                logger.error(f"Error BD RAG U={current_user_id}: {e}", exc_info=True)
-                document_context = "\n<p><i>[Error buscar docs.]</i></p>"
+                futuro = self._enviar(executor, fn, *args)
+                return await asyncio.wait_for(asyncio.wrap_future(futuro), self.timeout)
+            except asyncio.TimeoutError:
+                self._stats["timeouts"] += 1
+                logger.error(f"Timeout extracción ({self.timeout}s) en {fn.__name__}. Reciclando pool.")
+                with self._lock:
+                    if not futuro.done():
+                        self._colgados.add(futuro)
+                self._reiniciar(executor)
+                raise
+            except BrokenProcessPool:
+                self._stats["failed"] += 1
+                logger.error(f"Pool de extracción roto en {fn.__name__}. Reiniciando.")
+                self._reiniciar(executor)
+                raise
             finally:
-                if conn_docs:
-                    conn_docs.close()
+                self._stats["running"] -= 1
+
+    def estadisticas(self) -> dict:
+        return {"workers": self.workers, "timeout": self.timeout, "max_tasks_per_child": self.max_tasks_per_child, "open": self._executor is not None, **self._stats}
+
+extraction_pool = PoolExtraccion(EXTRACT_WORKERS, EXTRACT_TIMEOUT, EXTRACT_MAX_TASKS_PER_CHILD)
+
+# Extractor (y modo) que produce el texto de cada extensión: los mismos bytes subidos como .txt y .csv,
+# o con CSV_MODO distinto, dan textos distintos y no se pueden reutilizar entre sí
+def version_extractor(extension: str) -> str:
+    if extension in ['pdf', 'doc', 'docx']:
+        return f"pdf_docx:{extension}"
+    if extension == 'csv':
+        return f"csv:{CSV_MODO}"
+    return f"simple:{extension}"
+
+def extraer_texto_documento(origen: bytes | str, extension: str, max_chars: int | None = None) -> str:
+    if extension in ['pdf', 'doc', 'docx']:
+        return extraer_texto_pdf_docx(origen, extension, max_chars)
+    if extension == 'csv':
+        return extraer_texto_csv(origen, max_chars)
+    return extraer_texto_simple(origen, max_chars)
+
+# Ingesta: extracción y troceado en el mismo proceso worker (el troceado tampoco ocupa el event loop)
+def extraer_texto_y_chunks(origen: bytes | str, extension: str, max_chars: int | None = None) -> tuple[str, list[str]]:
+    texto = extraer_texto_documento(origen, extension, max_chars)
+    return texto, (dividir_en_chunks(texto) if texto_indexable(texto) else [])
+
+# Los extractores devuelven "[Error ...]" en vez de lanzar (se ejecutan en otro proceso): se cuentan aquí
+def _contar_fallo_extraccion(extension: str, texto: str | None, motivo: str = "error"):
+    if texto is None or texto.startswith("[Error"):
+        metricas.incrementar("extraction_failures_total", file_type=extension or "desconocido", reason=motivo)
+
+async def extraer_texto_async(origen: bytes | str, extension: str, max_chars: int | None = None) -> str:
+    try:
+        with metricas.medir("extraccion"):
+            texto = await extraction_pool.ejecutar(extraer_texto_documento, origen, extension, max_chars)
+    except asyncio.TimeoutError:
+        _contar_fallo_extraccion(extension, None, "timeout")
+        return "[Error: Timeout extracción]"
+    except BrokenProcessPool:
+        _contar_fallo_extraccion(extension, None, "pool")
+        return f"[Error interno {extension.upper()}]"
+    _contar_fallo_extraccion(extension, texto)
+    return texto
+
+async def extraer_texto_y_chunks_async(origen: bytes | str, extension: str, max_chars: int | None = None) -> tuple[str, list[str]]:
+    try:
+        with metricas.medir("extraccion"):
+            texto, chunks = await extraction_pool.ejecutar(extraer_texto_y_chunks, origen, extension, max_chars)
+    except asyncio.TimeoutError:
+        _contar_fallo_extraccion(extension, None, "timeout")
+        return "[Error: Timeout extracción]", []
+    except BrokenProcessPool:
+        _contar_fallo_extraccion(extension, None, "pool")
+        return f"[Error interno {extension.upper()}]", []
+    _contar_fallo_extraccion(extension, texto)
+    return texto, chunks
+
+# --- Preprocesado de imágenes para Vision (Pillow) ---
+IMAGE_MAX_DIM = _env_int("IMAGE_MAX_DIM", 2048)  # Lado mayor; Vision reescala por encima de 2048 px igualmente
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "jpeg").lower()  # jpeg | webp | png
+IMAGE_QUALITY = _env_int("IMAGE_QUALITY", 85)
+imagen_stats = {"processed": 0, "fallbacks": 0, "bytes_in": 0, "bytes_out": 0}
+
+# Orienta según EXIF, reduce al lado máximo y re-codifica sin metadatos. Devuelve (bytes, mime).
+def preprocesar_imagen(datos: bytes, max_dim: int, formato: str, calidad: int) -> tuple[bytes, str]:
+    from PIL import Image, ImageOps
+    with Image.open(io.BytesIO(datos)) as imagen:
+        if imagen.format == "JPEG":
+            imagen.draft("RGB", (max_dim, max_dim))  # Decodificación JPEG ya reducida (mucho más rápida en fotos grandes)
+        imagen = ImageOps.exif_transpose(imagen)
+        imagen.thumbnail((max_dim, max_dim), Image.LANCZOS)
+        if formato == "png":
+            if imagen.mode not in ("RGB", "RGBA", "L", "LA", "P"):
+                imagen = imagen.convert("RGBA")
+        elif imagen.mode in ("RGBA", "LA", "P"):
+            imagen = imagen.convert("RGBA")
+            fondo = Image.new("RGB", imagen.size, (255, 255, 255))
+            fondo.paste(imagen, mask=imagen.getchannel("A"))
+            imagen = fondo
+        elif imagen.mode != "RGB":
+            imagen = imagen.convert("RGB")
+        salida = io.BytesIO()
+        if formato == "png":
+            imagen.save(salida, "PNG", optimize=True)
+        elif formato == "webp":
+            imagen.save(salida, "WEBP", quality=calidad, method=4)
         else:
-            logger.warning(f"No conexión BD RAG U={current_user_id}")
-    prompt_especifico = PROMPT_ESPECIALIZACIONES.get(especializacion, PROMPT_ESPECIALIZACIONES["general"])
-    system_prompt_parts = [BASE_PROMPT_CONSULTA, prompt_especifico]
-    if custom_prompt_text:
-        system_prompt_parts.append(f"\n### Memoria ###\n{custom_prompt_text}")
-    if document_context:
-        system_prompt_parts.append(document_context)
-    system_prompt = "\n".join(filter(None, system_prompt_parts))
-    texto_respuesta_final = "<p><i>Error generando respuesta.</i></p>"
-    MAX_RETRIES_OPENAI = 2
-    for attempt in range(MAX_RETRIES_OPENAI):
-         try:
-            logger.info(f"Llamando OpenAI (Intento {attempt + 1}) U={current_user_id}...")
-            respuesta_inicial = client.chat.completions.create(model="gpt-4-turbo", messages=[{"role": "system", "content": system_prompt},{"role": "user", "content": mensaje_usuario}], temperature=0.6, max_tokens=2000 )
-            if not respuesta_inicial.choices or not respuesta_inicial.choices[0].message or not respuesta_inicial.choices[0].message.content:
-                logger.error("Respuesta OpenAI inválida.")
-                texto_respuesta_final = "<p><i>Error: Respuesta IA inválida.</i></p>"
-                continue
-            texto_respuesta_final = respuesta_inicial.choices[0].message.content.strip()
-            finish_reason = respuesta_inicial.choices[0].finish_reason
-            logger.info(f"Respuesta OpenAI OK (Len: {len(texto_respuesta_final)}, Fin: {finish_reason}).")
-            if finish_reason == 'length':
-                logger.warning("Respuesta OpenAI truncada.")
-                texto_respuesta_final += "\n<p><i>(Respuesta incompleta...)</i></p>"
-            necesita_web = any(frase in texto_respuesta_final.lower() for frase in FRASES_BUSQUEDA) or forzar_busqueda_web
-            if necesita_web:
-                logger.info("Requiere búsqueda web (Forzado).")
-                web_resultados_html = buscar_google(mensaje_usuario)
-                if web_resultados_html and not web_resultados_html.startswith("<p><i>["):
-                    texto_respuesta_final += "\n\n" + web_resultados_html
-                    logger.info("Resultados web añadidos.")
+            imagen.save(salida, "JPEG", quality=calidad, optimize=True)
+        return salida.getvalue(), f"image/{formato}"
+
+async def preparar_imagen_vision(datos: bytes, content_type: str, filename: str) -> tuple[bytes, str]:
+    if not PIL_AVAILABLE or IMAGE_MAX_DIM <= 0:
+        return datos, content_type
+    inicio = time.perf_counter()
+    try:
+        with metricas.medir("imagen_preproceso"):
+            procesada, mime = await extraction_pool.ejecutar(preprocesar_imagen, datos, IMAGE_MAX_DIM, IMAGE_FORMAT, IMAGE_QUALITY)
+    except Exception as e:
+        imagen_stats["fallbacks"] += 1
+        logger.warning(f"Preprocesado de imagen '{filename}' fallido ({type(e).__name__}: {e}). Se envía el original.")
+        return datos, content_type
+    imagen_stats["processed"] += 1
+    imagen_stats["bytes_in"] += len(datos)
+    imagen_stats["bytes_out"] += len(procesada)
+    logger.info(f"Imagen '{filename}': {len(datos) / 1024:.0f} KB -> {len(procesada) / 1024:.0f} KB ({mime}) en {time.perf_counter() - inicio:.2f}s.")
+    return procesada, mime
+
+# --- Caché en memoria con TTL + LRU (acotada por entradas y tamaño aproximado) ---
+class CacheTTL:
+    def __init__(self, nombre: str, ttl: float, max_entradas: int, max_bytes: int = 0):
+        self.nombre = nombre
+        self.ttl = ttl
+        self.max_entradas = max(1, max_entradas)
+        self.max_bytes = max_bytes
+        self._datos = OrderedDict()  # clave -> (expira, valor, tamaño, etiquetas)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    @staticmethod
+    def _tamaño(valor) -> int:
+        if hasattr(valor, "nbytes"):
+            return int(valor.nbytes)
+        if isinstance(valor, (str, bytes)):
+            return len(valor)
+        if isinstance(valor, BaseModel):
+            return len(valor.model_dump_json())
+        return len(repr(valor))
+
+    def _quitar(self, clave):
+        _, _, tamaño, _ = self._datos.pop(clave)
+        self._bytes -= tamaño
+
+    def obtener(self, clave):
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is None:
+                self._stats["misses"] += 1
+                return None
+            if entrada[0] < time.monotonic():
+                self._quitar(clave)
+                self._stats["expirations"] += 1
+                self._stats["misses"] += 1
+                return None
+            self._datos.move_to_end(clave)
+            self._stats["hits"] += 1
+            return entrada[1]
+
+    def guardar(self, clave, valor, etiquetas: tuple = (), ttl: float | None = None):
+        tamaño = self._tamaño(valor)
+        if self.max_bytes and tamaño > self.max_bytes:
+            return
+        with self._lock:
+            if clave in self._datos:
+                self._quitar(clave)
+            self._datos[clave] = (time.monotonic() + (self.ttl if ttl is None else ttl), valor, tamaño, tuple(etiquetas))
+            self._bytes += tamaño
+            while len(self._datos) > self.max_entradas or (self.max_bytes and self._bytes > self.max_bytes):
+                self._quitar(next(iter(self._datos)))
+                self._stats["evictions"] += 1
+
+    def invalidar(self, etiqueta) -> int:
+        with self._lock:
+            claves = [c for c, entrada in self._datos.items() if etiqueta in entrada[3]]
+            for clave in claves:
+                self._quitar(clave)
+            self._stats["invalidations"] += len(claves)
+            return len(claves)
+
+    def limpiar(self):
+        with self._lock:
+            self._datos.clear()
+            self._bytes = 0
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            consultas = self._stats["hits"] + self._stats["misses"]
+            return {
+                "entries": len(self._datos), "bytes": self._bytes, "max_entries": self.max_entradas, "max_bytes": self.max_bytes,
+                "ttl": self.ttl, "hit_rate": round(self._stats["hits"] / consultas, 4) if consultas else 0.0, **self._stats
+            }
+
+# Caché LRU en disco (un fichero comprimido por clave) acotada en bytes. Los ficheros se comparten entre workers:
+# un fallo en el índice local mira el disco antes de contar miss; el índice se reconstruye por mtime al primer uso.
+class CacheDisco:
+    def __init__(self, nombre: str, directorio: str, max_bytes: int):
+        self.nombre = nombre
+        self.directorio = directorio
+        self.max_bytes = max_bytes
+        self._indice = OrderedDict()  # clave -> tamaño en disco
+        self._bytes = 0
+        self._cargado = False
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "errors": 0}
+
+    @property
+    def activa(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def clave(*partes) -> str:
+        return hashlib.sha256("\x00".join(str(p) for p in partes).encode("utf-8")).hexdigest()
+
+    def _ruta(self, clave: str) -> str:
+        return os.path.join(self.directorio, clave + ".z")
+
+    def _cargar(self):
+        if self._cargado:
+            return
+        self._cargado = True
+        try:
+            os.makedirs(self.directorio, exist_ok=True)
+            self._escanear()
+            logger.info(f"Caché disco '{self.nombre}': {len(self._indice)} entradas ({self._bytes / 1024:.0f} KB) en {self.directorio}.")
+            self._recortar()
+        except OSError as e:
+            logger.error(f"Error cargando caché disco '{self.nombre}': {e}")
+
+    # El índice se rehace desde el directorio, que comparten todos los workers de uvicorn: así max_bytes
+    # limita el directorio y no cada proceso. El orden LRU es el mtime (obtener() lo actualiza).
+    def _escanear(self):
+        ficheros = []
+        for entrada in os.scandir(self.directorio):
+            if entrada.is_file() and entrada.name.endswith(".z"):
+                try:
+                    info = entrada.stat()
+                except FileNotFoundError:
+                    continue  # Recortado por otro worker
+                ficheros.append((info.st_mtime, entrada.name[:-2], info.st_size))
+        self._indice = OrderedDict((clave, tamaño) for _, clave, tamaño in sorted(ficheros))
+        self._bytes = sum(self._indice.values())
+
+    def _olvidar(self, clave: str):
+        self._bytes -= self._indice.pop(clave, 0)
+
+    def _recortar(self):
+        while self._indice and self._bytes > self.max_bytes:
+            clave = next(iter(self._indice))
+            self._olvidar(clave)
+            self._stats["evictions"] += 1
+            try:
+                os.remove(self._ruta(clave))
+            except OSError:
+                pass
+
+    def obtener(self, clave: str) -> str | None:
+        if not self.activa:
+            return None
+        ruta = self._ruta(clave)
+        with self._lock:
+            self._cargar()
+            try:
+                with open(ruta, "rb") as f:
+                    datos = f.read()
+                os.utime(ruta)
+            except FileNotFoundError:
+                self._olvidar(clave)
+                self._stats["misses"] += 1
+                return None
+            except OSError as e:
+                logger.error(f"Error leyendo caché disco '{self.nombre}': {e}")
+                self._stats["errors"] += 1
+                return None
+            if clave not in self._indice:
+                self._indice[clave] = len(datos)
+                self._bytes += len(datos)
+            self._indice.move_to_end(clave)
+            self._stats["hits"] += 1
+        try:
+            return zlib.decompress(datos).decode("utf-8")
+        except (zlib.error, UnicodeDecodeError) as e:
+            logger.error(f"Entrada corrupta en caché disco '{self.nombre}': {e}")
+            self._stats["errors"] += 1
+            return None
+
+    def guardar(self, clave: str, valor: str):
+        if not self.activa:
+            return
+        datos = zlib.compress(valor.encode("utf-8"), 3)
+        if len(datos) > self.max_bytes:
+            return
+        ruta = self._ruta(clave)
+        with self._lock:
+            self._cargar()
+            try:
+                # Escritura atómica: otro worker nunca ve un fichero a medias
+                temporal = f"{ruta}.{uuid.uuid4().hex}.tmp"
+                with open(temporal, "wb") as f:
+                    f.write(datos)
+                os.replace(temporal, ruta)
+            except OSError as e:
+                logger.error(f"Error escribiendo caché disco '{self.nombre}': {e}")
+                self._stats["errors"] += 1
+                return
+            try:
+                self._escanear()
+            except OSError as e:
+                logger.error(f"Error recorriendo caché disco '{self.nombre}': {e}")
+                self._olvidar(clave)
+                self._indice[clave] = len(datos)
+                self._bytes += len(datos)
+            self._recortar()
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            consultas = self._stats["hits"] + self._stats["misses"]
+            return {
+                "entries": len(self._indice), "bytes": self._bytes, "max_bytes": self.max_bytes,
+                "hit_rate": round(self._stats["hits"] / consultas, 4) if consultas else 0.0, **self._stats
+            }
+
+# --- Búsqueda web (Google Custom Search): cliente async compartido, caché TTL y peticiones en vuelo compartidas ---
+GOOGLE_SEARCH_URL = os.getenv("GOOGLE_SEARCH_URL", "https://www.googleapis.com/customsearch/v1")
+SEARCH_TIMEOUT = _env_float("SEARCH_TIMEOUT", 10.0)
+SEARCH_MAX_CONNECTIONS = _env_int("SEARCH_MAX_CONNECTIONS", 20)
+SEARCH_CACHE_TTL = _env_float("SEARCH_CACHE_TTL", 6 * 3600.0)
+SEARCH_CACHE_MAX = _env_int("SEARCH_CACHE_MAX", 2000)
+SEARCH_NUM_RESULTS = 3
+SEARCH_MAX_RETRIES = max(1, _env_int("SEARCH_MAX_RETRIES", 2))
+SEARCH_HEDGE_DELAY = _env_float("SEARCH_HEDGE_DELAY", 0.0)  # s sin respuesta antes de lanzar una petición cubierta; 0 desactiva
+
+class ErrorBusqueda(Exception):
+    pass
+
+# Backend real. Cualquier objeto con `async buscar(query) -> list[dict]` (title/link/snippet) sirve como sustituto.
+class BackendGoogleSearch:
+    def __init__(self, api_key: str, cx: str, url: str = GOOGLE_SEARCH_URL):
+        self.api_key = api_key
+        self.cx = cx
+        self.url = url
+        self._http = None
+
+    def _cliente(self) -> "httpx.AsyncClient":
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                timeout=SEARCH_TIMEOUT,
+                limits=httpx.Limits(max_connections=SEARCH_MAX_CONNECTIONS, max_keepalive_connections=SEARCH_MAX_CONNECTIONS)
+            )
+        return self._http
+
+    async def _pedir(self, params: dict) -> "tuple[httpx.Response, dict]":
+        response = await self._cliente().get(self.url, params=params)
+        if _estado_http_transitorio(response.status_code):
+            response.raise_for_status()
+        return response, response.json()
+
+    async def buscar(self, query: str) -> list[dict]:
+        params = {"key": self.api_key, "cx": self.cx, "q": query, "num": SEARCH_NUM_RESULTS, "lr": "lang_es"}
+        try:
+            response, data = await con_reintentos(interruptor_busqueda, lambda: self._pedir(params), "Google Search", "search", SEARCH_MAX_RETRIES, SEARCH_HEDGE_DELAY)
+        except CircuitoAbierto as e:
+            raise ErrorBusqueda(f"Búsqueda web no disponible temporalmente ({e.retry_after}s).")
+        except httpx.TimeoutException:
+            raise ErrorBusqueda("Timeout búsqueda web.")
+        except httpx.HTTPStatusError as e:
+            raise ErrorBusqueda(f"Error búsqueda ({e.response.status_code}).")
+        except (httpx.RequestError, ValueError) as e:
+            logger.error(f"Error conexión búsqueda web: {e}")
+            raise ErrorBusqueda("Error conexión búsqueda web.")
+        if "error" in data:
+            error_details = data["error"].get("message", "?")
+            logger.error(f"Error Google Search API: {error_details}")
+            raise ErrorBusqueda(f"Error búsqueda: {error_details}")
+        if response.status_code >= 400:
+            raise ErrorBusqueda(f"Error búsqueda ({response.status_code}).")
+        return data.get("items", [])
+
+    async def cerrar(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+class MotorBusqueda:
+    def __init__(self, backend, cache: CacheTTL):
+        self.backend = backend
+        self.cache = cache
+        self._en_vuelo = {}  # consulta normalizada -> asyncio.Task compartida
+        self._stats = {"requests": 0, "coalesced": 0, "errors": 0}
+
+    @staticmethod
+    def normalizar(query: str) -> str:
+        sin_acentos = unicodedata.normalize("NFKD", query.lower())
+        sin_acentos = "".join(c for c in sin_acentos if not unicodedata.combining(c))
+        return re.sub(r"\s+", " ", re.sub(r"[^\w\s]", " ", sin_acentos)).strip()
+
+    async def _consultar(self, clave: str, query: str) -> list[dict]:
+        self._stats["requests"] += 1
+        try:
+            with metricas.medir("web_search"):
+                resultados = await self.backend.buscar(query)
+        except Exception:
+            self._stats["errors"] += 1
+            raise
+        self.cache.guardar(clave, resultados)
+        return resultados
+
+    def _fin_consulta(self, clave: str, tarea: asyncio.Task):
+        self._en_vuelo.pop(clave, None)
+        if not tarea.cancelled():
+            tarea.exception()  # Recuperada aunque todos los que esperaban se hayan cancelado
+
+    async def buscar(self, query: str) -> list[dict]:
+        clave = self.normalizar(query)
+        resultados = self.cache.obtener(clave)
+        if resultados is not None:
+            return resultados
+        tarea = self._en_vuelo.get(clave)
+        if tarea is not None:
+            self._stats["coalesced"] += 1
+        else:
+            # La petición vive en su propia tarea: cancelar a quien la lanzó no corta a los demás que la esperan
+            tarea = asyncio.create_task(self._consultar(clave, query))
+            self._en_vuelo[clave] = tarea
+            tarea.add_done_callback(lambda t: self._fin_consulta(clave, t))
+        return await asyncio.shield(tarea)
+
+    async def cerrar(self):
+        cerrar = getattr(self.backend, "cerrar", None)
+        if cerrar:
+            await cerrar()
+
+    def estadisticas(self) -> dict:
+        return {"backend": type(self.backend).__name__ if self.backend else None, "in_flight": len(self._en_vuelo), **self._stats, "cache": self.cache.estadisticas()}
+
+motor_busqueda = MotorBusqueda(
+    BackendGoogleSearch(GOOGLE_API_KEY, GOOGLE_CX) if SEARCH_CONFIGURED else None,
+    CacheTTL("busqueda_web", SEARCH_CACHE_TTL, SEARCH_CACHE_MAX)
+)
+
+def formatear_resultados_web(resultados: list[dict]) -> str:
+    texto_resultados = "<div class='google-results' style='margin-top:15px; padding-top:10px; border-top: 1px solid #eee;'><h4 style='font-size:0.9em;color:#555; margin-bottom: 5px;'>Resultados web relacionados:</h4><ul>"
+    for item in resultados:
+        title = item.get('title','?')
+        link = item.get('link','#')
+        snippet = item.get('snippet','')
+        if snippet:
+            snippet = re.sub('<.*?>', '', snippet).replace('\n',' ').strip()
+        else:
+            snippet = "No descripción."
+        texto_resultados += (f"<li style='margin-bottom: 10px; padding-left: 5px; border-left: 3px solid #ddd;'><a href='{link}' target='_blank' style='font-weight: bold; color: #1a0dab; text-decoration: none; display: block; margin-bottom: 2px;'>{htmlspecialchars(title)}</a><p style='font-size: 0.85em; margin: 0; color: #333;'>{htmlspecialchars(snippet)}</p><cite style='font-size: 0.8em; color: #006621; display: block; margin-top: 2px;'>{htmlspecialchars(link)}</cite></li>")
+    texto_resultados += "</ul></div>"
+    return texto_resultados
+
+async def buscar_google(query: str) -> str:
+    if motor_busqueda.backend is None:
+        logger.warning("buscar_google sin config.")
+        return "<p><i>[Búsqueda web no config.]</i></p>"
+    logger.info(f"Buscando Google Search: '{query}'")
+    try:
+        resultados = await motor_busqueda.buscar(query)
+    except ErrorBusqueda as e:
+        logger.error(f"Búsqueda web fallida: {e}")
+        return f"<p><i>[{htmlspecialchars(str(e))}]</i></p>"
+    except Exception as e:
+        logger.error(f"Error inesperado búsqueda web: {e}", exc_info=True)
+        return "<p><i>[Error inesperado búsqueda web.]</i></p>"
+    if not resultados:
+        logger.info("Búsqueda web sin resultados.")
+        return "<p><i>[No resultados web.]</i></p>"
+    logger.info(f"Búsqueda web OK: {len(resultados)} resultados.")
+    return formatear_resultados_web(resultados)
+
+# --- Conteo de tokens y empaquetado de contexto ---
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "cl100k_base")
+TOKEN_CACHE_SIZE = _env_int("TOKEN_CACHE_SIZE", 20000)
+# Sin el BPE (sin tiktoken o sin el fichero en TIKTOKEN_CACHE_DIR y sin red) el arranque falla salvo que se acepte
+# explícitamente la estimación por pre-tokens (TOKENIZER_FALLBACK=1); /stats y /metrics indican cuál se usa
+TOKENIZER_FALLBACK = os.getenv("TOKENIZER_FALLBACK", "false").strip().lower() in ("1", "true", "yes")
+# Pre-tokenización al estilo cl100k (letras / números de hasta 3 cifras / puntuación / espacios)
+_REGEX_PRETOKENS = re.compile(r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\w]?[^\W\d_]+|\d{1,3}| ?[^\s\w]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+""")
+_REGEX_FIN_FRASE = re.compile(r"[.!?…:;](?=\s)|\n")
+
+class ContadorTokens:
+    def __init__(self, encoding_name: str, cache_size: int):
+        self.encoding_name = encoding_name
+        self.cache_size = cache_size
+        self._encoding = None
+        self._cargado = False
+        self._cache = OrderedDict()  # blake2b(texto) -> nº tokens
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0}
+
+    def _codificador(self):
+        if not self._cargado:
+            self._cargado = True
+            if TIKTOKEN_AVAILABLE:
+                try:
+                    self._encoding = tiktoken.get_encoding(self.encoding_name)
+                    logger.info(f"Tokenizador BPE '{self.encoding_name}' cargado.")
+                except Exception as e:
+                    logger.error(f"No se pudo cargar BPE '{self.encoding_name}' ({type(e).__name__}). Usando estimación por pre-tokens (define TIKTOKEN_CACHE_DIR para uso offline).")
+            metricas.fijar("tokenizer_fallback", 1 if self._encoding is None else 0)
+        return self._encoding
+
+    @property
+    def estimado(self) -> bool:
+        return self._codificador() is None
+
+    # Al arrancar: sin BPE real solo se sigue si se ha aceptado la estimación
+    def verificar(self, permitir_estimacion: bool):
+        if not self.estimado:
+            return
+        if not permitir_estimacion:
+            raise RuntimeError(f"Tokenizador BPE '{self.encoding_name}' no disponible (instala tiktoken y pre-carga la codificación en TIKTOKEN_CACHE_DIR, o define TOKENIZER_FALLBACK=1 para usar la estimación).")
+        logger.error("Tokenizador en modo estimación (TOKENIZER_FALLBACK=1): los presupuestos de tokens son aproximados.")
+
+    @staticmethod
+    def _tokens_pieza(pieza: str) -> int:
+        return max(1, (len(pieza.strip()) + 3) // 4)
+
+    def _contar_sin_cache(self, texto: str) -> int:
+        codificador = self._codificador()
+        if codificador is not None:
+            return len(codificador.encode(texto, disallowed_special=()))
+        return sum(self._tokens_pieza(p) for p in _REGEX_PRETOKENS.findall(texto))
+
+    def contar(self, texto: str) -> int:
+        if not texto:
+            return 0
+        if len(texto) < 64:
+            return self._contar_sin_cache(texto)
+        clave = hashlib.blake2b(texto.encode("utf-8", "ignore"), digest_size=16).digest()
+        with self._lock:
+            if clave in self._cache:
+                self._cache.move_to_end(clave)
+                self._stats["hits"] += 1
+                return self._cache[clave]
+        tokens = self._contar_sin_cache(texto)
+        with self._lock:
+            self._stats["misses"] += 1
+            self._cache[clave] = tokens
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return tokens
+
+    # Recorta a max_tokens cortando en el último fin de frase (o palabra) disponible
+    def recortar(self, texto: str, max_tokens: int) -> str:
+        if max_tokens <= 0:
+            return ""
+        texto = texto[:max_tokens * 8]  # Ningún token ocupa más de ~8 chars de media: evita tokenizar lo que se descarta
+        if self.contar(texto) <= max_tokens:
+            return texto
+        codificador = self._codificador()
+        if codificador is not None:
+            recortado = codificador.decode(codificador.encode(texto, disallowed_special=())[:max_tokens])
+        else:
+            acumulado = 0
+            fin = 0
+            for m in _REGEX_PRETOKENS.finditer(texto):
+                acumulado += self._tokens_pieza(m.group())
+                if acumulado > max_tokens:
+                    break
+                fin = m.end()
+            recortado = texto[:fin]
+        cortes = [m.end() for m in _REGEX_FIN_FRASE.finditer(recortado)]
+        if cortes and cortes[-1] >= len(recortado) // 2:
+            return recortado[:cortes[-1]].rstrip()
+        espacio = recortado.rfind(" ")
+        return recortado[:espacio].rstrip() if espacio > len(recortado) // 2 else recortado
+
+    # Trocea en bloques consecutivos de como máximo max_tokens, cortando en fin de frase cuando se puede
+    def dividir(self, texto: str, max_tokens: int) -> list[str]:
+        bloques = []
+        resto = texto.strip()
+        while resto:
+            bloque = self.recortar(resto, max_tokens) or resto[:max_tokens * 4]
+            bloques.append(bloque)
+            resto = resto[len(bloque):].lstrip()
+        return bloques
+
+    def estadisticas(self) -> dict:
+        return {"encoding": self.encoding_name if self._encoding is not None else "estimado", "fallback": self._cargado and self._encoding is None, "cached": len(self._cache), **self._stats}
+
+metricas.definir("tokenizer_fallback", "gauge", "1 si el conteo de tokens usa la estimación por pre-tokens en lugar del BPE.")
+contador_tokens = ContadorTokens(TOKENIZER_ENCODING, TOKEN_CACHE_SIZE)
+
+def _shingles(texto: str, n: int = 3) -> set:
+    palabras = re.findall(r"\w+", texto.lower())
+    if len(palabras) < n:
+        return {" ".join(palabras)} if palabras else set()
+    return {" ".join(palabras[i:i + n]) for i in range(len(palabras) - n + 1)}
+
+class EmpaquetadorContexto:
+    def __init__(self, presupuesto_tokens: int, contador: ContadorTokens = contador_tokens, umbral_duplicado: float = 0.8, min_tokens_parcial: int = 150):
+        self.presupuesto = presupuesto_tokens
+        self.contador = contador
+        self.umbral_duplicado = umbral_duplicado
+        self.min_tokens_parcial = min_tokens_parcial
+        self.usados = 0
+        self.partes = []
+        self.incluidos = 0
+        self.duplicados = 0
+        self._huellas = []
+
+    @property
+    def restante(self) -> int:
+        return max(0, self.presupuesto - self.usados)
+
+    # Piezas fijas (mensaje, memoria): siempre entran, recortadas como mucho a max_tokens
+    def reservar(self, texto: str, max_tokens: int | None = None) -> str:
+        if not texto:
+            return texto
+        if max_tokens is not None and self.contador.contar(texto) > max_tokens:
+            texto = self.contador.recortar(texto, max_tokens)
+        self.usados += self.contador.contar(texto)
+        return texto
+
+    def _es_duplicado(self, texto: str) -> bool:
+        huella = _shingles(texto)
+        if not huella:
+            return True
+        for previa in self._huellas:
+            interseccion = len(huella & previa)
+            if interseccion and interseccion / len(huella | previa) >= self.umbral_duplicado:
+                return True
+        self._huellas.append(huella)
+        return False
+
+    # Pasajes ordenados por relevancia. Devuelve False cuando el presupuesto ya no admite más.
+    def añadir(self, cabecera: str, texto: str) -> bool:
+        if self.restante <= 0:
+            return False
+        if self._es_duplicado(texto):
+            self.duplicados += 1
+            return True
+        tokens_cabecera = self.contador.contar(cabecera)
+        tokens_texto = self.contador.contar(texto)
+        if tokens_cabecera + tokens_texto > self.restante:
+            disponibles = self.restante - tokens_cabecera
+            if disponibles < self.min_tokens_parcial:
+                return False
+            texto = self.contador.recortar(texto, disponibles) + " [...]"
+            tokens_texto = self.contador.contar(texto)
+        self.partes.append(cabecera)
+        self.partes.append(texto)
+        self.usados += tokens_cabecera + tokens_texto
+        self.incluidos += 1
+        return self.restante > 0
+
+# --- Capa OpenAI (async) compartida por /consulta y /analizar-documento ---
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4-turbo")
+OPENAI_TIMEOUT = _env_float("OPENAI_TIMEOUT", 90.0)  # Timeout (s) por llamada
+OPENAI_MAX_RETRIES = max(1, _env_int("OPENAI_MAX_RETRIES", 2))  # Intentos por llamada (espera entre ellos: RETRY_BASE_DELAY)
+
+# Respuesta vacía o sin contenido: error definitivo (no se reintenta ni cuenta para el interruptor)
+class RespuestaIAInvalida(Exception):
+    pass
+
+# --- Control de admisión de llamadas a OpenAI ---
+# Límite global de llamadas simultáneas; por encima, cola acotada con reparto round-robin entre tenants
+# (un tenant con 20 secciones en cola no deja sin turno a los demás). Cubos de tokens por tenant para
+# solicitudes/minuto y tokens estimados/minuto. Cola llena, espera excesiva o cubo vacío -> 429 + Retry-After.
+OPENAI_MAX_CONCURRENCY = _env_int("OPENAI_MAX_CONCURRENCY", 16)  # 0 desactiva el control de admisión
+ADMISSION_QUEUE_MAX = _env_int("ADMISSION_QUEUE_MAX", 200)  # Llamadas esperando turno (todos los tenants)
+ADMISSION_MAX_WAIT = _env_float("ADMISSION_MAX_WAIT", 30.0)  # Segundos máximos en cola antes de 429
+TENANT_RPM = _env_int("TENANT_RPM", 0)  # Solicitudes/minuto por tenant (ráfaga = RPM); 0 sin límite
+TENANT_TPM = _env_int("TENANT_TPM", 0)  # Tokens estimados/minuto por tenant (ráfaga = TPM); 0 sin límite
+
+class AdmisionRechazada(HTTPException):
+    def __init__(self, motivo: str, retry_after: float):
+        segundos = max(1, math.ceil(retry_after))
+        super().__init__(429, f"Demasiadas solicitudes ({motivo}). Inténtalo en {segundos}s.", headers={"Retry-After": str(segundos)})
+        self.motivo = motivo
+        self.retry_after = segundos
+
+class CuboTokens:
+    def __init__(self, capacidad: float, por_segundo: float):
+        self.capacidad = capacidad
+        self.por_segundo = por_segundo
+        self.nivel = capacidad
+        self._ultimo = time.monotonic()
+
+    # 0 si se consume; si no, segundos hasta que haya bastante (no consume nada)
+    def consumir(self, cantidad: float) -> float:
+        ahora = time.monotonic()
+        self.nivel = min(self.capacidad, self.nivel + (ahora - self._ultimo) * self.por_segundo)
+        self._ultimo = ahora
+        cantidad = min(cantidad, self.capacidad)  # Una petición mayor que el cubo pasa cuando está lleno
+        if self.nivel >= cantidad:
+            self.nivel -= cantidad
+            return 0.0
+        return (cantidad - self.nivel) / self.por_segundo
+
+    # Tokens consumidos por una llamada que al final no se hizo (rechazada o cancelada en la cola)
+    def devolver(self, cantidad: float):
+        self.nivel = min(self.capacidad, self.nivel + min(cantidad, self.capacidad))
+
+def estimar_tokens_mensajes(messages: list, max_tokens: int) -> int:
+    caracteres = 0
+    imagenes = 0
+    for mensaje in messages:
+        contenido = mensaje.get("content")
+        if isinstance(contenido, list):
+            for parte in contenido:
+                if parte.get("type") == "text":
+                    caracteres += len(parte.get("text", ""))
                 else:
-                    logger.info("Búsqueda web sin resultados/error.")
+                    imagenes += 1
+        elif contenido:
+            caracteres += len(contenido)
+    return caracteres // 4 + imagenes * 1000 + max_tokens
+
+class PermisoAdmision:
+    def __init__(self, control, tenant):
+        self._control = control
+        self.tenant = tenant
+        self.inicio = time.monotonic()
+        self._activo = True
+
+    def liberar(self):
+        if self._activo:
+            self._activo = False
+            self._control._liberar(time.monotonic() - self.inicio)
+
+class ControlAdmision:
+    def __init__(self, max_concurrencia: int, max_cola: int, espera_max: float, rpm: int, tpm: int):
+        self.max_concurrencia = max_concurrencia
+        self.max_cola = max_cola
+        self.espera_max = espera_max
+        self.rpm = rpm
+        self.tpm = tpm
+        self._en_curso = 0
+        self._esperando = 0
+        self._colas = {}  # tenant -> deque de futures esperando turno
+        self._turnos = deque()  # Tenants con llamadas en cola, en orden round-robin
+        self._cubos_peticiones = {}
+        self._cubos_tokens = {}
+        self._duracion_media = 5.0  # EWMA (s) de cada llamada, para estimar Retry-After
+        self._stats = {"admitted": 0, "queued": 0, "rejected": 0}
+        self._tenants = {}  # tenant -> {"admitted", "rejected", "wait_total_s", "wait_max_s"}
+
+    def _stats_tenant(self, tenant) -> dict:
+        if tenant not in self._tenants:
+            self._tenants[tenant] = {"admitted": 0, "rejected": 0, "wait_total_s": 0.0, "wait_max_s": 0.0}
+        return self._tenants[tenant]
+
+    def _rechazar(self, tenant, motivo: str, retry_after: float):
+        self._stats["rejected"] += 1
+        self._stats_tenant(tenant)["rejected"] += 1
+        metricas.incrementar("admission_rejected_total", tenant=tenant, reason=motivo)
+        logger.warning(f"Admisión OpenAI rechazada T={tenant} ({motivo}), Retry-After {retry_after:.1f}s.")
+        raise AdmisionRechazada(motivo, retry_after)
+
+    def _espera_estimada(self) -> float:
+        return self._duracion_media * (self._esperando + 1) / max(1, self.max_concurrencia)
+
+    # Una vez por solicitud de usuario que vaya a llamar a OpenAI
+    def comprobar_peticion(self, tenant_id: int | None):
+        tenant = str(tenant_id)
+        if self.rpm > 0:
+            cubo = self._cubos_peticiones.setdefault(tenant, CuboTokens(self.rpm, self.rpm / 60))
+            espera = cubo.consumir(1)
+            if espera:
+                self._rechazar(tenant, "rate", espera)
+        if self.max_concurrencia > 0 and self.max_cola >= 0 and self._esperando >= self.max_cola and self._en_curso >= self.max_concurrencia:
+            self._rechazar(tenant, "queue_full", self._espera_estimada())
+
+    async def adquirir(self, tenant_id: int | None, tokens: int) -> PermisoAdmision:
+        tenant = str(tenant_id)
+        hueco_libre = self.max_concurrencia <= 0 or (self._en_curso < self.max_concurrencia and not self._esperando)
+        # Cola llena antes de tocar el cubo de tokens: un rechazo no gasta presupuesto TPM del tenant
+        if not hueco_libre and self._esperando >= self.max_cola:
+            self._rechazar(tenant, "queue_full", self._espera_estimada())
+        cubo = None
+        if self.tpm > 0:
+            cubo = self._cubos_tokens.setdefault(tenant, CuboTokens(self.tpm, self.tpm / 60))
+            espera = cubo.consumir(tokens)
+            if espera:
+                self._rechazar(tenant, "tokens", espera)
+        inicio = time.monotonic()
+        if self.max_concurrencia <= 0:
+            pass
+        elif hueco_libre:
+            self._en_curso += 1
+        else:
+            turno = asyncio.get_running_loop().create_future()
+            cola = self._colas.get(tenant)
+            if cola is None:
+                cola = self._colas[tenant] = deque()
+                self._turnos.append(tenant)
+            cola.append(turno)
+            self._esperando += 1
+            self._stats["queued"] += 1
+            try:
+                await asyncio.wait_for(asyncio.shield(turno), self.espera_max)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if turno.done():
+                    self._liberar(0.0, medir=False)  # El turno llegó a la vez que el timeout/cancelación
+                else:
+                    turno.cancel()
+                    self._quitar_de_cola(tenant, turno)
+                if cubo is not None:
+                    cubo.devolver(tokens)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                self._rechazar(tenant, "timeout", self._espera_estimada())
+        espera = time.monotonic() - inicio
+        stats = self._stats_tenant(tenant)
+        stats["admitted"] += 1
+        stats["wait_total_s"] += espera
+        stats["wait_max_s"] = max(stats["wait_max_s"], espera)
+        self._stats["admitted"] += 1
+        metricas.observar("admission_queue_seconds", espera, tenant=tenant)
+        return PermisoAdmision(self, tenant)
+
+    @asynccontextmanager
+    async def turno(self, tenant_id: int | None, tokens: int):
+        permiso = await self.adquirir(tenant_id, tokens)
+        try:
+            yield permiso
+        finally:
+            permiso.liberar()
+
+    def _quitar_de_cola(self, tenant: str, turno: asyncio.Future):
+        cola = self._colas.get(tenant)
+        if cola is not None and turno in cola:
+            cola.remove(turno)
+            self._esperando -= 1
+            if not cola:
+                del self._colas[tenant]
+                self._turnos.remove(tenant)
+
+    # El hueco pasa directamente al siguiente tenant en turno (no se decrementa _en_curso si hay espera)
+    def _liberar(self, duracion: float, medir: bool = True):
+        if self.max_concurrencia <= 0:
+            return
+        if medir:
+            self._duracion_media = 0.9 * self._duracion_media + 0.1 * duracion
+        while self._turnos:
+            tenant = self._turnos.popleft()
+            cola = self._colas[tenant]
+            turno = cola.popleft()
+            self._esperando -= 1
+            if cola:
+                self._turnos.append(tenant)
             else:
-                logger.info("No requiere búsqueda web.")
+                del self._colas[tenant]
+            if not turno.done():
+                turno.set_result(True)
+                return
+        self._en_curso -= 1
+
+    def estadisticas(self) -> dict:
+        tenants = {
+            t: {"admitted": s["admitted"], "rejected": s["rejected"], "avg_wait_ms": round(s["wait_total_s"] / s["admitted"] * 1000, 1) if s["admitted"] else 0.0,
+                "max_wait_ms": round(s["wait_max_s"] * 1000, 1), "queued_now": len(self._colas.get(t, ()))}
+            for t, s in self._tenants.items()
+        }
+        return {"max_concurrency": self.max_concurrencia, "max_queue": self.max_cola, "max_wait_s": self.espera_max, "tenant_rpm": self.rpm,
+                "tenant_tpm": self.tpm, "in_flight": self._en_curso, "waiting": self._esperando, **self._stats, "tenants": tenants}
+
+control_admision = ControlAdmision(OPENAI_MAX_CONCURRENCY, ADMISSION_QUEUE_MAX, ADMISSION_MAX_WAIT, TENANT_RPM, TENANT_TPM)
+metricas.definir("admission_queue_seconds", "histogram", "Espera en la cola de admisión de OpenAI por tenant.")
+metricas.definir("admission_rejected_total", "counter", "Llamadas a OpenAI rechazadas con 429 por tenant y motivo (rate, tokens, queue_full, timeout).")
+
+async def llamar_openai(messages: list, temperature: float, max_tokens: int, etiqueta: str, tenant_id: int | None = None) -> tuple[str, str | None]:
+    async with control_admision.turno(tenant_id, estimar_tokens_mensajes(messages, max_tokens)):
+        return await _llamar_openai(messages, temperature, max_tokens, etiqueta)
+
+async def _llamar_openai(messages: list, temperature: float, max_tokens: int, etiqueta: str) -> tuple[str, str | None]:
+    intento = 0
+
+    async def llamada():
+        nonlocal intento
+        intento += 1
+        logger.info(f"Llamando OpenAI {etiqueta} (Intento {intento})...")
+        with metricas.medir("openai"):
+            respuesta = await client.chat.completions.create(model=OPENAI_MODEL, messages=messages, temperature=temperature, max_tokens=max_tokens, timeout=OPENAI_TIMEOUT)
+        registrar_uso_openai(respuesta.usage, "chat")
+        if not respuesta.choices or not respuesta.choices[0].message or not respuesta.choices[0].message.content:
+            logger.error(f"Respuesta OpenAI inválida {etiqueta}.")
+            raise RespuestaIAInvalida("Respuesta IA inválida.")
+        if respuesta.choices[0].finish_reason == 'length':
+            metricas.incrementar("openai_truncated_total", operation="chat")
+        return respuesta.choices[0].message.content.strip(), respuesta.choices[0].finish_reason
+
+    return await con_reintentos(interruptor_openai, llamada, f"OpenAI {etiqueta}", "chat", OPENAI_MAX_RETRIES)
+
+async def abrir_stream_openai(messages: list, temperature: float, max_tokens: int, etiqueta: str):
+    logger.info(f"Llamando OpenAI stream {etiqueta}...")
+    # include_usage: el último chunk trae usage (sin choices)
+    return await con_reintentos(
+        interruptor_openai,
+        lambda: client.chat.completions.create(model=OPENAI_MODEL, messages=messages, temperature=temperature, max_tokens=max_tokens, timeout=OPENAI_TIMEOUT, stream=True, stream_options={"include_usage": True}),
+        f"OpenAI stream {etiqueta}", "chat_stream", OPENAI_MAX_RETRIES
+    )
+
+# --- Almacenamiento RAG por fragmentos (chunks) ---
+RAG_CHUNK_SIZE = max(200, _env_int("RAG_CHUNK_SIZE", 1500))  # Caracteres por fragmento
+RAG_CHUNK_OVERLAP = min(_env_int("RAG_CHUNK_OVERLAP", 200), RAG_CHUNK_SIZE // 2)
+RAG_TOP_CHUNKS = max(1, _env_int("RAG_TOP_CHUNKS", 8))
+
+# El esquema RAG se crea con migraciones/001_rag_chunks.sql (DDL sobre la tabla compartida con PHP, una sola vez).
+# Al arrancar solo se comprueba que existen las columnas, sin bloqueos ni permisos DDL.
+COLUMNAS_ESQUEMA_RAG = {
+    "user_document_chunks": ("id", "document_id", "user_id", "tenant_id", "chunk_index", "content", "fts_vector", "embedding", "embedding_model"),
+    "user_documents": ("content_sha256", "content_extractor"),
+}
+MIGRACION_RAG = "migraciones/001_rag_chunks.sql"
+
+def comprobar_esquema_rag() -> list[str]:
+    conn = get_db_connection()
+    if not conn:
+        logger.warning("Sin conexión BD: no se verificó el esquema de chunks RAG.")
+        return []
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT table_name, column_name FROM information_schema.columns
+                WHERE table_schema = current_schema() AND table_name = ANY(%s)
+            """, (list(COLUMNAS_ESQUEMA_RAG),))
+            existentes = {(fila[0], fila[1]) for fila in cursor.fetchall()}
+        conn.rollback()
+    except psycopg2.Error as e:
+        logger.error(f"Error comprobando esquema de chunks RAG: {e}", exc_info=True)
+        conn.rollback()
+        return []
+    finally:
+        release_db_connection(conn)
+    faltan = [f"{tabla}.{columna}" for tabla, columnas in COLUMNAS_ESQUEMA_RAG.items() for columna in columnas if (tabla, columna) not in existentes]
+    if faltan:
+        logger.error(f"Esquema RAG incompleto (faltan {', '.join(faltan)}). Aplica {MIGRACION_RAG}.")
+    else:
+        logger.info("Esquema de chunks RAG verificado.")
+    return faltan
+
+# Corta en ventanas de ~tam caracteres solapadas, retrocediendo al último párrafo/frase dentro de la ventana.
+# Con final=False se detiene antes de la última ventana incompleta y devuelve dónde continuar.
+def _trocear(texto: str, tam: int, solapamiento: int, final: bool) -> tuple[list[str], int]:
+    chunks = []
+    longitud = len(texto)
+    inicio = 0
+    while inicio < longitud:
+        if not final and inicio + tam >= longitud:
             break
-         except APIError as e:
-            logger.error(f"Error API OpenAI /consulta (Intento {attempt + 1}): {e}", exc_info=True)
-            texto_respuesta_final = f"<p><i>Error IA: {e.message}.</i></p>"
-            time.sleep(0.5)
-         except Exception as e:
-            logger.error(f"Error /consulta (Intento {attempt + 1}): {e}", exc_info=True)
-            texto_respuesta_final = "<p><i>Error interno consulta.</i></p>"
-            time.sleep(0.5)
-    if DB_CONFIGURED:
-        conn_hist = get_db_connection()
-        if conn_hist:
+        fin = min(inicio + tam, longitud)
+        if fin < longitud:
+            minimo = inicio + int(tam * 0.6)
+            for separador in ("\n\n", "\n", ". ", " "):
+                corte = texto.rfind(separador, minimo, fin)
+                if corte != -1:
+                    fin = corte + len(separador)
+                    break
+        chunk = texto[inicio:fin].strip()
+        if chunk:
+            chunks.append(chunk)
+        if fin >= longitud:
+            inicio = longitud
+            break
+        siguiente = fin - solapamiento
+        if siguiente > inicio:
+            espacio = texto.find(" ", siguiente, fin)
+            inicio = espacio + 1 if espacio != -1 else siguiente
+        else:
+            inicio = fin
+    return chunks, inicio
+
+# Acepta un texto o un iterable de segmentos (páginas, párrafos); el búfer nunca supera unas pocas ventanas
+def iterar_chunks(segmentos, tam: int = RAG_CHUNK_SIZE, solapamiento: int = RAG_CHUNK_OVERLAP):
+    if isinstance(segmentos, str):
+        segmentos = (segmentos,)
+    buffer = ""
+    pendientes = []
+    longitud_pendiente = 0
+    for segmento in segmentos:
+        pendientes.append(segmento)
+        longitud_pendiente += len(segmento)
+        if longitud_pendiente >= tam * 4:
+            buffer += "".join(pendientes)
+            pendientes = []
+            longitud_pendiente = 0
+            chunks, inicio = _trocear(buffer, tam, solapamiento, final=False)
+            yield from chunks
+            buffer = buffer[inicio:]
+    buffer += "".join(pendientes)
+    chunks, _ = _trocear(buffer, tam, solapamiento, final=True)
+    yield from chunks
+
+def dividir_en_chunks(texto, tam: int = RAG_CHUNK_SIZE, solapamiento: int = RAG_CHUNK_OVERLAP) -> list[str]:
+    return list(iterar_chunks(texto, tam, solapamiento))
+
+def texto_indexable(texto: str | None) -> bool:
+    if not texto or not texto.strip():
+        return False
+    return not (texto.startswith("[Error") or texto.startswith("[Archivo vacío") or texto.startswith("[Archivo sin texto") or texto.startswith("[Extracción no soportada"))
+
+# Sustituye los chunks del documento dentro de la transacción del cursor recibido
+def guardar_chunks_documento(cursor, doc_id: int, user_id: int, tenant_id: int, chunks: list[str], embeddings=None) -> int:
+    cursor.execute("DELETE FROM user_document_chunks WHERE document_id = %s", (doc_id,))
+    if not chunks:
+        return 0
+    modelo = embedder.nombre if embeddings is not None else None
+    filas = [
+        (doc_id, user_id, tenant_id, i, chunk, psycopg2.Binary(embeddings[i].tobytes()) if embeddings is not None else None, modelo)
+        for i, chunk in enumerate(chunks)
+    ]
+    psycopg2.extras.execute_values(
+        cursor,
+        "INSERT INTO user_document_chunks (document_id, user_id, tenant_id, chunk_index, content, embedding, embedding_model) VALUES %s",
+        filas, page_size=500
+    )
+    return len(filas)
+
+# --- Deduplicación por contenido ---
+dedup_stats = {"hits": 0, "misses": 0, "bytes_saved": 0}
+
+# Si el tenant ya tiene procesado un documento con el mismo SHA-256, copia su texto y chunks (con embeddings) en BD
+# sin volver a extraer. Devuelve (id origen, nº chunks) o None si no hay duplicado válido.
+def reutilizar_documento_duplicado(doc_id: int, user_id: int, tenant_id: int, sha256: str, extractor: str) -> tuple[int, int] | None:
+    conn = get_db_connection()
+    if not conn:
+        raise ConnectionError("No se pudo conectar a BD para buscar duplicados.")
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT id FROM user_documents
+                WHERE tenant_id = %s AND content_sha256 = %s AND content_extractor = %s AND procesado = TRUE AND id <> %s
+                  AND extracted_text IS NOT NULL AND extracted_text NOT LIKE '[Error%%'
+                ORDER BY id LIMIT 1
+            """, (tenant_id, sha256, extractor, doc_id))
+            fila = cursor.fetchone()
+            if not fila:
+                return None
+            origen_id = fila[0]
+            cursor.execute("""
+                UPDATE user_documents AS d
+                SET extracted_text = o.extracted_text, procesado = TRUE, content_sha256 = %s, content_extractor = %s
+                FROM user_documents AS o
+                WHERE d.id = %s AND d.user_id = %s AND d.tenant_id = %s AND o.id = %s
+            """, (sha256, extractor, doc_id, user_id, tenant_id, origen_id))
+            if cursor.rowcount == 0:
+                conn.rollback()
+                return None
+            cursor.execute("DELETE FROM user_document_chunks WHERE document_id = %s", (doc_id,))
+            cursor.execute("""
+                INSERT INTO user_document_chunks (document_id, user_id, tenant_id, chunk_index, content, embedding, embedding_model)
+                SELECT %s, %s, %s, chunk_index, content, embedding, embedding_model
+                FROM user_document_chunks WHERE document_id = %s
+            """, (doc_id, user_id, tenant_id, origen_id))
+            num_chunks = cursor.rowcount
+        conn.commit()
+        return origen_id, num_chunks
+    except psycopg2.Error:
+        conn.rollback()
+        raise
+    finally:
+        release_db_connection(conn)
+
+# --- Recuperación vectorial (embeddings) ---
+EMBEDDER = os.getenv("EMBEDDER", "local").lower()  # local | openai
+EMBEDDING_DIM = _env_int("EMBEDDING_DIM", 384)  # Solo embedder local
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")  # Solo embedder openai
+EMBEDDING_BATCH = max(1, _env_int("EMBEDDING_BATCH", 256))
+RAG_VECTOR_TOP_K = max(1, _env_int("RAG_VECTOR_TOP_K", 16))
+RAG_RRF_K = _env_int("RAG_RRF_K", 60)
+VECTOR_INDEX_MAX_BYTES = _env_int("VECTOR_INDEX_MAX_BYTES", 256 * 1024 * 1024)
+
+# Determinista y sin red: hashing de palabras y 4-gramas de caracteres (sin acentos) con signo, log-tf y norma L2
+class EmbedderLocal:
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.nombre = f"local-hash-{dim}"
+
+    def _rasgos(self, texto: str) -> list[str]:
+        normal = unicodedata.normalize("NFKD", texto.lower())
+        normal = "".join(c for c in normal if not unicodedata.combining(c))
+        palabras = re.findall(r"\w+", normal)
+        return palabras + [f"#{p[i:i + 4]}" for p in palabras if len(p) > 4 for i in range(len(p) - 3)]
+
+    def embeber_sync(self, textos: list[str]) -> "np.ndarray":
+        matriz = np.zeros((len(textos), self.dim), dtype=np.float32)
+        for fila, texto in enumerate(textos):
+            for rasgo in self._rasgos(texto):
+                h = zlib.crc32(rasgo.encode("utf-8"))
+                matriz[fila, h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        matriz = np.sign(matriz) * np.log1p(np.abs(matriz))
+        normas = np.linalg.norm(matriz, axis=1, keepdims=True)
+        normas[normas == 0] = 1.0
+        return matriz / normas
+
+    async def embeber(self, textos: list[str]) -> "np.ndarray":
+        return await asyncio.to_thread(self.embeber_sync, textos)
+
+class EmbedderOpenAI:
+    def __init__(self, modelo: str):
+        self.modelo = modelo
+        self.nombre = f"openai-{modelo}"
+
+    async def embeber(self, textos: list[str]) -> "np.ndarray":
+        vectores = []
+        for i in range(0, len(textos), EMBEDDING_BATCH):
+            lote = textos[i:i + EMBEDDING_BATCH]
+            respuesta = await con_reintentos(interruptor_openai, lambda: client.embeddings.create(model=self.modelo, input=lote, timeout=OPENAI_TIMEOUT), f"embeddings OpenAI ({len(lote)} textos)", "embeddings", OPENAI_MAX_RETRIES)
+            registrar_uso_openai(respuesta.usage, "embeddings")
+            vectores.extend(item.embedding for item in sorted(respuesta.data, key=lambda d: d.index))
+        matriz = np.asarray(vectores, dtype=np.float32)
+        normas = np.linalg.norm(matriz, axis=1, keepdims=True)
+        normas[normas == 0] = 1.0
+        return matriz / normas
+
+embedder = EmbedderOpenAI(EMBEDDING_MODEL) if EMBEDDER == "openai" and client else EmbedderLocal(EMBEDDING_DIM)
+
+async def calcular_embeddings(textos: list[str], etiqueta: str):
+    if not textos:
+        return None
+    try:
+        return await embedder.embeber(textos)
+    except Exception as e:
+        # Sin embeddings el documento sigue siendo recuperable por FTS
+        logger.error(f"Error calculando embeddings ({embedder.nombre}) para {etiqueta}: {e}", exc_info=True)
+        return None
+
+# Matriz (n, dim) de los chunks activos de un usuario; se recarga cuando cambia el sello de documentos
+class IndiceVectorial:
+    def __init__(self, version: str, chunk_ids: "np.ndarray", matriz: "np.ndarray"):
+        self.version = version
+        self.chunk_ids = chunk_ids
+        self.matriz = matriz
+
+    @property
+    def nbytes(self) -> int:
+        return self.matriz.nbytes + self.chunk_ids.nbytes
+
+    def buscar(self, vector: "np.ndarray", k: int) -> list[tuple[int, float]]:
+        if not len(self.chunk_ids):
+            return []
+        puntuaciones = self.matriz @ vector
+        k = min(k, len(puntuaciones))
+        mejores = np.argpartition(-puntuaciones, k - 1)[:k]
+        mejores = mejores[np.argsort(-puntuaciones[mejores])]
+        return [(int(self.chunk_ids[i]), float(puntuaciones[i])) for i in mejores]
+
+indices_vectoriales = CacheTTL("vector_index", 24 * 3600.0, 10000, VECTOR_INDEX_MAX_BYTES)
+
+def cargar_indice_vectorial(cursor, user_id: int, tenant_id: int, version: str) -> IndiceVectorial:
+    clave = (tenant_id, user_id, embedder.nombre)
+    indice = indices_vectoriales.obtener(clave)
+    if indice is not None and indice.version == version:
+        return indice
+    cursor.execute("""
+        SELECT c.id, c.embedding FROM user_document_chunks c
+        JOIN user_documents d ON d.id = c.document_id
+        WHERE c.user_id = %s AND c.tenant_id = %s AND d.is_active_for_ai = TRUE AND d.procesado = TRUE
+          AND c.embedding IS NOT NULL AND c.embedding_model = %s
+    """, (user_id, tenant_id, embedder.nombre))
+    filas = cursor.fetchall()
+    dim = None
+    ids = []
+    vectores = []
+    for fila in filas:
+        vector = np.frombuffer(bytes(fila[1]), dtype=np.float32)
+        dim = dim or len(vector)
+        if len(vector) == dim:
+            ids.append(fila[0])
+            vectores.append(vector)
+    matriz = np.vstack(vectores) if vectores else np.zeros((0, dim or 1), dtype=np.float32)
+    indice = IndiceVectorial(version, np.asarray(ids, dtype=np.int64), matriz)
+    indices_vectoriales.guardar(clave, indice, etiquetas=(("tenant", tenant_id),))
+    logger.info(f"Índice vectorial cargado U={user_id}/T={tenant_id}: {len(ids)} chunks ({indice.nbytes / 1024:.0f} KB).")
+    return indice
+
+# Reciprocal Rank Fusion de las listas ordenadas (FTS y vectorial)
+def fusionar_rrf(*rankings: list, k: int = RAG_RRF_K) -> list[tuple]:
+    puntuaciones = {}
+    for ranking in rankings:
+        for posicion, clave in enumerate(ranking):
+            puntuaciones[clave] = puntuaciones.get(clave, 0.0) + 1.0 / (k + posicion + 1)
+    return sorted(puntuaciones.items(), key=lambda item: item[1], reverse=True)
+
+def _error_config_procesado() -> str | None:
+    if DB_CONFIGURED and PHP_BRIDGE_CONFIGURED:
+        return None
+    error_msg = "Configuración incompleta en el backend para procesar documentos."
+    if not DB_CONFIGURED:
+        error_msg += " (Falta config BD)"
+    if not PHP_BRIDGE_CONFIGURED:
+        error_msg += " (Falta config PHP Bridge)"
+    return error_msg
+
+def leer_info_documento(doc_id: int, user_id: int, tenant_id: int) -> dict | None:
+    conn = get_db_connection()
+    if not conn:
+        raise ConnectionError("No se pudo conectar a BD para obtener info del documento.")
+    try:
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            sql_select = """
+                SELECT original_filename, file_type, stored_path, procesado
+                FROM user_documents
+                WHERE id = %s AND user_id = %s AND tenant_id = %s
+            """
+            cursor.execute(sql_select, (doc_id, user_id, tenant_id))
+            doc_info = cursor.fetchone()
+            return dict(doc_info) if doc_info else None
+    finally:
+        release_db_connection(conn)
+
+def guardar_documento_procesado(doc_id: int, user_id: int, tenant_id: int, texto: str, content_sha256: str | None, extractor: str | None, chunks: list[str], embeddings) -> tuple[int, int]:
+    conn = get_db_connection()
+    if not conn:
+        raise ConnectionError("No se pudo reconectar a BD para actualizar.")
+    try:
+        with conn.cursor() as cursor:
+            sql_update = """
+                UPDATE user_documents
+                SET extracted_text = %s, procesado = TRUE, content_sha256 = %s, content_extractor = %s
+                WHERE id = %s AND user_id = %s AND tenant_id = %s
+            """
+            cursor.execute(sql_update, (texto, content_sha256, extractor, doc_id, user_id, tenant_id))
+            rows_affected = cursor.rowcount
+            num_chunks = 0
+            if rows_affected > 0:
+                num_chunks = guardar_chunks_documento(cursor, doc_id, user_id, tenant_id, chunks, embeddings)
+        conn.commit()
+        return rows_affected, num_chunks
+    except psycopg2.Error:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        release_db_connection(conn)
+
+# --- Descarga de documentos desde el PHP Bridge (streaming async, conexiones reutilizadas) ---
+PHP_TIMEOUT = _env_float("PHP_TIMEOUT", 120.0)
+PHP_MAX_CONNECTIONS = _env_int("PHP_MAX_CONNECTIONS", 20)
+PHP_READ_CHUNK = 64 * 1024
+PHP_MAX_RETRIES = max(1, _env_int("PHP_MAX_RETRIES", 2))
+
+class ClientePHPBridge:
+    def __init__(self):
+        self._http = None
+        self._stats = {"downloads": 0, "bytes": 0, "errors": 0}
+
+    def _cliente(self) -> "httpx.AsyncClient":
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                timeout=httpx.Timeout(PHP_TIMEOUT, connect=10.0),
+                limits=httpx.Limits(max_connections=PHP_MAX_CONNECTIONS, max_keepalive_connections=PHP_MAX_CONNECTIONS)
+            )
+        return self._http
+
+    async def _abrir(self, params: dict) -> "httpx.Response":
+        cliente = self._cliente()
+        response = await cliente.send(cliente.build_request("GET", PHP_FILE_SERVE_URL, params=params), stream=True)
+        try:
+            response.raise_for_status()
+        except httpx.HTTPStatusError:
+            await response.aclose()
+            raise
+        return response
+
+    # Vuelca el archivo en destino (BufferArchivo) a medida que llega; los bloques que van a disco se escriben en un hilo.
+    # Solo se reintenta hasta recibir las cabeceras: con bytes ya escritos en destino la descarga no se repite.
+    async def descargar(self, doc_id: int, user_id: int, tenant_id: int, destino) -> int:
+        params = {"doc_id": doc_id, "user_id": user_id, "tenant_id": tenant_id, "api_key": PHP_API_SECRET_KEY}
+        logger.info(f"Solicitando doc ID {doc_id} a PHP. URL: {PHP_FILE_SERVE_URL}?doc_id={doc_id}&user_id={user_id}&tenant_id={tenant_id}")
+        self._stats["downloads"] += 1
+        try:
+            with metricas.medir("php_descarga"):
+                response = await con_reintentos(interruptor_php, lambda: self._abrir(params), f"PHP Bridge doc {doc_id}", "download", PHP_MAX_RETRIES)
+                try:
+                    logger.info(f"Respuesta recibida de PHP Bridge (Status: {response.status_code}).")
+                    async for bloque in response.aiter_bytes(PHP_READ_CHUNK):
+                        metricas.incrementar("php_bridge_bytes_total", len(bloque))
+                        if destino.en_disco:
+                            await asyncio.to_thread(destino.write, bloque)
+                        else:
+                            destino.write(bloque)
+                except httpx.TransportError as e:
+                    interruptor_php.fallo(e)
+                    raise
+                finally:
+                    await response.aclose()
+        except (httpx.HTTPError, CircuitoAbierto):
+            self._stats["errors"] += 1
+            raise
+        self._stats["bytes"] += destino.tamaño
+        return destino.tamaño
+
+    async def cerrar(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    def estadisticas(self) -> dict:
+        return dict(self._stats)
+
+cliente_php = ClientePHPBridge()
+
+# BD en hilos, descarga async y extracción en el pool de procesos: nada de esto bloquea el event loop
+async def procesar_documento(doc_id: int, current_user_id: int, current_tenant_id: int) -> ProcessResponse:
+    logger.info(f"Procesar doc ID: {doc_id} user: {current_user_id} tenant: {current_tenant_id}")
+    original_fname = None
+    try:
+        doc_info = await asyncio.to_thread(leer_info_documento, doc_id, current_user_id, current_tenant_id)
+        if not doc_info:
+            logger.warning(f"Documento ID {doc_id} no encontrado para User {current_user_id}/Tenant {current_tenant_id}.")
+            raise FileNotFoundError(f"Documento ID {doc_id} no encontrado para este usuario/tenant.")
+        original_fname = doc_info['original_filename']
+        if doc_info['procesado']:
+            logger.info(f"Documento {doc_id} ('{original_fname}') ya estaba marcado como procesado. Omitiendo.")
+            return ProcessResponse(success=True, message="El documento ya estaba procesado.")
+        file_ext = os.path.splitext(original_fname)[1].lower().strip('.') if original_fname else ''
+        extracted_text = None
+        chunks = None
+        content_sha256 = None
+        extractor = None
+        TEXT_EXTENSIONS_PROC = ["pdf", "doc", "docx", "txt", "csv"]
+        if file_ext in TEXT_EXTENSIONS_PROC:
+            with BufferArchivo(f'.{file_ext}') as archivo:
+                try:
+                    await cliente_php.descargar(doc_id, current_user_id, current_tenant_id, archivo)
+                    logger.info(f"Recibidos {archivo.tamaño} bytes de PHP Bridge para doc {doc_id}.")
+                except (httpx.HTTPError, CircuitoAbierto):
+                    raise
+                except Exception as write_err:
+                    logger.error(f"Error guardando archivo recibido para doc {doc_id}: {write_err}", exc_info=True)
+                    raise IOError(f"No se pudo guardar el archivo recibido para {original_fname}")
+                if archivo.tamaño == 0:
+                    logger.warning(f"Archivo recibido de PHP Bridge para doc {doc_id} vacío.")
+                    extracted_text = "[Archivo vacío recibido]"
+                else:
+                    content_sha256 = archivo.sha256
+                    extractor = version_extractor(file_ext)
+                    with metricas.medir("dedup"):
+                        reutilizado = await asyncio.to_thread(reutilizar_documento_duplicado, doc_id, current_user_id, current_tenant_id, content_sha256, extractor)
+                    if reutilizado:
+                        origen_id, num_chunks = reutilizado
+                        dedup_stats["hits"] += 1
+                        dedup_stats["bytes_saved"] += archivo.tamaño
+                        logger.info(f"Doc {doc_id} idéntico (SHA-256 {content_sha256[:12]}) al doc {origen_id} del tenant {current_tenant_id}: reutilizados texto y {num_chunks} chunks.")
+                        invalidar_cache_consulta(current_tenant_id, current_user_id)
+                        return ProcessResponse(success=True, message=f"Documento procesado (contenido reutilizado del documento {origen_id}).", reused_from=origen_id)
+                    dedup_stats["misses"] += 1
+                    extracted_text, chunks = await extraer_texto_y_chunks_async(archivo.origen(), file_ext, MAX_TEXT_LENGTH)
+                    logger.info(f"Texto extraído (longitud: {len(extracted_text) if extracted_text else 0} caracteres)")
+        else:
+            logger.warning(f"Extracción no soportada para extensión '{file_ext}' (Doc: {doc_id}, File: '{original_fname}')")
+            extracted_text = f"[Extracción no soportada para tipo: {file_ext}]"
+        if extracted_text is None or not extracted_text.strip() or extracted_text.strip().startswith("[Error"):
+            if extracted_text is None:
+                extracted_text = "[Error: Extracción devolvió None]"
+            if not extracted_text.strip():
+                extracted_text = "[Archivo vacío o sin texto extraíble]"
+            logger.error(f"Extracción de texto fallida o vacía para doc {doc_id}. Texto guardado en BD: '{extracted_text[:100]}...'")
+        if len(extracted_text) > MAX_TEXT_LENGTH:
+             logger.warning(f"Texto extraído truncado a {MAX_TEXT_LENGTH} caracteres para BD (doc {doc_id}). Longitud original: {len(extracted_text)}")
+             extracted_text_to_save = extracted_text[:MAX_TEXT_LENGTH]
+        else:
+             extracted_text_to_save = extracted_text
+        if chunks is None or len(extracted_text_to_save) < len(extracted_text):
+            chunks = await asyncio.to_thread(dividir_en_chunks, extracted_text_to_save) if texto_indexable(extracted_text_to_save) else []
+        with metricas.medir("embeddings_documento"):
+            embeddings = await calcular_embeddings(chunks, f"doc {doc_id}")
+        logger.info(f"Actualizando BD doc ID {doc_id} tenant {current_tenant_id}...")
+        with metricas.medir("bd_guardado"):
+            rows_affected, num_chunks = await asyncio.to_thread(guardar_documento_procesado, doc_id, current_user_id, current_tenant_id, extracted_text_to_save, content_sha256, extractor, chunks, embeddings)
+        if rows_affected == 0:
+            logger.warning(f"UPDATE no afectó filas para doc {doc_id}/tenant {current_tenant_id}")
+        else:
+            logger.info(f"BD actualizada doc ID {doc_id} ({rows_affected} fila, {num_chunks} chunks).")
+            invalidar_cache_consulta(current_tenant_id, current_user_id)
+        return ProcessResponse(success=True, message="Documento procesado.")
+    except FileNotFoundError as e:
+        logger.error(f"Error FNF procesando doc {doc_id}: {e}")
+        return ProcessResponse(success=False, error=str(e))
+    except ConnectionError as e:
+        logger.error(f"Error de Conexión BD procesando doc {doc_id}: {e}")
+        return ProcessResponse(success=False, error="Error de conexión con la base de datos.")
+    except httpx.HTTPError as e:
+        logger.error(f"Error PHP Bridge en doc {doc_id}: {e}", exc_info=True)
+        status_code = e.response.status_code if isinstance(e, httpx.HTTPStatusError) else 'N/A'
+        return ProcessResponse(success=False, error=f"Error al obtener el archivo ({status_code}).")
+    except CircuitoAbierto as e:
+        logger.error(f"PHP Bridge no disponible para doc {doc_id}: {e.detail}")
+        return ProcessResponse(success=False, error=e.detail)
+    except IOError as e:
+         logger.error(f"Error de I/O con archivo recibido para doc {doc_id}: {e}", exc_info=True)
+         return ProcessResponse(success=False, error=f"Error al manejar archivo recibido: {e}")
+    except (psycopg2.Error) as db_err:
+        logger.error(f"Error de Base de Datos (Update) procesando doc {doc_id}: {db_err}", exc_info=True)
+        return ProcessResponse(success=False, error="Error de base de datos durante actualización.")
+    except Exception as e:
+        logger.error(f"Error general inesperado procesando doc {doc_id}: {e}", exc_info=True)
+        return ProcessResponse(success=False, error=f"Error interno del servidor ({type(e).__name__}).")
+
+# --- Cola de ingesta de documentos ---
+INGEST_WORKERS = max(1, _env_int("INGEST_WORKERS", 2))
+INGEST_QUEUE_MAX = _env_int("INGEST_QUEUE_MAX", 1000)
+INGEST_JOBS_RETENTION = _env_int("INGEST_JOBS_RETENTION", 5000)  # Trabajos terminados que se conservan para consulta
+
+class ColaIngesta:
+    def __init__(self, workers: int, max_cola: int, retencion: int):
+        self.workers = workers
+        self.max_cola = max_cola
+        self.retencion = retencion
+        self._cola = None
+        self._tareas = []
+        self._trabajos = OrderedDict()  # job_id -> dict
+        self._activos = {}  # (doc_id, user_id, tenant_id) -> job_id en cola o en curso
+        self._fin = {}  # job_id -> asyncio.Event que se marca al terminar (llamadas síncronas)
+        self._stats = {"enqueued": 0, "done": 0, "failed": 0, "rejected": 0}
+
+    async def iniciar(self):
+        if self._tareas:
+            return
+        self._cola = asyncio.Queue(maxsize=self.max_cola)
+        self._tareas = [asyncio.create_task(self._worker(n)) for n in range(self.workers)]
+        logger.info(f"Cola de ingesta iniciada ({self.workers} workers, máx. {self.max_cola} en cola).")
+
+    async def detener(self):
+        for tarea in self._tareas:
+            tarea.cancel()
+        await asyncio.gather(*self._tareas, return_exceptions=True)
+        self._tareas = []
+        pendientes = self._cola.qsize() if self._cola else 0
+        if pendientes:
+            logger.warning(f"Cola de ingesta detenida con {pendientes} trabajos sin procesar (siguen con procesado=FALSE en BD).")
+
+    def huecos_libres(self) -> int:
+        if self._cola is None:
+            return 0
+        return self.max_cola - self._cola.qsize() if self.max_cola > 0 else 1 << 30
+
+    def encolar(self, doc_id: int, user_id: int, tenant_id: int) -> dict | None:
+        clave = (doc_id, user_id, tenant_id)
+        job_id = self._activos.get(clave)
+        if job_id and job_id in self._trabajos:
+            return self._trabajos[job_id]
+        if self._cola is None:
+            logger.error("Cola de ingesta no iniciada.")
+            return None
+        trabajo = {
+            "job_id": uuid.uuid4().hex, "doc_id": doc_id, "user_id": user_id, "tenant_id": tenant_id,
+            "status": "queued", "message": None, "error": None, "reused_from": None,
+            "created_at": time.time(), "started_at": None, "finished_at": None
+        }
+        try:
+            self._cola.put_nowait(trabajo["job_id"])
+        except asyncio.QueueFull:
+            self._stats["rejected"] += 1
+            logger.error(f"Cola de ingesta llena ({self.max_cola}). Doc {doc_id} rechazado.")
+            return None
+        self._trabajos[trabajo["job_id"]] = trabajo
+        self._activos[clave] = trabajo["job_id"]
+        self._fin[trabajo["job_id"]] = asyncio.Event()
+        self._stats["enqueued"] += 1
+        self._purgar()
+        logger.info(f"Doc {doc_id} encolado (job {trabajo['job_id']}, en cola: {self._cola.qsize()}).")
+        return trabajo
+
+    def estado(self, job_id: str) -> dict | None:
+        return self._trabajos.get(job_id)
+
+    async def esperar(self, job_id: str) -> dict | None:
+        fin = self._fin.get(job_id)
+        if fin is not None:
+            await fin.wait()
+        return self._trabajos.get(job_id)
+
+    def _purgar(self):
+        exceso = len(self._trabajos) - self.retencion
+        if exceso <= 0:
+            return
+        for job_id in [j for j, t in self._trabajos.items() if t["status"] in ("done", "failed")][:exceso]:
+            del self._trabajos[job_id]
+
+    async def _worker(self, n: int):
+        while True:
+            job_id = await self._cola.get()
+            trabajo = self._trabajos.get(job_id)
             try:
-                with conn_hist.cursor() as cursor:
-                    cursor.execute("INSERT INTO historial (usuario_id, tenant_id, pregunta, respuesta, fecha_hora) VALUES (%s, %s, %s, %s, NOW())", (current_user_id, current_tenant_id, mensaje_usuario, texto_respuesta_final))
-                    conn_hist.commit()
-                    logger.info(f"Consulta guardada historial U={current_user_id}/T={current_tenant_id}.")
-            except (Exception, psycopg2.Error) as e_hist:
-                logger.error(f"Error guardar historial U={current_user_id}: {e_hist}", exc_info=True)
-                conn_hist.rollback()
+                if trabajo is None:
+                    continue
+                trabajo["status"] = "running"
+                trabajo["started_at"] = time.time()
+                try:
+                    resultado = await procesar_documento(trabajo["doc_id"], trabajo["user_id"], trabajo["tenant_id"])
+                except Exception as e:
+                    logger.error(f"Error inesperado en worker de ingesta {n} (job {job_id}): {e}", exc_info=True)
+                    resultado = ProcessResponse(success=False, error=f"Error interno del servidor ({type(e).__name__}).")
+                trabajo["status"] = "done" if resultado.success else "failed"
+                trabajo["message"] = resultado.message
+                trabajo["error"] = resultado.error
+                trabajo["reused_from"] = resultado.reused_from
+                trabajo["finished_at"] = time.time()
+                self._stats[trabajo["status"]] += 1
+                logger.info(f"Job {job_id} (doc {trabajo['doc_id']}) {trabajo['status']} en {trabajo['finished_at'] - trabajo['started_at']:.2f}s.")
             finally:
-                conn_hist.close()
+                if trabajo is not None:
+                    self._activos.pop((trabajo["doc_id"], trabajo["user_id"], trabajo["tenant_id"]), None)
+                fin = self._fin.pop(job_id, None)
+                if fin is not None:
+                    fin.set()
+                self._cola.task_done()
+
+    def estadisticas(self) -> dict:
+        estados = {"queued": 0, "running": 0}
+        for trabajo in self._trabajos.values():
+            if trabajo["status"] in estados:
+                estados[trabajo["status"]] += 1
+        return {"workers": self.workers, "max_queue": self.max_cola, **estados, **self._stats}
+
+cola_ingesta = ColaIngesta(INGEST_WORKERS, INGEST_QUEUE_MAX, INGEST_JOBS_RETENTION)
+
+def _respuesta_trabajo(trabajo: dict) -> ProcessResponse:
+    return ProcessResponse(success=True, message="Documento encolado para procesar.", job_id=trabajo["job_id"], status=trabajo["status"])
+
+def _respuesta_trabajo_terminado(trabajo: dict) -> ProcessResponse:
+    return ProcessResponse(success=trabajo["status"] == "done", message=trabajo["message"], error=trabajo["error"], job_id=trabajo["job_id"],
+                           status=trabajo["status"], reused_from=trabajo["reused_from"])
+
+# Por defecto responde al terminar el procesado (contrato síncrono de los llamadores PHP); con ?async=1
+# responde al encolar con el job_id para consultar /process-document/jobs/{job_id}
+@app.post("/process-document", response_model=ProcessResponse)
+async def process_document_text(request: ProcessRequest, asincrono: bool = Query(False, alias="async", description="Responder al encolar, sin esperar al procesado")):
+    doc_id = request.doc_id
+    current_user_id = request.user_id
+    current_tenant_id = request.tenant_id
+    if not isinstance(current_user_id, int) or not isinstance(current_tenant_id, int):
+        logger.error(f"IDs inválidos recibidos en /process-document: User='{current_user_id}', Tenant='{current_tenant_id}' para Doc ID {doc_id}")
+        return ProcessResponse(success=False, error="User ID y Tenant ID deben ser números enteros válidos.")
+    error_msg = _error_config_procesado()
+    if error_msg:
+        logger.error(error_msg + f" - Solicitud para doc {doc_id}")
+        return ProcessResponse(success=False, error=error_msg)
+    trabajo = cola_ingesta.encolar(doc_id, current_user_id, current_tenant_id)
+    if not trabajo:
+        return ProcessResponse(success=False, error="Cola de procesamiento llena. Inténtalo más tarde.")
+    if asincrono:
+        return _respuesta_trabajo(trabajo)
+    trabajo = await cola_ingesta.esperar(trabajo["job_id"])
+    if not trabajo:
+        return ProcessResponse(success=False, error="Trabajo de procesamiento no encontrado.")
+    return _respuesta_trabajo_terminado(trabajo)
+
+@app.post("/process-document/batch", response_model=ProcessBatchResponse)
+async def process_documents_batch(request: ProcessBatchRequest):
+    current_user_id = request.user_id
+    current_tenant_id = request.tenant_id
+    if not isinstance(current_tenant_id, int):
+        logger.error(f"IDs inválidos recibidos en /process-document/batch: User='{current_user_id}', Tenant='{current_tenant_id}'")
+        return ProcessBatchResponse(success=False, error="User ID y Tenant ID deben ser números enteros válidos.")
+    error_msg = _error_config_procesado()
+    if error_msg:
+        logger.error(error_msg + f" - Lote de {len(request.doc_ids)} docs")
+        return ProcessBatchResponse(success=False, error=error_msg)
+    doc_ids = list(dict.fromkeys(request.doc_ids))
+    if len(doc_ids) > cola_ingesta.huecos_libres():
+        logger.error(f"Lote de {len(doc_ids)} docs no cabe en la cola de ingesta.")
+        return ProcessBatchResponse(success=False, error="Cola de procesamiento llena. Inténtalo más tarde.")
+    jobs = []
+    for doc_id in doc_ids:
+        trabajo = cola_ingesta.encolar(doc_id, current_user_id, current_tenant_id)
+        if trabajo:
+            jobs.append(_respuesta_trabajo(trabajo))
+        else:
+            jobs.append(ProcessResponse(success=False, error=f"Doc {doc_id} no encolado (cola llena)."))
+    logger.info(f"Lote encolado: {len(jobs)} docs U={current_user_id}/T={current_tenant_id}.")
+    return ProcessBatchResponse(success=all(j.success for j in jobs), jobs=jobs)
+
+@app.get("/process-document/jobs/{job_id}", response_model=IngestJobStatus)
+async def estado_trabajo_ingesta(job_id: str = Path(..., description="ID devuelto por /process-document")):
+    trabajo = cola_ingesta.estado(job_id)
+    if not trabajo:
+        raise HTTPException(404, "Trabajo no encontrado.")
+    return IngestJobStatus(**trabajo)
+
+# --- Caché de respuestas de /consulta (por tenant) ---
+CONSULTA_CACHE_TTL = _env_float("CONSULTA_CACHE_TTL", 3600.0)
+CONSULTA_CACHE_MAX = _env_int("CONSULTA_CACHE_MAX", 2000)
+CONSULTA_CACHE_MAX_BYTES = _env_int("CONSULTA_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+consulta_cache = CacheTTL("consulta", CONSULTA_CACHE_TTL, CONSULTA_CACHE_MAX, CONSULTA_CACHE_MAX_BYTES)
+_generacion_tenant = {}  # tenant_id -> contador que se incrementa al invalidar
+
+class PeticionInvalidarCache(BaseModel):
+    tenant_id: int = Field(..., description="Tenant cuyas respuestas cacheadas se descartan")
+    user_id: int | None = Field(None, description="Si se indica, solo las de este usuario")
+
+def invalidar_cache_consulta(tenant_id: int, user_id: int | None = None) -> int:
+    if user_id is None:
+        _generacion_tenant[tenant_id] = _generacion_tenant.get(tenant_id, 0) + 1
+        eliminadas = consulta_cache.invalidar(("tenant", tenant_id))
+    else:
+        eliminadas = consulta_cache.invalidar(("user", tenant_id, user_id))
+    indices_vectoriales.invalidar(("tenant", tenant_id))
+    logger.info(f"Caché /consulta invalidada T={tenant_id} U={user_id}: {eliminadas} entradas.")
+    return eliminadas
+
+def normalizar_mensaje(mensaje: str) -> str:
+    return re.sub(r"\s+", " ", mensaje.lower()).strip(" \t¿?¡!.")
+
+# Sello del conjunto de documentos activos: cambia al subir, reprocesar o (des)activar documentos desde PHP
+def obtener_version_documentos(user_id: int, tenant_id: int) -> str | None:
+    if not DB_CONFIGURED:
+        return "sin-bd"
+    conn = get_db_connection()
+    if not conn:
+        return None
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*), md5(COALESCE(string_agg(id::text, ',' ORDER BY id), '')) FROM user_documents WHERE user_id = %s AND tenant_id = %s AND is_active_for_ai = TRUE AND procesado = TRUE", (user_id, tenant_id))
+            total, huella = cursor.fetchone()
+            return f"{total}:{huella}"
+    except (Exception, psycopg2.Error) as e:
+        logger.error(f"Error BD versión docs U={user_id}/T={tenant_id}: {e}", exc_info=True)
+        return None
+    finally:
+        release_db_connection(conn)
+
+def clave_cache_consulta(mensaje_usuario: str, especializacion: str, memoria: str, version_docs: str, user_id: int, tenant_id: int, buscar_web: bool) -> str:
+    partes = [normalizar_mensaje(mensaje_usuario), especializacion, memoria, version_docs, str(_generacion_tenant.get(tenant_id, 0)), str(user_id), str(tenant_id), str(bool(buscar_web))]
+    return hashlib.sha256("\x1f".join(partes).encode("utf-8")).hexdigest()
+
+def _respuesta_cacheable(texto: str) -> bool:
+    return bool(texto) and not texto.startswith("<p><i>Error")
+
+def obtener_memoria_y_version(user_id: int, tenant_id: int) -> tuple[str, str | None]:
+    with metricas.medir("memoria"):
+        memoria = obtener_memoria_usuario(user_id, tenant_id)
+    with metricas.medir("version_documentos"):
+        return memoria, obtener_version_documentos(user_id, tenant_id)
+
+def obtener_memoria_usuario(user_id: int, tenant_id: int) -> str:
+    if not DB_CONFIGURED:
+        return ""
+    conn_prompt = get_db_connection()
+    if not conn_prompt:
+        logger.warning(f"No conexión BD Memoria U={user_id}")
+        return ""
+    try:
+        with conn_prompt.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            cursor.execute("SELECT custom_prompt FROM user_settings WHERE user_id = %s AND tenant_id = %s", (user_id, tenant_id))
+            result = cursor.fetchone()
+            if result and result.get('custom_prompt') and result['custom_prompt'].strip():
+                logger.info(f"Memoria OK U={user_id}/T={tenant_id}.")
+                return result['custom_prompt'].strip()
+            logger.info(f"No Memoria U={user_id}/T={tenant_id}.")
+    except (Exception, psycopg2.Error) as e:
+        logger.error(f"Error BD get Memoria U={user_id}: {e}", exc_info=True)
+    finally:
+        release_db_connection(conn_prompt)
+    return ""
+
+SQL_RAG_CHUNKS = """
+    SELECT c.id AS chunk_id, d.original_filename, c.document_id, c.chunk_index, c.content,
+           ts_rank_cd(c.fts_vector, plainto_tsquery('spanish', %(query)s)) AS relevance
+    FROM user_document_chunks c
+    JOIN user_documents d ON d.id = c.document_id
+    WHERE c.user_id = %(user_id)s AND c.tenant_id = %(tenant_id)s
+      AND d.is_active_for_ai = TRUE AND d.procesado = TRUE
+      AND c.fts_vector @@ plainto_tsquery('spanish', %(query)s)
+    ORDER BY relevance DESC LIMIT %(limit)s
+"""
+# Documentos procesados antes de existir los chunks: solo se trae el inicio del texto, nunca el documento completo
+SQL_RAG_DOCS_SIN_CHUNKS = """
+    SELECT NULL AS chunk_id, d.original_filename, d.id AS document_id, 0 AS chunk_index, LEFT(d.extracted_text, %(max_chars)s) AS content,
+           ts_rank_cd(d.fts_vector, plainto_tsquery('spanish', %(query)s)) AS relevance
+    FROM user_documents d
+    WHERE d.user_id = %(user_id)s AND d.tenant_id = %(tenant_id)s AND d.is_active_for_ai = TRUE AND d.procesado = TRUE
+      AND d.fts_vector @@ plainto_tsquery('spanish', %(query)s)
+      AND d.extracted_text IS NOT NULL AND d.extracted_text != '' AND NOT d.extracted_text LIKE '[Error%%' AND NOT d.extracted_text LIKE '[Archivo vacío%%'
+      AND NOT EXISTS (SELECT 1 FROM user_document_chunks c WHERE c.document_id = d.id)
+    ORDER BY relevance DESC LIMIT 3
+"""
+
+SQL_RAG_CHUNKS_POR_ID = """
+    SELECT c.id AS chunk_id, d.original_filename, c.document_id, c.chunk_index, c.content
+    FROM user_document_chunks c
+    JOIN user_documents d ON d.id = c.document_id
+    WHERE c.id = ANY(%(ids)s) AND c.user_id = %(user_id)s AND c.tenant_id = %(tenant_id)s
+"""
+
+def _clave_fragmento(frag) -> tuple:
+    return ("chunk", frag['chunk_id']) if frag['chunk_id'] is not None else ("doc", frag['document_id'])
+
+# Recuperación híbrida: ranking FTS (ts_rank_cd) + ranking vectorial del índice en memoria, fusionados con RRF
+def buscar_fragmentos_rag(cursor, fts_query_string: str, user_id: int, tenant_id: int, max_chars_legacy: int, vector_consulta=None, version_docs: str | None = None) -> list:
+    params = {'query': fts_query_string, 'user_id': user_id, 'tenant_id': tenant_id, 'limit': RAG_TOP_CHUNKS, 'max_chars': max_chars_legacy}
+    fragmentos_fts = []
+    if fts_query_string:
+        cursor.execute(SQL_RAG_CHUNKS, params)
+        fragmentos_fts = [dict(f) for f in cursor.fetchall()]
+        cursor.execute(SQL_RAG_DOCS_SIN_CHUNKS, params)
+        fragmentos_fts.extend(dict(f) for f in cursor.fetchall())
+    if vector_consulta is None or not version_docs:
+        return fragmentos_fts
+    try:
+        similares = cargar_indice_vectorial(cursor, user_id, tenant_id, version_docs).buscar(vector_consulta, RAG_VECTOR_TOP_K)
+    except (Exception, psycopg2.Error) as e:
+        logger.error(f"Error búsqueda vectorial U={user_id}: {e}", exc_info=True)
+        cursor.connection.rollback()
+        return fragmentos_fts
+    por_clave = {_clave_fragmento(f): f for f in fragmentos_fts}
+    faltan = [chunk_id for chunk_id, _ in similares if ("chunk", chunk_id) not in por_clave]
+    if faltan:
+        cursor.execute(SQL_RAG_CHUNKS_POR_ID, {'ids': faltan, 'user_id': user_id, 'tenant_id': tenant_id})
+        for f in cursor.fetchall():
+            por_clave[("chunk", f['chunk_id'])] = dict(f)
+    fusion = fusionar_rrf([_clave_fragmento(f) for f in fragmentos_fts], [("chunk", chunk_id) for chunk_id, _ in similares])
+    fragmentos = []
+    for clave, puntuacion in fusion[:RAG_TOP_CHUNKS]:
+        if clave in por_clave:
+            frag = por_clave[clave]
+            frag['relevance'] = puntuacion
+            fragmentos.append(frag)
+    logger.info(f"RAG híbrido: {len(fragmentos_fts)} FTS + {len(similares)} vectoriales -> {len(fragmentos)} fusionados.")
+    return fragmentos
+
+CONSULTA_CONTEXT_TOKENS = _env_int("CONSULTA_CONTEXT_TOKENS", 5000)  # Mensaje + memoria + pasajes RAG
+MEMORIA_MAX_TOKENS = _env_int("MEMORIA_MAX_TOKENS", 1000)
+
+def construir_contexto_rag(mensaje_usuario: str, current_user_id: int, current_tenant_id: int, empaquetador: EmpaquetadorContexto, vector_consulta=None, version_docs: str | None = None) -> str:
+    document_context = ""
+    if not DB_CONFIGURED or empaquetador.restante <= 0:
+        return document_context
+    conn_docs = get_db_connection()
+    if not conn_docs:
+        logger.warning(f"No conexión BD RAG U={current_user_id}")
+        return document_context
+    try:
+        with conn_docs.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            search_query_cleaned = re.sub(r'[!\'()|&:*<>~@]', ' ', mensaje_usuario).strip()
+            search_query_terms = search_query_cleaned.split()
+            if not search_query_terms and vector_consulta is None:
+                logger.info("Msg RAG vacío tras limpiar.")
+            else:
+                fts_query_string = ' & '.join(search_query_terms)
+                logger.info(f"Buscando RAG FTS: '{fts_query_string}' U={current_user_id}/T={current_tenant_id}")
+                fragmentos = buscar_fragmentos_rag(cursor, fts_query_string, current_user_id, current_tenant_id, empaquetador.restante * 6, vector_consulta, version_docs)
+                if fragmentos:
+                    logger.info(f"Encontrados {len(fragmentos)} fragmentos RAG pots.")
+                    tokens_previos = empaquetador.usados
+                    for frag in fragmentos:
+                        filename = frag['original_filename']
+                        cabecera = f"\n--- Doc: {htmlspecialchars(filename)} (Frag. {frag['chunk_index'] + 1}, Rel: {frag['relevance']:.2f}) ---"
+                        if not empaquetador.añadir(cabecera, frag['content']):
+                            logger.info(f"Límite RAG alcanzado en '{filename}' #{frag['chunk_index']}.")
+                            break
+                    if empaquetador.incluidos > 0:
+                        document_context = "\n".join(["\n\n### Contexto de tus Documentos ###\n"] + empaquetador.partes)
+                        logger.info(f"Contexto RAG: {empaquetador.incluidos} fragmentos ({empaquetador.usados - tokens_previos} tokens, {empaquetador.duplicados} duplicados omitidos).")
+                    else:
+                        logger.info("Ningún fragmento RAG añadido a contexto.")
+                else:
+                    logger.info("No docs RAG encontrados.")
+    except (Exception, psycopg2.Error) as e:
+        logger.error(f"Error BD RAG U={current_user_id}: {e}", exc_info=True)
+        document_context = "\n<p><i>[Error buscar docs.]</i></p>"
+    finally:
+        release_db_connection(conn_docs)
+    return document_context
+
+async def embeber_consulta(mensaje_usuario: str):
+    with metricas.medir("embedding_consulta"):
+        vectores = await calcular_embeddings([mensaje_usuario], "consulta")
+    return vectores[0] if vectores is not None else None
+
+# Memoria + RAG dentro de un presupuesto fijo de tokens (el mensaje del usuario se reserva primero)
+def preparar_contexto_consulta(mensaje_usuario: str, user_id: int, tenant_id: int, memoria: str, vector_consulta=None, version_docs: str | None = None) -> tuple[str, str]:
+    empaquetador = EmpaquetadorContexto(CONSULTA_CONTEXT_TOKENS)
+    empaquetador.reservar(mensaje_usuario)
+    custom_prompt_text = empaquetador.reservar(memoria, MEMORIA_MAX_TOKENS)
+    with metricas.medir("contexto_rag"):
+        document_context = construir_contexto_rag(mensaje_usuario, user_id, tenant_id, empaquetador, vector_consulta, version_docs)
+    return custom_prompt_text, document_context
+
+def construir_prompt_consulta(especializacion: str, custom_prompt_text: str, document_context: str) -> str:
+    prompt_especifico = PROMPT_ESPECIALIZACIONES.get(especializacion, PROMPT_ESPECIALIZACIONES["general"])
+    system_prompt_parts = [BASE_PROMPT_CONSULTA, prompt_especifico]
+    if custom_prompt_text:
+        system_prompt_parts.append(f"\n### Memoria ###\n{custom_prompt_text}")
+    if document_context:
+        system_prompt_parts.append(document_context)
+    return "\n".join(filter(None, system_prompt_parts))
+
+# Con búsqueda forzada se lanza en paralelo a la llamada a OpenAI
+def iniciar_busqueda_web(mensaje_usuario: str, forzar_busqueda_web: bool) -> asyncio.Task | None:
+    return asyncio.create_task(buscar_google(mensaje_usuario)) if forzar_busqueda_web else None
+
+# Sufijo común a /consulta y /consulta/stream: aviso de truncado + bloque de resultados web
+async def anexos_respuesta_consulta(texto_respuesta: str, finish_reason: str | None, mensaje_usuario: str, forzar_busqueda_web: bool, busqueda_web: asyncio.Task | None = None) -> str:
+    anexos = ""
+    if finish_reason == 'length':
+        logger.warning("Respuesta OpenAI truncada.")
+        anexos += "\n<p><i>(Respuesta incompleta...)</i></p>"
+    necesita_web = any(frase in texto_respuesta.lower() for frase in FRASES_BUSQUEDA) or forzar_busqueda_web
+    if necesita_web:
+        logger.info("Requiere búsqueda web (Forzado).")
+        web_resultados_html = await (busqueda_web or buscar_google(mensaje_usuario))
+        if web_resultados_html and not web_resultados_html.startswith("<p><i>["):
+            anexos += "\n\n" + web_resultados_html
+            logger.info("Resultados web añadidos.")
         else:
-            logger.warning("No se guardó historial (sin conexión BD).")
+            logger.info("Búsqueda web sin resultados/error.")
+    else:
+        logger.info("No requiere búsqueda web.")
+    return anexos
+
+# --- Historial con escritura diferida (write-behind) ---
+# /consulta no espera al INSERT: las filas se acumulan en memoria y se vuelcan por lotes (INSERT multi-fila)
+# al llegar a HISTORIAL_BATCH filas o cada HISTORIAL_FLUSH_INTERVAL segundos. Al parar se vacía el buffer.
+HISTORIAL_BATCH = max(1, _env_int("HISTORIAL_BATCH", 200))
+HISTORIAL_FLUSH_INTERVAL = _env_float("HISTORIAL_FLUSH_INTERVAL", 1.0)
+HISTORIAL_BUFFER_MAX = max(1, _env_int("HISTORIAL_BUFFER_MAX", 10000))
+HISTORIAL_DESBORDE = os.getenv("HISTORIAL_DESBORDE", "descartar_antiguas").strip().lower()  # descartar_antiguas | descartar_nuevas
+HISTORIAL_DRAIN_TIMEOUT = _env_float("HISTORIAL_DRAIN_TIMEOUT", 10.0)
+
+# fecha_hora se calcula en BD restando la espera en el buffer, para conservar la hora real de la consulta
+SQL_INSERT_HISTORIAL = "INSERT INTO historial (usuario_id, tenant_id, pregunta, respuesta, fecha_hora) VALUES %s"
+PLANTILLA_HISTORIAL = "(%s, %s, %s, %s, NOW() - %s * INTERVAL '1 second')"
+
+def insertar_historial(filas: list[tuple]):
+    conn_hist = get_db_connection()
+    if not conn_hist:
+        raise psycopg2.OperationalError("Sin conexión BD para historial.")
+    try:
+        ahora = time.time()
+        with conn_hist.cursor() as cursor:
+            psycopg2.extras.execute_values(
+                cursor, SQL_INSERT_HISTORIAL,
+                [(u, t, p, r, max(0.0, ahora - ts)) for u, t, p, r, ts in filas],
+                template=PLANTILLA_HISTORIAL, page_size=len(filas)
+            )
+        conn_hist.commit()
+    except Exception:
+        conn_hist.rollback()
+        raise
+    finally:
+        release_db_connection(conn_hist)
+
+class BufferHistorial:
+    def __init__(self, lote: int, intervalo: float, max_filas: int, desborde: str):
+        if desborde not in ("descartar_antiguas", "descartar_nuevas"):
+            logger.warning(f"HISTORIAL_DESBORDE '{desborde}' no válido. Usando 'descartar_antiguas'.")
+            desborde = "descartar_antiguas"
+        self.lote = lote
+        self.intervalo = intervalo
+        self.max_filas = max_filas
+        self.desborde = desborde
+        self._filas = deque()
+        self._hay_lote = None
+        self._tarea = None
+        self._parando = False
+        self._stats = {"enqueued": 0, "written": 0, "dropped": 0, "flushes": 0, "flush_errors": 0,
+                       "last_flush_ms": 0.0, "max_flush_ms": 0.0, "total_flush_ms": 0.0}
+
+    async def iniciar(self):
+        if self._tarea:
+            return
+        self._hay_lote = asyncio.Event()
+        self._parando = False
+        self._tarea = asyncio.create_task(self._volcador())
+        logger.info(f"Buffer de historial iniciado (lote {self.lote}, cada {self.intervalo}s, máx. {self.max_filas}, {self.desborde}).")
+
+    async def detener(self, timeout: float):
+        if self._tarea:
+            self._parando = True
+            self._hay_lote.set()
+            try:
+                await asyncio.wait_for(self._tarea, timeout)  # El volcador vacía el buffer antes de salir
+            except asyncio.TimeoutError:
+                logger.error(f"Historial: vaciado no terminado en {timeout}s.")
+            self._tarea = None
+        if self._filas:
+            self._stats["dropped"] += len(self._filas)
+            logger.error(f"Historial: {len(self._filas)} filas sin guardar al parar.")
+            self._filas.clear()
+
+    # Síncrono a propósito: se puede llamar desde un finally tras cancelar el stream
+    def agregar(self, user_id: int, tenant_id: int, pregunta: str, respuesta: str):
+        if not DB_CONFIGURED:
+            return
+        if len(self._filas) >= self.max_filas:
+            self._stats["dropped"] += 1
+            if self.desborde == "descartar_nuevas":
+                logger.warning(f"Buffer de historial lleno ({self.max_filas}). Descartada consulta U={user_id}/T={tenant_id}.")
+                return
+            self._filas.popleft()
+            logger.warning(f"Buffer de historial lleno ({self.max_filas}). Descartada la fila más antigua.")
+        self._filas.append((user_id, tenant_id, pregunta, respuesta, time.time()))
+        self._stats["enqueued"] += 1
+        if self._hay_lote is not None and len(self._filas) >= self.lote:
+            self._hay_lote.set()
+
+    async def _volcador(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._hay_lote.wait(), self.intervalo)
+            except asyncio.TimeoutError:
+                pass
+            self._hay_lote.clear()
+            if self._parando:
+                while self._filas and await self._volcar():
+                    pass
+                return
+            if self._filas and not await self._volcar():
+                await asyncio.sleep(self.intervalo)  # BD caída: no reintentar en bucle
+
+    async def _volcar(self) -> bool:
+        filas = [self._filas.popleft() for _ in range(min(self.lote, len(self._filas)))]
+        inicio = time.perf_counter()
+        try:
+            await asyncio.to_thread(insertar_historial, filas)
+        except (Exception, psycopg2.Error) as e:
+            # Se devuelven al frente del buffer respetando el límite (lo que no quepa se pierde)
+            self._stats["flush_errors"] += 1
+            hueco = self.max_filas - len(self._filas)
+            if hueco < len(filas):
+                self._stats["dropped"] += len(filas) - max(0, hueco)
+            self._filas.extendleft(reversed(filas[:max(0, hueco)]))
+            logger.error(f"Error guardando lote de historial ({len(filas)} filas): {e}")
+            return False
+        ms = (time.perf_counter() - inicio) * 1000
+        metricas.observar("stage_duration_seconds", ms / 1000, stage="historial_flush")
+        self._stats["flushes"] += 1
+        self._stats["written"] += len(filas)
+        self._stats["last_flush_ms"] = round(ms, 2)
+        self._stats["max_flush_ms"] = round(max(self._stats["max_flush_ms"], ms), 2)
+        self._stats["total_flush_ms"] += ms
+        logger.info(f"Historial: {len(filas)} filas guardadas en {ms:.1f} ms.")
+        return True
+
+    def estadisticas(self) -> dict:
+        flushes = self._stats["flushes"]
+        media = self._stats["total_flush_ms"] / flushes if flushes else 0.0
+        return {"batch": self.lote, "interval_s": self.intervalo, "max_rows": self.max_filas, "overflow": self.desborde,
+                "pending": len(self._filas), **{k: v for k, v in self._stats.items() if k != "total_flush_ms"},
+                "avg_flush_ms": round(media, 2)}
+
+buffer_historial = BufferHistorial(HISTORIAL_BATCH, HISTORIAL_FLUSH_INTERVAL, HISTORIAL_BUFFER_MAX, HISTORIAL_DESBORDE)
+
+def guardar_historial(user_id: int, tenant_id: int, pregunta: str, respuesta: str):
+    buffer_historial.agregar(user_id, tenant_id, pregunta, respuesta)
+
+def _validar_peticion_consulta(datos: PeticionConsulta, ruta: str):
+    if not client:
+        logger.error(f"Llamada {ruta} sin cliente OpenAI.")
+        raise HTTPException(503, "Servicio IA no disponible.")
+    if not isinstance(datos.user_id, int) or not isinstance(datos.tenant_id, int):
+        logger.error(f"IDs inválidos {ruta}: U={datos.user_id}, T={datos.tenant_id}")
+        raise HTTPException(400, "User/Tenant ID inválidos.")
+
+@app.post("/consulta", response_model=RespuestaConsulta)
+async def consultar_agente(datos: PeticionConsulta):
+    _validar_peticion_consulta(datos, "/consulta")
+    current_user_id = datos.user_id
+    current_tenant_id = datos.tenant_id
+    especializacion = datos.especializacion.lower() if datos.especializacion else "general"
+    mensaje_usuario = datos.mensaje.strip()
+    forzar_busqueda_web = datos.buscar_web
+    logger.info(f"Consulta: U={current_user_id},T={current_tenant_id},E='{especializacion}',Web={forzar_busqueda_web},Msg='{mensaje_usuario[:100]}...'")
+    if not mensaje_usuario:
+        return RespuestaConsulta(respuesta="<p>Por favor, introduce tu consulta.</p>")
+    memoria, version_docs = await asyncio.to_thread(obtener_memoria_y_version, current_user_id, current_tenant_id)
+    clave_cache = clave_cache_consulta(mensaje_usuario, especializacion, memoria, version_docs, current_user_id, current_tenant_id, forzar_busqueda_web) if version_docs else None
+    texto_cacheado = consulta_cache.obtener(clave_cache) if clave_cache else None
+    if texto_cacheado:
+        logger.info(f"Respuesta desde caché U={current_user_id}/T={current_tenant_id}.")
+        guardar_historial(current_user_id, current_tenant_id, mensaje_usuario, texto_cacheado)
+        return RespuestaConsulta(respuesta=texto_cacheado)
+    control_admision.comprobar_peticion(current_tenant_id)
+    vector_consulta = await embeber_consulta(mensaje_usuario) if DB_CONFIGURED else None
+    custom_prompt_text, document_context = await asyncio.to_thread(preparar_contexto_consulta, mensaje_usuario, current_user_id, current_tenant_id, memoria, vector_consulta, version_docs)
+    system_prompt = construir_prompt_consulta(especializacion, custom_prompt_text, document_context)
+    messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": mensaje_usuario}]
+    busqueda_web = iniciar_busqueda_web(mensaje_usuario, forzar_busqueda_web)
+    try:
+        texto_respuesta_final, finish_reason = await llamar_openai(messages, 0.6, 2000, f"/consulta U={current_user_id}", current_tenant_id)
+        logger.info(f"Respuesta OpenAI OK (Len: {len(texto_respuesta_final)}, Fin: {finish_reason}).")
+        texto_respuesta_final += await anexos_respuesta_consulta(texto_respuesta_final, finish_reason, mensaje_usuario, forzar_busqueda_web, busqueda_web)
+        if clave_cache and _respuesta_cacheable(texto_respuesta_final):
+            consulta_cache.guardar(clave_cache, texto_respuesta_final, etiquetas=(("tenant", current_tenant_id), ("user", current_tenant_id, current_user_id)))
+    except AdmisionRechazada:
+        if busqueda_web:
+            busqueda_web.cancel()
+        raise
+    except RespuestaIAInvalida:
+        texto_respuesta_final = "<p><i>Error: Respuesta IA inválida.</i></p>"
+    except CircuitoAbierto as e:
+        texto_respuesta_final = f"<p><i>Error IA: {e.detail}</i></p>"
+    except error_api_openai() as e:
+        texto_respuesta_final = f"<p><i>Error IA: {e.message}.</i></p>"
+    except Exception as e:
+        logger.error(f"Error /consulta U={current_user_id}: {e}", exc_info=True)
+        texto_respuesta_final = "<p><i>Error interno consulta.</i></p>"
+    guardar_historial(current_user_id, current_tenant_id, mensaje_usuario, texto_respuesta_final)
     return RespuestaConsulta(respuesta=texto_respuesta_final)
 
+def _evento_sse(datos: dict, evento: str | None = None) -> str:
+    cabecera = f"event: {evento}\n" if evento else ""
+    return f"{cabecera}data: {json.dumps(datos, ensure_ascii=False)}\n\n"
+
+# Variante SSE de /consulta: eventos 'delta' con cada fragmento y un 'done' final con la respuesta completa.
+# /consulta (JSON) se mantiene para consulta.php y asistente.php.
+@app.post("/consulta/stream")
+async def consultar_agente_stream(datos: PeticionConsulta):
+    _validar_peticion_consulta(datos, "/consulta/stream")
+    current_user_id = datos.user_id
+    current_tenant_id = datos.tenant_id
+    especializacion = datos.especializacion.lower() if datos.especializacion else "general"
+    mensaje_usuario = datos.mensaje.strip()
+    forzar_busqueda_web = datos.buscar_web
+    logger.info(f"Consulta stream: U={current_user_id},T={current_tenant_id},E='{especializacion}',Web={forzar_busqueda_web},Msg='{mensaje_usuario[:100]}...'")
+    if not mensaje_usuario:
+        vacia = "<p>Por favor, introduce tu consulta.</p>"
+        return StreamingResponse(iter([_evento_sse({"delta": vacia}, "delta"), _evento_sse({"respuesta": vacia}, "done")]), media_type="text/event-stream")
+    memoria, version_docs = await asyncio.to_thread(obtener_memoria_y_version, current_user_id, current_tenant_id)
+    clave_cache = clave_cache_consulta(mensaje_usuario, especializacion, memoria, version_docs, current_user_id, current_tenant_id, forzar_busqueda_web) if version_docs else None
+    texto_cacheado = consulta_cache.obtener(clave_cache) if clave_cache else None
+    if texto_cacheado:
+        logger.info(f"Respuesta stream desde caché U={current_user_id}/T={current_tenant_id}.")
+        guardar_historial(current_user_id, current_tenant_id, mensaje_usuario, texto_cacheado)
+        return StreamingResponse(iter([_evento_sse({"delta": texto_cacheado}, "delta"), _evento_sse({"respuesta": texto_cacheado, "cached": True}, "done")]), media_type="text/event-stream")
+    control_admision.comprobar_peticion(current_tenant_id)
+    vector_consulta = await embeber_consulta(mensaje_usuario) if DB_CONFIGURED else None
+    custom_prompt_text, document_context = await asyncio.to_thread(preparar_contexto_consulta, mensaje_usuario, current_user_id, current_tenant_id, memoria, vector_consulta, version_docs)
+    system_prompt = construir_prompt_consulta(especializacion, custom_prompt_text, document_context)
+    messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": mensaje_usuario}]
+    # El turno se pide antes de enviar las cabeceras: cola llena o espera excesiva -> 429 + Retry-After.
+    # Se mantiene mientras dura el stream y lo libera el generador (o la tarea de fondo si nunca llega a empezar).
+    permiso = await control_admision.adquirir(current_tenant_id, estimar_tokens_mensajes(messages, 2000))
+
+    async def generar_eventos():
+        partes = []
+        finish_reason = None
+        guardado = False
+        stream = None
+        busqueda_web = None
+        try:
+            busqueda_web = iniciar_busqueda_web(mensaje_usuario, forzar_busqueda_web)
+            inicio_openai = time.perf_counter()
+            try:
+                stream = await abrir_stream_openai(messages, 0.6, 2000, f"/consulta/stream U={current_user_id}")
+            except error_api_openai() as e:
+                partes = [f"<p><i>Error IA: {e.message}.</i></p>"]
+                yield _evento_sse({"error": partes[0]}, "error")
+                return
+            except CircuitoAbierto as e:
+                partes = [f"<p><i>Error IA: {e.detail}</i></p>"]
+                yield _evento_sse({"error": partes[0], "retry_after": e.retry_after}, "error")
+                return
+            try:
+                async for chunk in stream:
+                    if chunk.usage:
+                        registrar_uso_openai(chunk.usage, "chat_stream")
+                    if not chunk.choices:
+                        continue
+                    choice = chunk.choices[0]
+                    delta = choice.delta.content if choice.delta else None
+                    if delta:
+                        partes.append(delta)
+                        yield _evento_sse({"delta": delta}, "delta")
+                    if choice.finish_reason:
+                        finish_reason = choice.finish_reason
+            except Exception as e:
+                # Corte a mitad del stream (timeout, conexión, 5xx): también cuenta para el interruptor
+                if es_error_transitorio(e):
+                    interruptor_openai.fallo(e)
+                raise
+            metricas.observar("stage_duration_seconds", time.perf_counter() - inicio_openai, stage="openai_stream")
+            permiso.liberar()
+            if finish_reason == 'length':
+                metricas.incrementar("openai_truncated_total", operation="chat_stream")
+            texto_respuesta = "".join(partes).strip()
+            if not texto_respuesta:
+                logger.error("Respuesta OpenAI stream vacía.")
+                partes = ["<p><i>Error: Respuesta IA inválida.</i></p>"]
+                yield _evento_sse({"error": partes[0]}, "error")
+                return
+            logger.info(f"Respuesta OpenAI stream OK (Len: {len(texto_respuesta)}, Fin: {finish_reason}).")
+            anexos = await anexos_respuesta_consulta(texto_respuesta, finish_reason, mensaje_usuario, forzar_busqueda_web, busqueda_web)
+            if anexos:
+                partes.append(anexos)
+                yield _evento_sse({"delta": anexos}, "delta")
+            texto_final = "".join(partes).strip()
+            if clave_cache and _respuesta_cacheable(texto_final):
+                consulta_cache.guardar(clave_cache, texto_final, etiquetas=(("tenant", current_tenant_id), ("user", current_tenant_id, current_user_id)))
+            guardar_historial(current_user_id, current_tenant_id, mensaje_usuario, texto_final)
+            guardado = True
+            yield _evento_sse({"respuesta": texto_final}, "done")
+        except Exception as e:
+            logger.error(f"Error /consulta/stream U={current_user_id}: {e}", exc_info=True)
+            if not partes:
+                partes = ["<p><i>Error interno consulta.</i></p>"]
+            yield _evento_sse({"error": "<p><i>Error interno consulta.</i></p>"}, "error")
+        finally:
+            # Cliente desconectado o error: se corta la generación en OpenAI y la búsqueda web pendiente
+            if stream is not None:
+                try:
+                    await stream.close()
+                except Exception as e:
+                    logger.warning(f"Error cerrando stream OpenAI U={current_user_id}: {type(e).__name__}")
+            if busqueda_web and not busqueda_web.done():
+                busqueda_web.cancel()
+            permiso.liberar()
+            # Error o cliente desconectado a mitad: se guarda lo recibido (agregar al buffer no necesita await)
+            texto_final = "".join(partes).strip()
+            if texto_final and not guardado:
+                logger.warning(f"Stream /consulta incompleto U={current_user_id}. Guardando lo recibido.")
+                guardar_historial(current_user_id, current_tenant_id, mensaje_usuario, texto_final)
+
+    return StreamingResponse(generar_eventos(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}, background=BackgroundTask(permiso.liberar))
+
+# --- Caché de /analizar-documento (texto extraído por hash del archivo; informe final por hash + prompt) ---
+ANALISIS_CACHE_DIR = os.getenv("ANALISIS_CACHE_DIR", os.path.join(TEMP_DIR, "cache_analisis"))
+ANALISIS_CACHE_TEXTO_MAX_BYTES = _env_int("ANALISIS_CACHE_TEXTO_MAX_BYTES", 512 * 1024 * 1024)  # 0 desactiva; límite del directorio, compartido por todos los workers
+ANALISIS_CACHE_INFORME_MAX_BYTES = _env_int("ANALISIS_CACHE_INFORME_MAX_BYTES", 64 * 1024 * 1024)  # 0 desactiva
+cache_texto_analisis = CacheDisco("analisis_texto", os.path.join(ANALISIS_CACHE_DIR, "texto"), ANALISIS_CACHE_TEXTO_MAX_BYTES)
+cache_informe_analisis = CacheDisco("analisis_informe", os.path.join(ANALISIS_CACHE_DIR, "informe"), ANALISIS_CACHE_INFORME_MAX_BYTES)
+
+def clave_informe_analisis(file_sha256: str, tipo: str, system_prompt: str) -> str:
+    # El system prompt ya incluye especialización y memoria del usuario
+    return CacheDisco.clave(file_sha256, tipo, OPENAI_MODEL, system_prompt)
+
+# --- Análisis map-reduce de documentos largos ---
+ANALYSIS_MAPREDUCE = os.getenv("ANALYSIS_MAPREDUCE", "1").lower() in ("1", "true", "yes")
+ANALYSIS_SECTION_TOKENS = max(1000, _env_int("ANALYSIS_SECTION_TOKENS", 12000))
+ANALYSIS_MAX_SECTIONS = max(1, _env_int("ANALYSIS_MAX_SECTIONS", 20))
+ANALYSIS_MAPREDUCE_MIN_TOKENS = _env_int("ANALYSIS_MAPREDUCE_MIN_TOKENS", 2 * ANALYSIS_SECTION_TOKENS)  # Por debajo, una sola llamada
+ANALYSIS_PARALLELISM = max(1, _env_int("ANALYSIS_PARALLELISM", 8))  # Secciones resumidas a la vez por petición
+ANALYSIS_SECTION_SUMMARY_TOKENS = _env_int("ANALYSIS_SECTION_SUMMARY_TOKENS", 1200)
+# Tokens de documento que se llegan a leer (con map-reduce se cubre mucho más que en una sola llamada)
+ANALYSIS_TOKENS_LIMIT = max(MAX_ANALYSIS_TOKENS, ANALYSIS_SECTION_TOKENS * ANALYSIS_MAX_SECTIONS) if ANALYSIS_MAPREDUCE else MAX_ANALYSIS_TOKENS
+
+async def resumir_secciones(secciones: list[str], filename: str, prompt_especifico: str, tenant_id: int | None = None) -> list[str | None]:
+    limite = asyncio.Semaphore(ANALYSIS_PARALLELISM)
+    total = len(secciones)
+    async def resumir(i: int, seccion: str) -> str | None:
+        messages = [
+            {"role": "system", "content": f"{PROMPT_RESUMEN_SECCION}\nEnfoque: {prompt_especifico}"},
+            {"role": "user", "content": f"Sección {i}/{total} de '{filename}':\n--- INICIO ---\n{seccion}\n--- FIN ---"}
+        ]
+        async with limite:
+            try:
+                resumen, _ = await llamar_openai(messages, 0.2, ANALYSIS_SECTION_SUMMARY_TOKENS, f"sección {i}/{total} '{filename}'", tenant_id)
+                return resumen
+            except (AdmisionRechazada, CircuitoAbierto):
+                raise
+            except Exception as e:
+                logger.error(f"Sección {i}/{total} de '{filename}' sin resumen ({type(e).__name__}).")
+                return None
+    tareas = [asyncio.create_task(resumir(i, seccion)) for i, seccion in enumerate(secciones, 1)]
+    try:
+        return await asyncio.gather(*tareas)
+    finally:
+        # 429/503 (o cliente desconectado): las demás secciones no siguen gastando cupo del tenant ni huecos globales
+        for tarea in tareas:
+            if not tarea.done():
+                tarea.cancel()
+
 @app.post("/analizar-documento", response_model=RespuestaAnalisis)
 async def analizar_documento(
     file: UploadFile = File(...),
@@ -670,29 +3409,14 @@ async def analizar_documento(
     if not isinstance(current_user_id, int) or not isinstance(current_tenant_id, int):
         logger.error(f"IDs inválidos /analizar: U='{current_user_id}', T='{current_tenant_id}'")
         raise HTTPException(400, "User/Tenant ID inválidos.")
+    control_admision.comprobar_peticion(current_tenant_id)
     filename = file.filename if file.filename else "archivo_subido"
     content_type = file.content_type or ""
     base, dot, extension = filename.rpartition('.')
     extension = extension.lower() if dot else ''
     especializacion_lower = especializacion.lower() if especializacion else "general"
     logger.info(f"Análisis Doc: U={current_user_id}, T={current_tenant_id}, File='{filename}', Type='{content_type}', Espec='{especializacion_lower}'")
-    custom_prompt_text = ""
-    if DB_CONFIGURED:
-        conn_prompt = get_db_connection()
-    if conn_prompt:
-        try:
-            with conn_prompt.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
-                cursor.execute("SELECT custom_prompt FROM user_settings WHERE user_id = %s AND tenant_id = %s", (current_user_id, current_tenant_id))
-                result = cursor.fetchone()
-                if result and result.get('custom_prompt') and result['custom_prompt'].strip():
-                    custom_prompt_text = result['custom_prompt'].strip()
-                    logger.info(f"Memoria OK análisis U={current_user_id}.")
-        except (Exception, psycopg2.Error) as e_prompt:
-            logger.error(f"Error BD get Memoria análisis U={current_user_id}: {e_prompt}", exc_info=True)
-        finally:
-            conn_prompt.close()
-    else:
-        logger.warning("No conexión BD Memoria análisis.")
+    custom_prompt_text = await asyncio.to_thread(obtener_memoria_usuario, current_user_id, current_tenant_id)
     prompt_especifico = PROMPT_ESPECIALIZACIONES.get(especializacion_lower, PROMPT_ESPECIALIZACIONES["general"])
     system_prompt_parts = [BASE_PROMPT_ANALISIS_DOC, prompt_especifico]
     if custom_prompt_text:
@@ -701,7 +3425,6 @@ async def analizar_documento(
     messages_payload = []
     IMAGE_MIMES = ["image/png", "image/jpeg", "image/jpg", "image/webp", "image/gif"]
     TEXT_EXTENSIONS = ["pdf", "doc", "docx", "txt", "csv"]
-    temp_filename_analisis = None
     try:
         if content_type in IMAGE_MIMES:
             logger.info(f"Procesando imagen '{filename}' análisis Vision.")
@@ -710,48 +3433,79 @@ async def analizar_documento(
             if len(image_bytes) > MAX_IMAGE_SIZE:
                 logger.error(f"Imagen '{filename}' excede {MAX_IMAGE_SIZE / (1024*1024):.1f} MB.")
                 raise HTTPException(413, f"Imagen excede {MAX_IMAGE_SIZE / (1024*1024):.1f} MB.")
+            clave_informe = clave_informe_analisis(hashlib.sha256(image_bytes).hexdigest(), content_type, system_prompt)
+            informe_cacheado = await asyncio.to_thread(cache_informe_analisis.obtener, clave_informe)
+            if informe_cacheado is not None:
+                logger.info(f"Informe de '{filename}' servido desde caché.")
+                return RespuestaAnalisis(informe=informe_cacheado)
+            image_bytes, image_mime = await preparar_imagen_vision(image_bytes, content_type, filename)
             base64_image = base64.b64encode(image_bytes).decode('utf-8')
+            del image_bytes
             user_prompt = "Analiza imagen y genera informe HTML."
-            messages_payload = [{"role": "system", "content": system_prompt}, {"role": "user", "content": [{"type": "text", "text": user_prompt}, {"type": "image_url", "image_url": {"url": f"data:{content_type};base64,{base64_image}"}}]}]
+            messages_payload = [{"role": "system", "content": system_prompt}, {"role": "user", "content": [{"type": "text", "text": user_prompt}, {"type": "image_url", "image_url": {"url": f"data:{image_mime};base64,{base64_image}"}}]}]
         elif extension in TEXT_EXTENSIONS:
             logger.info(f"Procesando texto '{filename}' análisis.")
             texto_extraido = ""
-            with tempfile.NamedTemporaryFile(mode='wb', suffix=f'.{extension}', dir=TEMP_DIR, delete=False) as temp_file:
-                 temp_filename_analisis = temp_file.name
-                 try:
-                     while True:
-                         chunk = await file.read(8192)
-                         if not chunk:
-                             break
-                         temp_file.write(chunk)
-                     logger.info(f"Archivo '{filename}' -> temp '{temp_filename_analisis}'")
-                 except Exception as copy_err:
-                     logger.error(f"Error copiar a temp '{temp_filename_analisis}': {copy_err}", exc_info=True)
-                     raise HTTPException(500, "Error guardar archivo temporal.")
-            try:
-                 if extension in ['pdf', 'doc', 'docx']:
-                     texto_extraido = extraer_texto_pdf_docx(temp_filename_analisis, extension)
-                 else:
-                     texto_extraido = extraer_texto_simple(temp_filename_analisis)
-            finally:
-                 if temp_filename_analisis and os.path.exists(temp_filename_analisis):
-                     try:
-                         os.remove(temp_filename_analisis)
-                         logger.info(f"Temp '{temp_filename_analisis}' eliminado.")
-                         temp_filename_analisis = None
-                     except OSError as e:
-                         logger.error(f"Error borrar temp '{temp_filename_analisis}': {e}")
+            with BufferArchivo(f'.{extension}') as archivo:
+                try:
+                    while True:
+                        chunk = await file.read(65536)
+                        if not chunk:
+                            break
+                        archivo.write(chunk)
+                except Exception as copy_err:
+                    logger.error(f"Error leyendo subida '{filename}': {copy_err}", exc_info=True)
+                    raise HTTPException(500, "Error al recibir el archivo.")
+                extractor = version_extractor(extension)
+                clave_informe = clave_informe_analisis(archivo.sha256, extractor, system_prompt)
+                informe_cacheado = await asyncio.to_thread(cache_informe_analisis.obtener, clave_informe)
+                if informe_cacheado is not None:
+                    logger.info(f"Informe de '{filename}' servido desde caché.")
+                    return RespuestaAnalisis(informe=informe_cacheado)
+                clave_texto = CacheDisco.clave(archivo.sha256, extractor, ANALYSIS_TOKENS_LIMIT)
+                texto_extraido = await asyncio.to_thread(cache_texto_analisis.obtener, clave_texto)
+                if texto_extraido is None:
+                    # ~8 chars/token como cota superior: el recorte exacto en tokens se hace después
+                    texto_extraido = await extraer_texto_async(archivo.origen(), extension, ANALYSIS_TOKENS_LIMIT * 8)
+                    if texto_extraido.strip() and not texto_extraido.startswith("[Error"):
+                        await asyncio.to_thread(cache_texto_analisis.guardar, clave_texto, texto_extraido)
+                else:
+                    logger.info(f"Texto de '{filename}' servido desde caché ({len(texto_extraido)} caracteres).")
             if texto_extraido.startswith("[Error") or not texto_extraido.strip():
                 error_msg = texto_extraido if texto_extraido.startswith("[Error") else "[Archivo vacío]"
                 logger.error(f"Error/vacío extracción '{filename}': {error_msg}")
                 raise HTTPException(400, f"Error extraer texto: {error_msg}")
-            MAX_ANALYSIS_TOKENS = 100000
-            estimated_tokens = len(texto_extraido.split()) * 1.3
-            if estimated_tokens > MAX_ANALYSIS_TOKENS:
-                logger.warning(f"Texto '{filename}' truncado (~{MAX_ANALYSIS_TOKENS} tokens).")
-                max_chars = int(MAX_ANALYSIS_TOKENS / 1.3)
-                texto_extraido = texto_extraido[:max_chars] + "\n[TRUNCADO]"
-            user_prompt = f"Redacta informe HTML basado en texto de '{htmlspecialchars(filename)}':\n--- INICIO ---\n{texto_extraido}\n--- FIN ---"
+            tokens_texto = await asyncio.to_thread(contador_tokens.contar, texto_extraido)
+            if ANALYSIS_MAPREDUCE and tokens_texto > ANALYSIS_MAPREDUCE_MIN_TOKENS:
+                texto_recortado = await asyncio.to_thread(contador_tokens.recortar, texto_extraido, ANALYSIS_TOKENS_LIMIT)
+                truncado = len(texto_recortado) < len(texto_extraido)
+                secciones = await asyncio.to_thread(contador_tokens.dividir, texto_recortado, ANALYSIS_SECTION_TOKENS)
+                if len(secciones) > ANALYSIS_MAX_SECTIONS:
+                    secciones = secciones[:ANALYSIS_MAX_SECTIONS]
+                    truncado = True
+                del texto_extraido, texto_recortado
+                logger.info(f"Análisis map-reduce '{filename}': ~{tokens_texto} tokens en {len(secciones)} secciones (paralelismo {ANALYSIS_PARALLELISM}).")
+                inicio_map = time.perf_counter()
+                resumenes = await resumir_secciones(secciones, filename, prompt_especifico, current_tenant_id)
+                fallidas = sum(1 for r in resumenes if r is None)
+                logger.info(f"Fase map '{filename}' en {time.perf_counter() - inicio_map:.2f}s ({fallidas} secciones fallidas).")
+                if fallidas == len(resumenes):
+                    raise HTTPException(503, f"Error OpenAI al analizar tras {OPENAI_MAX_RETRIES} intentos.")
+                partes = [f"### Sección {i}/{len(resumenes)}\n{r if r is not None else '[Sección no disponible]'}" for i, r in enumerate(resumenes, 1)]
+                if truncado:
+                    logger.warning(f"Texto '{filename}' truncado ({ANALYSIS_TOKENS_LIMIT} tokens) antes de seccionar.")
+                    partes.append("[TRUNCADO]")
+                user_prompt = (
+                    f"Redacta informe HTML del documento '{htmlspecialchars(filename)}' a partir de los resúmenes de sus {len(resumenes)} secciones, "
+                    f"en orden. Integra la información en un único informe coherente, sin repetir ni organizarlo por secciones del original:\n"
+                    f"--- INICIO ---\n" + "\n\n".join(partes) + "\n--- FIN ---"
+                )
+            else:
+                texto_recortado = await asyncio.to_thread(contador_tokens.recortar, texto_extraido, MAX_ANALYSIS_TOKENS)
+                if len(texto_recortado) < len(texto_extraido):
+                    logger.warning(f"Texto '{filename}' truncado ({MAX_ANALYSIS_TOKENS} tokens).")
+                    texto_extraido = texto_recortado + "\n[TRUNCADO]"
+                user_prompt = f"Redacta informe HTML basado en texto de '{htmlspecialchars(filename)}':\n--- INICIO ---\n{texto_extraido}\n--- FIN ---"
             messages_payload = [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}]
         else:
             logger.error(f"Tipo archivo no soportado análisis: '{content_type or extension}' ('{filename}')")
@@ -760,32 +3514,24 @@ async def analizar_documento(
             logger.critical("Payload OpenAI no generado /analizar.")
             raise HTTPException(500, "Error interno preparando solicitud IA.")
         informe_html = "<p><i>Error generando informe.</i></p>"
-        MAX_RETRIES_OPENAI = 2
-        for attempt in range(MAX_RETRIES_OPENAI):
-             try:
-                 logger.info(f"Llamando OpenAI análisis '{filename}' (Intento {attempt + 1})...")
-                 respuesta_informe = client.chat.completions.create(model="gpt-4-turbo", messages=messages_payload, temperature=0.4, max_tokens=3000)
-                 if not respuesta_informe.choices or not respuesta_informe.choices[0].message or not respuesta_informe.choices[0].message.content:
-                     logger.error(f"Respuesta OpenAI inválida análisis '{filename}'.")
-                     continue
-                 informe_html = respuesta_informe.choices[0].message.content.strip()
-                 finish_reason = respuesta_informe.choices[0].finish_reason
-                 logger.info(f"Informe generado OK '{filename}' (Len: {len(informe_html)}, Fin: {finish_reason}).")
-                 if finish_reason == 'length':
-                     logger.warning(f"Informe OpenAI truncado '{filename}'.")
-                     informe_html += "\n<p><i>(Informe incompleto...)</i></p>"
-                 break
-             except APIError as e:
-                 logger.error(f"Error API OpenAI /analizar '{filename}' (Intento {attempt + 1}): {e}", exc_info=True)
-                 time.sleep(0.5)
-             except Exception as e:
-                 logger.error(f"Error OpenAI /analizar '{filename}' (Intento {attempt + 1}): {e}", exc_info=True)
-                 time.sleep(0.5)
-                 if attempt == MAX_RETRIES_OPENAI - 1:
-                     raise HTTPException(503, f"Error OpenAI al analizar tras {MAX_RETRIES_OPENAI} intentos.")
+        informe_cacheable = False
+        try:
+            informe_html, finish_reason = await llamar_openai(messages_payload, 0.4, 3000, f"análisis '{filename}'", current_tenant_id)
+            logger.info(f"Informe generado OK '{filename}' (Len: {len(informe_html)}, Fin: {finish_reason}).")
+            informe_cacheable = finish_reason != 'length'
+            if finish_reason == 'length':
+                logger.warning(f"Informe OpenAI truncado '{filename}'.")
+                informe_html += "\n<p><i>(Informe incompleto...)</i></p>"
+        except (error_api_openai(), RespuestaIAInvalida):
+            pass
+        except (AdmisionRechazada, CircuitoAbierto):
+            raise
+        except Exception:
+            raise HTTPException(503, f"Error OpenAI al analizar tras {OPENAI_MAX_RETRIES} intentos.")
         if BS4_AVAILABLE:
             try:
                 if "<!DOCTYPE html>" in informe_html or "<html" in informe_html:
+                    from bs4 import BeautifulSoup
                     soup = BeautifulSoup(informe_html, 'html.parser')
                     if soup.body:
                         informe_html = soup.body.decode_contents()
@@ -800,39 +3546,102 @@ async def analizar_documento(
         if not re.search(r'<[a-z][\s\S]*>', informe_html, re.IGNORECASE):
             logger.warning("Informe OpenAI no parece HTML, envolviendo en <p>.")
             informe_html = f"<p>{htmlspecialchars(informe_html)}</p>"
+        if informe_cacheable:
+            await asyncio.to_thread(cache_informe_analisis.guardar, clave_informe, informe_html)
         return RespuestaAnalisis(informe=informe_html)
     except HTTPException as e:
         raise e
     except Exception as e:
         logger.error(f"Error general /analizar '{filename}': {e}", exc_info=True)
-        if temp_filename_analisis and os.path.exists(temp_filename_analisis):
-            try:
-                os.remove(temp_filename_analisis)
-                logger.info(f"Temp '{temp_filename_analisis}' eliminado en catch general.")
-            except OSError as e_final_remove:
-                logger.error(f"Error borrar temp '{temp_filename_analisis}' en catch: {e_final_remove}")
         raise HTTPException(status_code=500, detail=f"Error interno procesando archivo ({type(e).__name__}).")
     finally:
         await file.close()
 
-@app.get("/direccion/detalles/{place_id}", response_model=PlaceDetailsResponse)
-async def obtener_detalles_direccion(
-    place_id: str = Path(..., description="ID del lugar obtenido de Google Places Autocomplete"),
-    user_id: int | None = Query(None, description="ID del usuario (opcional para logging)"),
-    tenant_id: int | None = Query(None, description="ID del tenant (opcional para logging)")
-):
-    logger.info(f"Solicitud detalles dirección Place ID: {place_id} (User: {user_id}, Tenant: {tenant_id})")
-    if not MAPS_CONFIGURED:
-        logger.error("/direccion/detalles llamado sin MAPS_API_ALL.")
-        raise HTTPException(503, "Servicio direcciones no disponible.")
-    GOOGLE_PLACES_DETAILS_URL = "https://maps.googleapis.com/maps/api/place/details/json"
-    fields_needed = "address_component,formatted_address"
-    params = {"place_id": place_id, "key": MAPS_API_ALL, "fields": fields_needed, "language": "es"}
-    try:
-        async with httpx.AsyncClient(timeout=10.0) as client_http:
-            response = await client_http.get(GOOGLE_PLACES_DETAILS_URL, params=params)
-            response.raise_for_status()
-            data = response.json()
+# --- Google Places Details: cliente compartido, caché TTL por place_id y peticiones en vuelo compartidas ---
+GOOGLE_PLACES_DETAILS_URL = os.getenv("GOOGLE_PLACES_DETAILS_URL", "https://maps.googleapis.com/maps/api/place/details/json")
+PLACES_TIMEOUT = _env_float("PLACES_TIMEOUT", 10.0)
+PLACES_MAX_CONNECTIONS = _env_int("PLACES_MAX_CONNECTIONS", 20)
+PLACES_CACHE_TTL = _env_float("PLACES_CACHE_TTL", 24 * 3600.0)
+PLACES_CACHE_NEGATIVE_TTL = _env_float("PLACES_CACHE_NEGATIVE_TTL", 600.0)  # ZERO_RESULTS / sin componentes
+PLACES_CACHE_MAX = _env_int("PLACES_CACHE_MAX", 20000)
+PLACES_BULK_MAX = _env_int("PLACES_BULK_MAX", 50)
+PLACES_BULK_CONCURRENCY = max(1, _env_int("PLACES_BULK_CONCURRENCY", 10))
+PLACES_MAX_RETRIES = max(1, _env_int("PLACES_MAX_RETRIES", 2))
+PLACES_HEDGE_DELAY = _env_float("PLACES_HEDGE_DELAY", 0.0)  # s sin respuesta antes de lanzar una petición cubierta; 0 desactiva
+
+class PeticionDetallesLote(BaseModel):
+    place_ids: list[str] = Field(..., min_length=1, description="IDs de lugar obtenidos de Google Places Autocomplete")
+    user_id: int | None = Field(None, description="ID del usuario (opcional para logging)")
+    tenant_id: int | None = Field(None, description="ID del tenant (opcional para logging)")
+
+class RespuestaDetallesLote(BaseModel):
+    results: dict[str, PlaceDetailsResponse]
+
+def parsear_detalles_place(place_id: str, result: dict) -> PlaceDetailsResponse:
+    address_components = result.get("address_components", [])
+    formatted_address = result.get("formatted_address", "N/A")
+    logger.info(f"Dirección formateada {place_id}: {formatted_address}")
+    if not address_components:
+        logger.warning(f"No 'address_components' Google {place_id}")
+        return PlaceDetailsResponse(success=False, error="No componentes detallados.")
+    street_number = None; route = None; postal_code = None; locality = None; province = None; country = None
+    for component in address_components:
+        types = component.get("types", [])
+        long_name = component.get("long_name")
+        if not types or not long_name:
+            continue
+        if "street_number" in types:
+            street_number = long_name
+        if "route" in types:
+            route = long_name
+        if "postal_code" in types:
+            postal_code = long_name
+        if "locality" in types:
+            locality = long_name
+        if "administrative_area_level_2" in types:
+            province = long_name
+        elif "administrative_area_level_1" in types and not province:
+            province = long_name
+        if "country" in types:
+            country = long_name
+    street_address_parts = []
+    if route:
+        street_address_parts.append(route)
+    if street_number:
+        street_address_parts.append(street_number)
+    final_street_address = ", ".join(street_address_parts) if route and street_number else (route or street_number)
+    logger.info(f"Componentes {place_id}: Calle='{final_street_address}', CP='{postal_code}', Loc='{locality}', Prov='{province}', Pais='{country}'")
+    return PlaceDetailsResponse(success=True, street_address=final_street_address, postal_code=postal_code, locality=locality, province=province, country=country)
+
+class ClientePlaces:
+    def __init__(self, cache: CacheTTL):
+        self.cache = cache
+        self._http = None
+        self._en_vuelo = {}  # place_id -> asyncio.Task compartida
+        self._stats = {"requests": 0, "coalesced": 0, "errors": 0}
+
+    def _cliente(self) -> "httpx.AsyncClient":
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                timeout=PLACES_TIMEOUT,
+                limits=httpx.Limits(max_connections=PLACES_MAX_CONNECTIONS, max_keepalive_connections=PLACES_MAX_CONNECTIONS)
+            )
+        return self._http
+
+    async def _pedir(self, params: dict) -> dict:
+        response = await self._cliente().get(GOOGLE_PLACES_DETAILS_URL, params=params)
+        response.raise_for_status()
+        data = response.json()
+        if data.get("status") == "UNKNOWN_ERROR":  # Error temporal de Google: se puede reintentar
+            raise ErrorTransitorio("Google Places API: UNKNOWN_ERROR")
+        return data
+
+    async def _consultar(self, place_id: str) -> PlaceDetailsResponse:
+        self._stats["requests"] += 1
+        params = {"place_id": place_id, "key": MAPS_API_ALL, "fields": "address_component,formatted_address", "language": "es"}
+        try:
+            with metricas.medir("places_api"):
+                data = await con_reintentos(interruptor_places, lambda: self._pedir(params), f"Google Places {place_id}", "details", PLACES_MAX_RETRIES, PLACES_HEDGE_DELAY)
             logger.debug(f"Respuesta Google Places: {data}")
             api_status = data.get("status")
             if api_status != "OK":
@@ -843,55 +3652,156 @@ async def obtener_detalles_direccion(
                 elif api_status == "INVALID_REQUEST":
                     raise HTTPException(400, "Solicitud inválida Google Places API.")
                 elif api_status == "ZERO_RESULTS":
-                    return PlaceDetailsResponse(success=False, error="No se encontraron detalles.")
+                    detalles = PlaceDetailsResponse(success=False, error="No se encontraron detalles.")
                 else:
                     raise HTTPException(503, f"Google Places API: {api_status}")
-            result = data.get("result", {})
-            address_components = result.get("address_components", [])
-            formatted_address = result.get("formatted_address", "N/A")
-            logger.info(f"Dirección formateada {place_id}: {formatted_address}")
-            if not address_components:
-                logger.warning(f"No 'address_components' Google {place_id}")
-                return PlaceDetailsResponse(success=False, error="No componentes detallados.")
-            street_number = None; route = None; postal_code = None; locality = None; province = None; country = None
-            for component in address_components:
-                types = component.get("types", [])
-                long_name = component.get("long_name")
-                if not types or not long_name:
-                    continue
-                if "street_number" in types:
-                    street_number = long_name
-                if "route" in types:
-                    route = long_name
-                if "postal_code" in types:
-                    postal_code = long_name
-                if "locality" in types:
-                    locality = long_name
-                if "administrative_area_level_2" in types:
-                    province = long_name
-                elif "administrative_area_level_1" in types and not province:
-                    province = long_name
-                if "country" in types:
-                    country = long_name
-            street_address_parts = []
-            if route:
-                street_address_parts.append(route)
-            if street_number:
-                street_address_parts.append(street_number)
-            final_street_address = ", ".join(street_address_parts) if route and street_number else (route or street_number)
-            logger.info(f"Componentes {place_id}: Calle='{final_street_address}', CP='{postal_code}', Loc='{locality}', Prov='{province}', Pais='{country}'")
-            return PlaceDetailsResponse(success=True, street_address=final_street_address, postal_code=postal_code, locality=locality, province=province, country=country)
-    except httpx.TimeoutException:
-        logger.error(f"Timeout Google Places {place_id}")
-        raise HTTPException(504, "Timeout obtener detalles dirección.")
-    except httpx.RequestError as e:
-        logger.error(f"Error conexión Google Places {place_id}: {e}", exc_info=True)
-        raise HTTPException(503, "Error conexión obtener detalles dirección.")
-    except HTTPException as e:
-        raise e
-    except Exception as e:
-        logger.error(f"Error inesperado detalles dirección {place_id}: {e}", exc_info=True)
-        raise HTTPException(500, "Error interno procesar dirección.")
+            else:
+                detalles = parsear_detalles_place(place_id, data.get("result", {}))
+        except httpx.TimeoutException:
+            logger.error(f"Timeout Google Places {place_id}")
+            self._stats["errors"] += 1
+            raise HTTPException(504, "Timeout obtener detalles dirección.")
+        except httpx.RequestError as e:
+            logger.error(f"Error conexión Google Places {place_id}: {e}", exc_info=True)
+            self._stats["errors"] += 1
+            raise HTTPException(503, "Error conexión obtener detalles dirección.")
+        except ErrorTransitorio as e:
+            self._stats["errors"] += 1
+            raise HTTPException(503, str(e))
+        except HTTPException:
+            self._stats["errors"] += 1
+            raise
+        except Exception as e:
+            logger.error(f"Error inesperado detalles dirección {place_id}: {e}", exc_info=True)
+            self._stats["errors"] += 1
+            raise HTTPException(500, "Error interno procesar dirección.")
+        self.cache.guardar(place_id, detalles, ttl=None if detalles.success else PLACES_CACHE_NEGATIVE_TTL)
+        return detalles
+
+    def _fin_consulta(self, place_id: str, tarea: asyncio.Task):
+        self._en_vuelo.pop(place_id, None)
+        if not tarea.cancelled():
+            tarea.exception()
+
+    async def detalles(self, place_id: str) -> PlaceDetailsResponse:
+        detalles = self.cache.obtener(place_id)
+        if detalles is not None:
+            return detalles
+        tarea = self._en_vuelo.get(place_id)
+        if tarea is not None:
+            self._stats["coalesced"] += 1
+        else:
+            tarea = asyncio.create_task(self._consultar(place_id))
+            self._en_vuelo[place_id] = tarea
+            tarea.add_done_callback(lambda t: self._fin_consulta(place_id, t))
+        return await asyncio.shield(tarea)
+
+    async def cerrar(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    def estadisticas(self) -> dict:
+        return {"in_flight": len(self._en_vuelo), **self._stats, "cache": self.cache.estadisticas()}
+
+cliente_places = ClientePlaces(CacheTTL("places", PLACES_CACHE_TTL, PLACES_CACHE_MAX))
+
+@app.get("/direccion/detalles/{place_id}", response_model=PlaceDetailsResponse)
+async def obtener_detalles_direccion(
+    place_id: str = Path(..., description="ID del lugar obtenido de Google Places Autocomplete"),
+    user_id: int | None = Query(None, description="ID del usuario (opcional para logging)"),
+    tenant_id: int | None = Query(None, description="ID del tenant (opcional para logging)")
+):
+    logger.info(f"Solicitud detalles dirección Place ID: {place_id} (User: {user_id}, Tenant: {tenant_id})")
+    if not MAPS_CONFIGURED:
+        logger.error("/direccion/detalles llamado sin MAPS_API_ALL.")
+        raise HTTPException(503, "Servicio direcciones no disponible.")
+    return await cliente_places.detalles(place_id)
+
+# Resuelve varios place_id a la vez; los errores se devuelven por elemento (success=false) sin fallar el lote
+@app.post("/direccion/detalles", response_model=RespuestaDetallesLote)
+async def obtener_detalles_direccion_lote(peticion: PeticionDetallesLote):
+    place_ids = list(dict.fromkeys(p.strip() for p in peticion.place_ids if p.strip()))
+    logger.info(f"Solicitud detalles dirección en lote: {len(place_ids)} IDs (User: {peticion.user_id}, Tenant: {peticion.tenant_id})")
+    if not MAPS_CONFIGURED:
+        logger.error("/direccion/detalles (lote) llamado sin MAPS_API_ALL.")
+        raise HTTPException(503, "Servicio direcciones no disponible.")
+    if len(place_ids) > PLACES_BULK_MAX:
+        raise HTTPException(400, f"Máximo {PLACES_BULK_MAX} place_ids por petición.")
+    limite = asyncio.Semaphore(PLACES_BULK_CONCURRENCY)
+    async def resolver(place_id: str) -> PlaceDetailsResponse:
+        async with limite:
+            try:
+                return await cliente_places.detalles(place_id)
+            except HTTPException as e:
+                return PlaceDetailsResponse(success=False, error=e.detail)
+    resultados = await asyncio.gather(*(resolver(p) for p in place_ids))
+    return RespuestaDetallesLote(results=dict(zip(place_ids, resultados)))
+
+# Para PHP: llamar al (des)activar documentos (is_active_for_ai) o cambiar custom_prompt
+@app.post("/cache/invalidate")
+async def invalidar_cache(peticion: PeticionInvalidarCache):
+    eliminadas = invalidar_cache_consulta(peticion.tenant_id, peticion.user_id)
+    return {"success": True, "invalidated": eliminadas}
+
+# --- Calentamiento opcional (WARMUP_ON_STARTUP o GET /warmup) ---
+# Carga en segundo plano lo que el arranque difiere: SDK y cliente de OpenAI, tokenizador y extractores en cada proceso del pool
+WARMUP_ON_STARTUP = os.getenv("WARMUP_ON_STARTUP", "false").strip().lower() in ("1", "true", "yes")
+
+def precargar_extractores() -> int:
+    import PyPDF2  # noqa: F401
+    import docx  # noqa: F401
+    import chardet  # noqa: F401
+    if PIL_AVAILABLE:
+        import PIL.Image  # noqa: F401
+    return os.getpid()
+
+async def calentar() -> dict:
+    tiempos = {}
+
+    async def paso(nombre: str, corrutina):
+        inicio = time.perf_counter()
+        try:
+            await corrutina
+        except Exception as e:
+            logger.warning(f"Calentamiento '{nombre}' fallido: {type(e).__name__}: {e}")
+        tiempos[nombre] = round((time.perf_counter() - inicio) * 1000, 1)
+
+    if client:
+        await paso("openai", asyncio.to_thread(client.obtener))
+    if BS4_AVAILABLE:
+        await paso("bs4", asyncio.to_thread(importlib.import_module, "bs4"))
+    await paso("tokenizer", asyncio.to_thread(contador_tokens.contar, "calentamiento"))
+    await paso("numpy_httpx", asyncio.to_thread(lambda: (np.ndarray, httpx.AsyncClient)))
+    # Un trabajo por proceso: el executor arranca todos los procesos si llegan a la vez
+    await paso("extraction_pool", asyncio.gather(*(extraction_pool.ejecutar(precargar_extractores) for _ in range(max(1, extraction_pool.workers)))))
+    logger.info(f"Calentamiento completado: {tiempos}")
+    return tiempos
+
+@app.get("/warmup")
+async def calentar_servicio():
+    return {"success": True, "timings_ms": await calentar()}
+
+@app.get("/stats")
+async def obtener_estadisticas():
+    return {"startup": estado_arranque, "db_pool": db_pool.estadisticas(), "extraction_pool": extraction_pool.estadisticas(), "ingest_queue": cola_ingesta.estadisticas(), "tokenizer": contador_tokens.estadisticas(), "consulta_cache": consulta_cache.estadisticas(), "vector_index": {"embedder": embedder.nombre, **indices_vectoriales.estadisticas()}, "admission": control_admision.estadisticas(), "circuit_breakers": {i.nombre: i.estadisticas() for i in interruptores}, "historial": buffer_historial.estadisticas(), "dedup": dedup_stats, "images": imagen_stats, "web_search": motor_busqueda.estadisticas(), "places": cliente_places.estadisticas(), "php_bridge": cliente_php.estadisticas(), "analisis_cache": {"texto": cache_texto_analisis.estadisticas(), "informe": cache_informe_analisis.estadisticas()}}
+
+# Estado de los interruptores por upstream (closed / open / half_open, fallos seguidos, último error)
+@app.get("/circuit-breakers")
+async def obtener_interruptores():
+    return {i.nombre: i.estadisticas() for i in interruptores}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def obtener_metricas():
+    return PlainTextResponse(metricas.exportar(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# --- Coste de arranque en frío (informativo en /stats) ---
+# El presupuesto lo comprueban tests/test_arranque.py y benchmarks/bench_arranque.py en un proceso nuevo
+DIFERIDOS = ("openai", "PyPDF2", "docx", "chardet", "bs4", "PIL", "numpy", "httpx")
+estado_arranque = {
+    "import_ms": round((time.perf_counter() - _inicio_import) * 1000, 1),
+    "eager_deferred_modules": [m for m in DIFERIDOS if m in sys.modules and m not in _modulos_previos],  # Solo los que ha traído main
+}
 
 # --- Punto de Entrada (Uvicorn local) ---
 # if __name__ == "__main__":
@@ -0,0 +1,30 @@
+-- Esquema RAG del backend Python (chunks con FTS y embeddings, deduplicación por contenido).
+-- Se aplica una vez, con un rol con permisos DDL, fuera del arranque de la API:
+--   psql "$DATABASE_URL" -f migraciones/001_rag_chunks.sql
+-- Es idempotente. ALTER TABLE sobre user_documents (tabla compartida con la app PHP) toma un bloqueo
+-- ACCESS EXCLUSIVE aunque no haya cambios: ejecutar en una ventana de mantenimiento.
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS user_document_chunks (
+    id BIGSERIAL PRIMARY KEY,
+    document_id INTEGER NOT NULL REFERENCES user_documents(id) ON DELETE CASCADE,
+    user_id INTEGER NOT NULL,
+    tenant_id INTEGER NOT NULL,
+    chunk_index INTEGER NOT NULL,
+    content TEXT NOT NULL,
+    fts_vector TSVECTOR GENERATED ALWAYS AS (to_tsvector('spanish', content)) STORED,
+    UNIQUE (document_id, chunk_index)
+);
+CREATE INDEX IF NOT EXISTS idx_user_document_chunks_fts ON user_document_chunks USING GIN (fts_vector);
+CREATE INDEX IF NOT EXISTS idx_user_document_chunks_owner ON user_document_chunks (tenant_id, user_id);
+
+-- Recuperación vectorial
+ALTER TABLE user_document_chunks ADD COLUMN IF NOT EXISTS embedding BYTEA;
+ALTER TABLE user_document_chunks ADD COLUMN IF NOT EXISTS embedding_model TEXT;
+
+-- Deduplicación por contenido (SHA-256 + extractor)
+ALTER TABLE user_documents ADD COLUMN IF NOT EXISTS content_sha256 CHAR(64);
+ALTER TABLE user_documents ADD COLUMN IF NOT EXISTS content_extractor TEXT;
+CREATE INDEX IF NOT EXISTS idx_user_documents_sha256 ON user_documents (tenant_id, content_sha256) WHERE content_sha256 IS NOT NULL;
+
+COMMIT;
@@ -0,0 +1,8 @@
+# Los tests importan main.py desde la raíz del repo, sin servicios externos (sin variables de BD, OpenAI ni PHP)
+import os
+import sys
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+os.environ.setdefault("LOG_LEVEL", "ERROR")
+os.environ.setdefault("TOKENIZER_FALLBACK", "1")  # Sin red ni TIKTOKEN_CACHE_DIR: estimación de tokens
@@ -0,0 +1,136 @@
+import asyncio
+import math
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+
+class Reloj:
+    def __init__(self):
+        self.ahora = 1000.0
+
+    def __call__(self):
+        return self.ahora
+
+
+def test_cubo_tokens_consume_y_se_rellena(monkeypatch):
+    reloj = Reloj()
+    monkeypatch.setattr(main.time, "monotonic", reloj)
+    cubo = main.CuboTokens(60, 1.0)
+    assert cubo.consumir(60) == 0.0
+    assert cubo.consumir(10) == pytest.approx(10.0)  # Segundos hasta tener 10
+    assert cubo.nivel == pytest.approx(0.0)  # Un rechazo no consume
+    reloj.ahora += 30
+    assert cubo.consumir(30) == 0.0
+    reloj.ahora += 1000
+    assert cubo.consumir(500) == 0.0  # Mayor que la capacidad: pasa con el cubo lleno
+    cubo.devolver(500)
+    assert cubo.nivel == 60
+
+
+def test_reparto_round_robin_entre_tenants():
+    async def escenario():
+        control = main.ControlAdmision(1, 10, 5.0, 0, 0)
+        orden = []
+        primero = await control.adquirir("A", 10)
+
+        async def pedir(tenant, n):
+            permiso = await control.adquirir(tenant, 10)
+            orden.append(f"{tenant}{n}")
+            await asyncio.sleep(0)
+            permiso.liberar()
+
+        tareas = [asyncio.create_task(pedir("A", n)) for n in (1, 2, 3)]
+        await asyncio.sleep(0)
+        tareas.append(asyncio.create_task(pedir("B", 1)))
+        await asyncio.sleep(0)
+        assert control.estadisticas()["waiting"] == 4
+        primero.liberar()
+        await asyncio.gather(*tareas)
+        return control, orden
+
+    control, orden = asyncio.run(escenario())
+    # B no espera detrás de toda la cola de A
+    assert orden == ["A1", "B1", "A2", "A3"]
+    stats = control.estadisticas()
+    assert (stats["in_flight"], stats["waiting"], stats["admitted"]) == (0, 0, 5)
+
+
+def test_cola_llena_rechaza_con_retry_after_estimado():
+    async def escenario():
+        control = main.ControlAdmision(1, 1, 5.0, 0, 0)
+        permiso = await control.adquirir(1, 10)
+        en_cola = asyncio.create_task(control.adquirir(2, 10))
+        await asyncio.sleep(0)
+        with pytest.raises(main.AdmisionRechazada) as rechazo:
+            await control.adquirir(3, 10)
+        with pytest.raises(main.AdmisionRechazada):
+            control.comprobar_peticion(3)
+        permiso.liberar()
+        (await en_cola).liberar()
+        return control, rechazo.value
+
+    control, rechazo = asyncio.run(escenario())
+    assert rechazo.status_code == 429
+    assert rechazo.motivo == "queue_full"
+    # Duración media inicial (5 s) x (1 en cola + 1) / 1 hueco
+    assert rechazo.retry_after == math.ceil(5.0 * 2 / 1)
+    assert rechazo.headers["Retry-After"] == str(rechazo.retry_after)
+    assert control.estadisticas()["tenants"]["3"]["rejected"] == 2
+
+
+def test_rechazo_por_cola_llena_no_gasta_tpm():
+    async def escenario():
+        control = main.ControlAdmision(1, 0, 5.0, 0, 1000)
+        await control.adquirir(1, 100)
+        with pytest.raises(main.AdmisionRechazada) as rechazo:
+            await control.adquirir(1, 500)
+        return control, rechazo.value
+
+    control, rechazo = asyncio.run(escenario())
+    assert rechazo.motivo == "queue_full"
+    assert control._cubos_tokens["1"].nivel == pytest.approx(900, abs=1)
+
+
+def test_espera_agotada_devuelve_los_tokens():
+    async def escenario():
+        control = main.ControlAdmision(1, 10, 0.05, 0, 1000)
+        await control.adquirir(1, 100)
+        with pytest.raises(main.AdmisionRechazada) as rechazo:
+            await control.adquirir(1, 500)
+        return control, rechazo.value
+
+    control, rechazo = asyncio.run(escenario())
+    assert rechazo.motivo == "timeout"
+    assert control._cubos_tokens["1"].nivel == pytest.approx(900, abs=1)
+    assert control.estadisticas()["waiting"] == 0
+
+
+def test_tpm_agotado_rechaza_por_tokens():
+    async def escenario():
+        control = main.ControlAdmision(0, 10, 5.0, 0, 600)
+        await control.adquirir(1, 600)
+        with pytest.raises(main.AdmisionRechazada) as rechazo:
+            await control.adquirir(1, 60)
+        await control.adquirir(2, 60)  # Otro tenant tiene su propio cubo
+        return rechazo.value
+
+    rechazo = asyncio.run(escenario())
+    assert rechazo.motivo == "tokens"
+    assert rechazo.retry_after == 6  # 60 tokens a 10 tokens/s
+
+
+def test_consulta_stream_responde_429_antes_de_abrir_el_stream(monkeypatch):
+    control = main.ControlAdmision(1, 10, 0.05, 0, 0)
+    asyncio.run(control.adquirir(1, 10))  # Hueco ocupado: la siguiente espera y agota el tiempo
+    monkeypatch.setattr(main, "control_admision", control)
+    monkeypatch.setattr(main, "client", object())
+    monkeypatch.setattr(main, "obtener_memoria_y_version", lambda user_id, tenant_id: ("", None))
+    monkeypatch.setattr(main, "preparar_contexto_consulta", lambda *args: ("", ""))
+    monkeypatch.setattr(main, "DB_CONFIGURED", False)
+    respuesta = TestClient(main.app).post("/consulta/stream", json={"mensaje": "hola", "user_id": 1, "tenant_id": 1})
+    assert respuesta.status_code == 429
+    assert int(respuesta.headers["Retry-After"]) >= 1
+    assert control.estadisticas()["in_flight"] == 1
@@ -0,0 +1,27 @@
+# Presupuesto de arranque en frío: una importación lenta o una dependencia pesada a nivel de módulo hace fallar los tests
+import json
+import os
+import subprocess
+import sys
+
+from conftest import RAIZ
+
+IMPORT_BUDGET_MS = float(os.getenv("IMPORT_BUDGET_MS", 250))  # Coste propio de main, sin FastAPI/pydantic
+
+SCRIPT = "import json, main; print(json.dumps(main.estado_arranque))"
+
+
+def _importar_main() -> dict:
+    entorno = {**os.environ, "LOG_LEVEL": "ERROR", "PYTHONDONTWRITEBYTECODE": "1"}
+    salida = subprocess.run([sys.executable, "-c", SCRIPT], cwd=RAIZ, env=entorno, capture_output=True, text=True, check=True)
+    return json.loads(salida.stdout.strip().splitlines()[-1])
+
+
+def test_import_main_no_carga_dependencias_diferidas():
+    assert _importar_main()["eager_deferred_modules"] == []
+
+
+def test_import_main_dentro_del_presupuesto():
+    # El mejor de tres procesos: descarta el ruido de la máquina, no una regresión
+    mejor = min(_importar_main()["import_ms"] for _ in range(3))
+    assert mejor < IMPORT_BUDGET_MS, f"import main tarda {mejor:.0f} ms propios (> {IMPORT_BUDGET_MS:.0f} ms)"
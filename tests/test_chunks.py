@@ -0,0 +1,55 @@
+import main
+
+
+def _texto_frases(n: int) -> str:
+    return " ".join(f"Frase número {i} del documento de prueba." for i in range(n))
+
+
+def test_texto_corto_es_un_solo_chunk():
+    assert main.dividir_en_chunks("Hola mundo.", 200, 40) == ["Hola mundo."]
+
+
+def test_chunks_respetan_tamano_y_solapan():
+    chunks = main.dividir_en_chunks(_texto_frases(60), 300, 60)
+    assert len(chunks) > 5
+    assert all(len(c) <= 300 for c in chunks)
+    for anterior, siguiente in zip(chunks, chunks[1:]):
+        # El inicio del siguiente repite el final del anterior
+        assert siguiente[:20] in anterior
+
+
+def test_corte_en_limite_de_frase():
+    chunks = main.dividir_en_chunks(_texto_frases(60), 300, 0)
+    assert all(c.endswith(".") for c in chunks[:-1])
+
+
+def test_prefiere_corte_en_parrafo():
+    parrafo = "a" * 150 + ". " + "b" * 40
+    texto = parrafo + "\n\n" + "c" * 300
+    chunks = main.dividir_en_chunks(texto, 300, 0)
+    assert chunks[0] == parrafo
+
+
+def test_segmentos_equivalen_al_texto_completo():
+    paginas = [f"Página {p}. " + _texto_frases(30) + "\n\n" for p in range(12)]
+    assert list(main.iterar_chunks(iter(paginas), 300, 60)) == main.dividir_en_chunks("".join(paginas), 300, 60)
+
+
+def test_iterar_chunks_es_perezoso():
+    consumidos = []
+
+    def paginas():
+        for p in range(1000):
+            consumidos.append(p)
+            yield _texto_frases(10) + "\n\n"
+
+    primeros = main.iterar_chunks(paginas(), 300, 60)
+    next(primeros)
+    assert len(consumidos) < 20
+
+
+def test_texto_indexable():
+    assert main.texto_indexable("Contenido real")
+    assert not main.texto_indexable("   ")
+    assert not main.texto_indexable("[Error: Timeout extracción]")
+    assert not main.texto_indexable("[Extracción no soportada para tipo: xls]")
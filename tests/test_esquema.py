@@ -0,0 +1,66 @@
+import os
+import re
+
+import main
+
+
+class CursorFalso:
+    def __init__(self, filas):
+        self.filas = filas
+        self.sql = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, sql, params=None):
+        self.sql.append(sql)
+
+    def fetchall(self):
+        return self.filas
+
+
+class ConexionFalsa:
+    def __init__(self, filas):
+        self.cursor_falso = CursorFalso(filas)
+
+    def cursor(self):
+        return self.cursor_falso
+
+    def rollback(self):
+        pass
+
+    def commit(self):
+        raise AssertionError("la comprobación del esquema no debe escribir")
+
+
+def _con_conexion(monkeypatch, filas):
+    conn = ConexionFalsa(filas)
+    monkeypatch.setattr(main, "get_db_connection", lambda: conn)
+    monkeypatch.setattr(main, "release_db_connection", lambda c: None)
+    return conn
+
+
+def test_esquema_completo(monkeypatch):
+    filas = [(tabla, columna) for tabla, columnas in main.COLUMNAS_ESQUEMA_RAG.items() for columna in columnas]
+    conn = _con_conexion(monkeypatch, filas)
+    assert main.comprobar_esquema_rag() == []
+    assert not any(re.search(r"\b(ALTER|CREATE)\b", sql) for sql in conn.cursor_falso.sql)
+
+
+def test_esquema_sin_migrar_indica_columnas(monkeypatch):
+    _con_conexion(monkeypatch, [("user_documents", "content_sha256")])
+    faltan = main.comprobar_esquema_rag()
+    assert "user_documents.content_extractor" in faltan
+    assert "user_document_chunks.embedding" in faltan
+    assert "user_documents.content_sha256" not in faltan
+
+
+def test_la_migracion_crea_todas_las_columnas_comprobadas():
+    with open(os.path.join(main.os.path.dirname(main.__file__), main.MIGRACION_RAG), encoding="utf-8") as f:
+        sql = f.read()
+    for columnas in main.COLUMNAS_ESQUEMA_RAG.values():
+        for columna in columnas:
+            assert re.search(rf"\b{columna}\b", sql), columna
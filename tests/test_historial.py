@@ -0,0 +1,127 @@
+import asyncio
+import time
+
+import pytest
+
+import main
+
+
+class ConexionFalsa:
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+@pytest.fixture
+def bd(monkeypatch):
+    lotes = []
+    estado = {"fallar": 0, "espera": 0.0, "durante": None}
+
+    def execute_values(cursor, sql, filas, template=None, page_size=100):
+        if estado["durante"]:
+            estado["durante"]()
+        time.sleep(estado["espera"])
+        if estado["fallar"]:
+            estado["fallar"] -= 1
+            raise main.psycopg2.OperationalError("BD caída")
+        lotes.append([fila[2] for fila in filas])
+
+    monkeypatch.setattr(main, "DB_CONFIGURED", True)
+    monkeypatch.setattr(main, "get_db_connection", lambda: ConexionFalsa())
+    monkeypatch.setattr(main, "release_db_connection", lambda conn: None)
+    monkeypatch.setattr(main.psycopg2.extras, "execute_values", execute_values)
+    return lotes, estado
+
+
+def _agregar(buffer, *preguntas):
+    for pregunta in preguntas:
+        buffer.agregar(1, 1, pregunta, "respuesta")
+
+
+def _pendientes(buffer):
+    return [fila[2] for fila in buffer._filas]
+
+
+def test_desborde_descarta_las_antiguas(bd):
+    buffer = main.BufferHistorial(10, 60.0, 3, "descartar_antiguas")
+    _agregar(buffer, "a", "b", "c", "d", "e")
+    assert _pendientes(buffer) == ["c", "d", "e"]
+    assert buffer.estadisticas()["dropped"] == 2
+
+
+def test_desborde_descarta_las_nuevas(bd):
+    buffer = main.BufferHistorial(10, 60.0, 3, "descartar_nuevas")
+    _agregar(buffer, "a", "b", "c", "d", "e")
+    assert _pendientes(buffer) == ["a", "b", "c"]
+    assert buffer.estadisticas()["dropped"] == 2
+
+
+def test_vuelca_por_lotes_y_vacia_al_parar(bd):
+    lotes, _ = bd
+
+    async def escenario():
+        buffer = main.BufferHistorial(2, 60.0, 100, "descartar_antiguas")
+        await buffer.iniciar()
+        _agregar(buffer, "a", "b", "c", "d", "e")
+        await buffer.detener(5.0)
+        return buffer
+
+    buffer = asyncio.run(escenario())
+    assert lotes == [["a", "b"], ["c", "d"], ["e"]]
+    stats = buffer.estadisticas()
+    assert (stats["written"], stats["pending"], stats["dropped"]) == (5, 0, 0)
+
+
+def test_lote_fallido_vuelve_al_frente_en_orden(bd):
+    lotes, estado = bd
+    estado["fallar"] = 1
+    buffer = main.BufferHistorial(2, 60.0, 10, "descartar_antiguas")
+    _agregar(buffer, "a", "b", "c")
+    assert asyncio.run(buffer._volcar()) is False
+    assert _pendientes(buffer) == ["a", "b", "c"]
+    assert buffer.estadisticas()["flush_errors"] == 1
+    assert asyncio.run(buffer._volcar()) is True
+    assert lotes == [["a", "b"]]
+
+
+def test_lote_fallido_respeta_el_limite_del_buffer(bd):
+    _, estado = bd
+    estado["fallar"] = 1
+    buffer = main.BufferHistorial(2, 60.0, 3, "descartar_antiguas")
+    _agregar(buffer, "a", "b", "c")
+    estado["durante"] = lambda: _agregar(buffer, "d")  # Llega mientras se escribe el lote
+    asyncio.run(buffer._volcar())
+    # Queda hueco para una de las dos filas del lote fallido: se conserva la más antigua
+    assert _pendientes(buffer) == ["a", "c", "d"]
+    assert buffer.estadisticas()["dropped"] == 1
+
+
+def test_vaciado_al_parar_esta_acotado(bd):
+    _, estado = bd
+    estado["espera"] = 0.5
+
+    async def escenario():
+        buffer = main.BufferHistorial(1, 60.0, 100, "descartar_antiguas")
+        await buffer.iniciar()
+        _agregar(buffer, "a", "b", "c", "d")
+        inicio = time.perf_counter()
+        await buffer.detener(0.2)
+        return buffer, time.perf_counter() - inicio
+
+    buffer, duracion = asyncio.run(escenario())
+    assert duracion < 0.45
+    stats = buffer.estadisticas()
+    assert stats["pending"] == 0
+    assert stats["written"] + stats["dropped"] <= 4
+    assert stats["dropped"] >= 3
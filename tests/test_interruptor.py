@@ -0,0 +1,185 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+
+
+class Reloj:
+    def __init__(self):
+        self.ahora = 1000.0
+
+    def __call__(self):
+        return self.ahora
+
+
+def error_http(status, cabeceras=None):
+    peticion = httpx.Request("GET", "https://upstream.test/")
+    return httpx.HTTPStatusError(f"HTTP {status}", request=peticion, response=httpx.Response(status, headers=cabeceras, request=peticion))
+
+
+@pytest.fixture
+def reloj(monkeypatch):
+    reloj = Reloj()
+    monkeypatch.setattr(main.time, "monotonic", reloj)
+    return reloj
+
+
+# asyncio.sleep sustituido: registra las esperas sin dormir
+@pytest.fixture
+def esperas(monkeypatch):
+    esperas = []
+
+    async def dormir(segundos):
+        esperas.append(segundos)
+
+    monkeypatch.setattr(main.asyncio, "sleep", dormir)
+    return esperas
+
+
+def llamadas(*resultados):
+    pendientes = list(resultados)
+    hechas = []
+
+    async def llamada():
+        hechas.append(1)
+        resultado = pendientes.pop(0)
+        if isinstance(resultado, Exception):
+            raise resultado
+        return resultado
+
+    return llamada, hechas
+
+
+def test_se_abre_tras_n_fallos_y_rechaza_con_503(reloj):
+    interruptor = main.Interruptor("prueba", 3, 30.0)
+    for _ in range(2):
+        interruptor.permitir()
+        interruptor.fallo(main.ErrorTransitorio("caído"))
+    assert interruptor.estado == "closed"
+    interruptor.permitir()
+    interruptor.fallo(main.ErrorTransitorio("caído"))
+    assert interruptor.estado == "open"
+    reloj.ahora += 10
+    with pytest.raises(main.CircuitoAbierto) as rechazo:
+        interruptor.permitir()
+    assert rechazo.value.status_code == 503
+    assert rechazo.value.headers["Retry-After"] == "20"
+    assert interruptor.estadisticas()["rejected"] == 1
+
+
+def test_un_exito_reinicia_los_fallos_consecutivos(reloj):
+    interruptor = main.Interruptor("prueba", 2, 30.0)
+    interruptor.permitir()
+    interruptor.fallo(main.ErrorTransitorio("caído"))
+    interruptor.permitir()
+    interruptor.exito()
+    interruptor.permitir()
+    interruptor.fallo(main.ErrorTransitorio("caído"))
+    assert interruptor.estado == "closed"
+
+
+def test_half_open_deja_pasar_una_sola_prueba(reloj):
+    interruptor = main.Interruptor("prueba", 1, 30.0)
+    interruptor.permitir()
+    interruptor.fallo(main.ErrorTransitorio("caído"))
+    reloj.ahora += 30
+    interruptor.permitir()
+    assert interruptor.estado == "half_open"
+    with pytest.raises(main.CircuitoAbierto):
+        interruptor.permitir()  # Prueba en curso
+    interruptor.exito()
+    assert interruptor.estado == "closed"
+    interruptor.permitir()
+    interruptor.permitir()
+
+
+def test_fallo_en_la_prueba_vuelve_a_abrir(reloj):
+    interruptor = main.Interruptor("prueba", 5, 30.0)
+    for _ in range(5):
+        interruptor.permitir()
+        interruptor.fallo(main.ErrorTransitorio("caído"))
+    reloj.ahora += 30
+    interruptor.permitir()
+    interruptor.fallo(main.ErrorTransitorio("sigue caído"))  # Un solo fallo basta en half_open
+    assert interruptor.estado == "open"
+    assert interruptor.estadisticas()["retry_in_s"] == 30.0
+    assert interruptor.estadisticas()["opened"] == 2
+
+
+def test_4xx_durante_la_prueba_no_cierra_ni_abre(reloj, esperas):
+    interruptor = main.Interruptor("prueba", 1, 30.0)
+    interruptor.permitir()
+    interruptor.fallo(main.ErrorTransitorio("caído"))
+    reloj.ahora += 30
+    llamada, hechas = llamadas(error_http(404), "ok")
+
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(main.con_reintentos(interruptor, llamada, "prueba", "test", 3))
+    assert len(hechas) == 1 and esperas == []  # Definitivo: sin reintento
+    assert interruptor.estado == "half_open"  # Ni éxito ni fallo, pero la prueba queda libre
+    assert asyncio.run(main.con_reintentos(interruptor, llamada, "prueba", "test", 3)) == "ok"
+    assert interruptor.estado == "closed"
+
+
+def test_reintenta_transitorios_y_cierra_con_exito(esperas):
+    interruptor = main.Interruptor("prueba", 5, 30.0)
+    llamada, hechas = llamadas(error_http(503), main.ErrorTransitorio("UNKNOWN_ERROR"), "ok")
+    assert asyncio.run(main.con_reintentos(interruptor, llamada, "prueba", "test", 3)) == "ok"
+    assert len(hechas) == 3 and len(esperas) == 2
+    assert interruptor.estadisticas()["consecutive_failures"] == 0
+    assert interruptor.estadisticas()["retries"] == 2
+
+
+def test_ultimo_intento_propaga_el_error(esperas):
+    interruptor = main.Interruptor("prueba", 5, 30.0)
+    llamada, hechas = llamadas(error_http(500), error_http(502))
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(main.con_reintentos(interruptor, llamada, "prueba", "test", 2))
+    assert len(hechas) == 2 and len(esperas) == 1
+
+
+def test_no_reintenta_si_el_interruptor_se_abre(esperas):
+    interruptor = main.Interruptor("prueba", 1, 30.0)
+    llamada, hechas = llamadas(error_http(503), "ok")
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(main.con_reintentos(interruptor, llamada, "prueba", "test", 3))
+    assert len(hechas) == 1 and esperas == []
+    assert interruptor.estado == "open"
+
+
+def test_respeta_retry_after(monkeypatch, esperas):
+    monkeypatch.setattr(main, "RETRY_AFTER_MAX", 30.0)
+    interruptor = main.Interruptor("prueba", 5, 30.0)
+    llamada, hechas = llamadas(error_http(429, {"Retry-After": "7"}), "ok")
+    assert asyncio.run(main.con_reintentos(interruptor, llamada, "prueba", "test", 3)) == "ok"
+    assert esperas == [7.0]
+
+
+def test_retry_after_mayor_que_el_maximo_no_se_reintenta(monkeypatch, esperas):
+    monkeypatch.setattr(main, "RETRY_AFTER_MAX", 30.0)
+    interruptor = main.Interruptor("prueba", 5, 30.0)
+    llamada, hechas = llamadas(error_http(429, {"Retry-After": "120"}), "ok")
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(main.con_reintentos(interruptor, llamada, "prueba", "test", 3))
+    assert len(hechas) == 1 and esperas == []
+    assert interruptor.estadisticas()["failures"] == 1  # Cuenta como fallo aunque no se reintente
+
+
+def test_segundos_retry_after():
+    assert main.segundos_retry_after(error_http(429, {"retry-after-ms": "1500"})) == 1.5
+    assert main.segundos_retry_after(error_http(503, {"Retry-After": "4"})) == 4.0
+    assert main.segundos_retry_after(error_http(503, {"Retry-After": "pronto"})) is None
+    assert main.segundos_retry_after(error_http(503)) is None
+    assert main.segundos_retry_after(ValueError("sin respuesta")) is None
+
+
+def test_jitter_completo(monkeypatch):
+    monkeypatch.setattr(main, "RETRY_BASE_DELAY", 0.5)
+    monkeypatch.setattr(main, "RETRY_MAX_DELAY", 8.0)
+    limites = []
+    monkeypatch.setattr(main.random, "uniform", lambda a, b: limites.append((a, b)) or b)
+    assert [main.calcular_espera(intento) for intento in range(6)] == [0.5, 1.0, 2.0, 4.0, 8.0, 8.0]
+    assert all(a == 0 for a, _ in limites)  # Uniforme desde 0, no alrededor del exponencial
+    assert main.calcular_espera(0, retry_after=3.0) == 3.0  # Nunca por debajo del Retry-After
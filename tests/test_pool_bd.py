@@ -0,0 +1,79 @@
+import psycopg2.extensions
+import pytest
+
+import main
+
+
+class ConexionFalsa:
+    def __init__(self):
+        self.closed = 0
+        self.status = psycopg2.extensions.STATUS_READY
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, sql):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+# Imita ThreadedConnectionPool: abre minconn al crearse y cierra al devolver lo que sobra por encima de minconn libres
+class PoolFalso:
+    def __init__(self, minconn, maxconn, **kwargs):
+        self.minconn = minconn
+        self.libres = [ConexionFalsa() for _ in range(minconn)]
+
+    def getconn(self):
+        return self.libres.pop() if self.libres else ConexionFalsa()
+
+    def putconn(self, conn, close=False):
+        if close or len(self.libres) >= self.minconn:
+            conn.close()
+        else:
+            self.libres.append(conn)
+
+    def closeall(self):
+        for conn in self.libres:
+            conn.close()
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(main.psycopg2.pool, "ThreadedConnectionPool", PoolFalso)
+    pool = main.PoolConexionesBD(1, 3, 1.0, 30.0)
+    assert pool.abrir()
+    yield pool
+    pool.cerrar()
+
+
+def test_estadisticas_cuentan_conexiones_abiertas_libres_y_cerradas(pool):
+    assert pool.estadisticas()["connections"] == 1
+    assert pool.estadisticas()["idle"] == 1
+    conexiones = [pool.obtener() for _ in range(3)]
+    stats = pool.estadisticas()
+    assert (stats["connections"], stats["idle"], stats["in_use"], stats["opened"]) == (3, 0, 3, 3)
+    for conn in conexiones:
+        pool.liberar(conn)
+    stats = pool.estadisticas()
+    assert (stats["connections"], stats["idle"], stats["in_use"], stats["closed"]) == (1, 1, 0, 2)
+
+
+def test_conexion_cerrada_se_descarta_al_devolver(pool):
+    conn = pool.obtener()
+    conn.closed = 1
+    pool.liberar(conn)
+    stats = pool.estadisticas()
+    assert (stats["connections"], stats["closed"]) == (0, 1)
+    assert pool.obtener() is not None
+    assert pool.estadisticas()["opened"] == 2
@@ -0,0 +1,55 @@
+import numpy as np
+
+import main
+
+
+def test_embedder_local_es_determinista_y_normalizado():
+    embedder = main.EmbedderLocal(256)
+    textos = ["Contrato de arrendamiento de vivienda", "Factura de electricidad"]
+    a = embedder.embeber_sync(textos)
+    b = main.EmbedderLocal(256).embeber_sync(textos)
+    assert a.shape == (2, 256)
+    assert a.dtype == np.float32
+    assert np.array_equal(a, b)
+    assert np.allclose(np.linalg.norm(a, axis=1), 1.0)
+
+
+def test_embedder_local_ignora_acentos_y_mayusculas():
+    embedder = main.EmbedderLocal(256)
+    a, b = embedder.embeber_sync(["Información del CAMIÓN", "informacion del camion"])
+    assert np.allclose(a, b)
+
+
+def test_embedder_local_texto_vacio_no_divide_por_cero():
+    vector = main.EmbedderLocal(64).embeber_sync([""])[0]
+    assert not np.isnan(vector).any()
+    assert not vector.any()
+
+
+def test_similitud_favorece_el_texto_relacionado():
+    embedder = main.EmbedderLocal(512)
+    consulta, cercano, lejano = embedder.embeber_sync(["arrendamiento de la vivienda", "contrato de arrendamiento de vivienda en Madrid", "receta de tortilla de patatas"])
+    assert consulta @ cercano > consulta @ lejano
+
+
+def test_indice_vectorial_devuelve_los_k_mejores_ordenados():
+    matriz = np.eye(4, dtype=np.float32)
+    indice = main.IndiceVectorial("v1", np.array([10, 11, 12, 13], dtype=np.int64), matriz)
+    vector = np.array([0.1, 0.9, 0.5, 0.0], dtype=np.float32)
+    assert [chunk_id for chunk_id, _ in indice.buscar(vector, 2)] == [11, 12]
+    assert main.IndiceVectorial("v1", np.zeros(0, dtype=np.int64), np.zeros((0, 4), dtype=np.float32)).buscar(vector, 3) == []
+
+
+def test_rrf_premia_lo_que_aparece_en_ambas_listas():
+    fts = ["a", "b", "c"]
+    vectorial = ["c", "d", "a"]
+    orden = [clave for clave, _ in main.fusionar_rrf(fts, vectorial, k=60)]
+    assert orden[:2] == ["a", "c"]
+    assert set(orden) == {"a", "b", "c", "d"}
+
+
+def test_rrf_puntuacion_por_posicion():
+    (clave, puntuacion), = main.fusionar_rrf(["x"], k=10)
+    assert clave == "x"
+    assert puntuacion == 1 / 11
+    assert main.fusionar_rrf() == []
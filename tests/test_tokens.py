@@ -0,0 +1,37 @@
+import pytest
+
+import main
+
+
+@pytest.fixture
+def sin_bpe(monkeypatch):
+    def fallar(nombre):
+        raise OSError("sin red")
+    if main.TIKTOKEN_AVAILABLE:
+        monkeypatch.setattr(main.tiktoken, "get_encoding", fallar)
+    return main.ContadorTokens("cl100k_base", 100)
+
+
+def test_sin_bpe_el_arranque_falla_salvo_fallback_explicito(sin_bpe):
+    with pytest.raises(RuntimeError, match="TOKENIZER_FALLBACK"):
+        sin_bpe.verificar(False)
+    sin_bpe.verificar(True)
+    assert sin_bpe.estadisticas()["fallback"] is True
+    assert sin_bpe.estadisticas()["encoding"] == "estimado"
+    assert 'tokenizer_fallback 1' in main.metricas.exportar()
+
+
+def test_recortar_y_dividir_respetan_el_presupuesto(sin_bpe):
+    texto = " ".join(f"Oración número {i} del informe." for i in range(400))
+    recortado = sin_bpe.recortar(texto, 100)
+    assert sin_bpe.contar(recortado) <= 100
+    assert recortado.endswith(".")
+    bloques = sin_bpe.dividir(texto, 100)
+    assert all(sin_bpe.contar(b) <= 100 for b in bloques)
+    assert " ".join(bloques) == texto
+
+
+def test_conteo_en_cache(sin_bpe):
+    texto = "palabra " * 50
+    assert sin_bpe.contar(texto) == sin_bpe.contar(texto)
+    assert sin_bpe.estadisticas()["hits"] == 1